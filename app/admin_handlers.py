@@ -1,16 +1,34 @@
 import logging
-from aiogram import Router, F
-from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from io import BytesIO
+from aiogram import Router, F, Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
+from aiogram.utils.chat_action import ChatActionSender
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
-from requests import ( get_statistics, get_all_users, search_users_by_phone, search_users_by_name, get_user_by_id, 
-                      update_user_points, delete_empty_users, clean_duplicate_phones, add_user_with_details,
-                      quick_add_user,get_points_history
+from requests import ( get_statistics, get_all_users, search_users, get_user_by_id, 
+                      update_user_points, add_user_with_details,
+                      quick_add_user,get_points_history, get_user_by_phone, import_users, accrue_cashback,
+                      get_users_page, get_user_stats, get_points_statistics
 )
-from models import Session, User, PointsHistory
-from config import ADMIN_IDS
+from sqlalchemy import select
+from models import async_session, User
+from config import ADMIN_IDS, CASHBACK_PERCENT, POINTS_EXPIRY_DAYS, BACKUP_DIR
+from app.cache import user_cache
+from app.metrics import format_latency_report
+from app.scheduler import scheduler
+from app.backup import list_backups
+from app.phones import normalize_phone
+from app.csv_import import read_users_csv, read_orders_csv
+from app.export import EXPORT_TABLES, export_table
+from app.broadcast import (create_broadcast, get_broadcast, get_recent_broadcasts, set_broadcast_status,
+                           start_broadcast, format_broadcast)
+from app.segments import SEGMENT_HELP, count_segment, sample_segment
 import app.keyboards as kb
 
 logger = logging.getLogger(__name__)
@@ -33,6 +51,9 @@ class AdminState(StatesGroup):
     waiting_for_add_user_phone = State()
     waiting_for_add_user_points = State()
     waiting_for_add_user_name = State()
+    waiting_for_import_file = State()
+    waiting_for_cashback_file = State()
+    waiting_for_broadcast_text = State()
 
 # Проверка на админа
 def is_admin(user_id: int) -> bool:
@@ -67,7 +88,7 @@ async def admin_stats_handler(callback: CallbackQuery):
     if not is_admin(callback.from_user.id):
         return
     
-    stats = get_statistics()
+    stats = await get_statistics()
     
     text = (
         "📊 *Статистика бота:*\n\n"
@@ -143,16 +164,38 @@ async def admin_exit_handler(callback: CallbackQuery):
 
 # ========== УПРАВЛЕНИЕ ПОЛЬЗОВАТЕЛЯМИ ==========
 
+USERS_PAGE_SIZE = 20
+
 @router.callback_query(F.data == "admin_users_list")
 async def admin_users_list_handler(callback: CallbackQuery):
-    """📋 Список пользователей"""
-    users = get_all_users(limit=20)
+    """📋 Список пользователей (первая страница - новые)"""
+    await show_users_page(callback)
+
+@router.callback_query(F.data.startswith("admin_users_older_"))
+async def admin_users_older_handler(callback: CallbackQuery):
+    """▶️ Следующая страница: пользователи старше последнего показанного id"""
+    await show_users_page(callback, before_id=int(callback.data.rsplit('_', 1)[1]))
+
+@router.callback_query(F.data.startswith("admin_users_newer_"))
+async def admin_users_newer_handler(callback: CallbackQuery):
+    """◀️ Предыдущая страница: пользователи новее первого показанного id"""
+    await show_users_page(callback, after_id=int(callback.data.rsplit('_', 1)[1]))
+
+async def show_users_page(callback: CallbackQuery, before_id: int = None, after_id: int = None):
+    # В кнопках - id крайних строк страницы (курсор), а не номер страницы
+    users, has_newer, has_older = await get_users_page(before_id, after_id, USERS_PAGE_SIZE)
     
     if not users:
-        await callback.message.edit_text("📭 Нет пользователей")
+        await callback.message.edit_text(
+            "📭 Нет пользователей",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_users")]
+            ])
+        )
+        await callback.answer()
         return
     
-    text = "👥 *Последние 20 пользователей:*\n\n"
+    text = "👥 *Пользователи (новые сверху):*\n\n"
     for user in users:
         phone_display = user.phone if user.phone else "📵 нет телефона"
         name_display = f"{user.first_name or ''} {user.last_name or ''}".strip()
@@ -167,13 +210,22 @@ async def admin_users_list_handler(callback: CallbackQuery):
             f"---\n"
         )
     
+    navigation = []
+    if has_newer:
+        navigation.append(InlineKeyboardButton(text="◀️ Новее", callback_data=f"admin_users_newer_{users[0].id}"))
+    if has_older:
+        navigation.append(InlineKeyboardButton(text="Старше ▶️", callback_data=f"admin_users_older_{users[-1].id}"))
+    
+    keyboard = [navigation] if navigation else []
+    keyboard += [
+        [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_users")],
+        [InlineKeyboardButton(text="🏠 В главное меню", callback_data="admin_back_main")]
+    ]
+    
     await callback.message.edit_text(
         text,
         parse_mode="Markdown",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_users")],
-            [InlineKeyboardButton(text="🏠 В главное меню", callback_data="admin_back_main")]
-        ])
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard)
     )
     await callback.answer()
 
@@ -196,13 +248,8 @@ async def process_admin_search(message: Message, state: FSMContext):
     """Обработка поиска пользователя"""
     search_text = message.text.strip()
     
-    # Ищем по телефону
-    users_by_phone = search_users_by_phone(search_text)
-    # Ищем по имени
-    users_by_name = search_users_by_name(search_text)
-    
-    # Объединяем результаты
-    all_users = list(set(users_by_phone + users_by_name))
+    # Один запрос к поисковому индексу: телефон, имя, фамилия, username
+    all_users = await search_users(search_text, limit=11)
     
     if not all_users:
         await message.answer(
@@ -212,7 +259,7 @@ async def process_admin_search(message: Message, state: FSMContext):
         await state.clear()
         return
     
-    text = f"🔍 *Найдено пользователей: {len(all_users)}*\n\n"
+    text = f"🔍 *Найдено пользователей: {len(all_users) if len(all_users) <= 10 else 'больше 10'}*\n\n"
     
     for i, user in enumerate(all_users[:10], 1):
         name_display = f"{user.first_name or ''} {user.last_name or ''}".strip()
@@ -238,7 +285,7 @@ async def process_admin_search(message: Message, state: FSMContext):
             ])
     
     if len(all_users) > 10:
-        text += f"\n... и еще {len(all_users) - 10} пользователей"
+        text += "\n... показаны первые 10, уточните запрос"
     
     await message.answer(
         text,
@@ -251,7 +298,7 @@ async def process_admin_search(message: Message, state: FSMContext):
 async def admin_view_user_handler(callback: CallbackQuery):
     """👁️ Подробная информация о пользователе"""
     user_id = int(callback.data.split("_")[2])
-    user = get_user_by_id(user_id)
+    user = await get_user_by_id(user_id)
     
     if not user:
         await callback.answer("❌ Пользователь не найден")
@@ -317,14 +364,14 @@ async def process_add_points(message: Message, state: FSMContext):
             await state.clear()
             return
         
-        user = get_user_by_id(user_id)
+        user = await get_user_by_id(user_id)
         if not user:
             await message.answer("❌ Пользователь не найден")
             await state.clear()
             return
         
         # Добавляем баллы
-        if update_user_points(user_id, 'add_manual', points):
+        if await update_user_points(user_id, 'add_manual', points):
             await message.answer(
                 f"✅ Успешно!\n\n"
                 f"👤 Пользователь: {user.first_name or 'ID:' + str(user.id)}\n"
@@ -343,13 +390,19 @@ async def process_add_points(message: Message, state: FSMContext):
 
 # ========== ОЧИСТКА БАЗЫ ==========
 
+def cleanup_started_text(job_name: str) -> str:
+    """Очистка идет фоновой задачей планировщика, а не внутри обработчика"""
+    if scheduler.trigger(job_name):
+        return "⏳ Очистка запущена в фоне, результат - /jobs"
+    if job_name in scheduler.jobs:
+        return "⏳ Очистка уже выполняется, результат - /jobs"
+    return "❌ Фоновые задачи не запущены"
+
 @router.callback_query(F.data == "admin_clean_empty")
 async def admin_clean_empty_handler(callback: CallbackQuery):
     """🧹 Очистить пустых пользователей"""
-    count, msg = delete_empty_users()
-    
     await callback.message.edit_text(
-        msg,
+        cleanup_started_text('clean_empty_users'),
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_cleanup")]
         ])
@@ -359,10 +412,8 @@ async def admin_clean_empty_handler(callback: CallbackQuery):
 @router.callback_query(F.data == "admin_clean_duplicates")
 async def admin_clean_duplicates_handler(callback: CallbackQuery):
     """🔄 Удалить дубликаты телефонов"""
-    count, msg = clean_duplicate_phones()
-    
     await callback.message.edit_text(
-        msg,
+        cleanup_started_text('clean_duplicates'),
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_cleanup")]
         ])
@@ -372,35 +423,22 @@ async def admin_clean_duplicates_handler(callback: CallbackQuery):
 @router.callback_query(F.data == "admin_db_stats")
 async def admin_db_stats_handler(callback: CallbackQuery):
     """📊 Статистика БД"""
-    session = Session()
-    try:
-        from sqlalchemy import func
-        
-        total_users = session.query(func.count(User.id)).scalar()
-        users_with_phone = session.query(func.count(User.id)).filter(User.phone.isnot(None)).scalar()
-        users_with_tg = session.query(func.count(User.id)).filter(User.tg_id.isnot(None)).scalar()
-        empty_users = session.query(func.count(User.id)).filter(
-            User.phone.is_(None),
-            User.tg_id.is_(None)
-        ).scalar()
-        
-        stats = (
-            f"📊 *Статистика базы данных:*\n\n"
-            f"👥 Всего записей: {total_users}\n"
-            f"📱 С телефоном: {users_with_phone}\n"
-            f"🤖 С TG ID: {users_with_tg}\n"
-            f"🚫 Пустых записей: {empty_users}\n\n"
-            f"Для очистки используйте соответствующие кнопки."
-        )
-        
-        await callback.message.edit_text(
-            stats,
-            parse_mode="Markdown",
-            reply_markup=kb.admin_cleanup_menu
-        )
-        
-    finally:
-        session.close()
+    stats = await get_user_stats()
+    
+    text = (
+        f"📊 *Статистика базы данных:*\n\n"
+        f"👥 Всего записей: {stats['total_users']}\n"
+        f"📱 С телефоном: {stats['users_with_phone']}\n"
+        f"🤖 С TG ID: {stats['users_with_tg']}\n"
+        f"🚫 Пустых записей: {stats['empty_users']}\n\n"
+        f"Для очистки используйте соответствующие кнопки."
+    )
+    
+    await callback.message.edit_text(
+        text,
+        parse_mode="Markdown",
+        reply_markup=kb.admin_cleanup_menu
+    )
     await callback.answer()
 
 # ========== НАВИГАЦИЯ ==========
@@ -436,7 +474,7 @@ async def quick_users_command(message: Message):
     if not is_admin(message.from_user.id):
         return
     
-    users = get_all_users(limit=10)
+    users = await get_all_users(limit=10)
     
     text = "👥 *Последние 10 пользователей:*\n\n"
     for user in users:
@@ -444,6 +482,46 @@ async def quick_users_command(message: Message):
     
     await message.answer(text, parse_mode="Markdown")
 
+@router.message(Command("latency"))
+async def latency_command(message: Message):
+    """Время ответа обработчиков с момента запуска: /latency"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    await message.answer(f"⏱ Время ответа обработчиков:\n\n{format_latency_report()}")
+
+@router.message(Command("jobs"))
+async def jobs_command(message: Message):
+    """Фоновые задачи: /jobs - состояние, /jobs run имя - запустить сейчас"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    parts = message.text.split()
+    if len(parts) > 2 and parts[1] == 'run':
+        if scheduler.trigger(parts[2]):
+            await message.answer(f"⏳ {parts[2]} запущена, результат - /jobs")
+        elif parts[2] in scheduler.jobs:
+            await message.answer(f"⏳ {parts[2]} уже выполняется")
+        else:
+            await message.answer(f"❌ Нет задачи {parts[2]}. Есть: {', '.join(scheduler.jobs)}")
+        return
+    
+    await message.answer(f"🗓 Фоновые задачи\n\n{scheduler.format_report()}")
+
+@router.message(Command("backup"))
+async def backup_command(message: Message):
+    """Резервная копия базы в фоне (задача backup планировщика) и список копий"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    if scheduler.trigger('backup'):
+        status = "⏳ Копия создается в фоне, результат - /jobs"
+    else:
+        status = "⏳ Копия уже создается, результат - /jobs"
+    backups = list_backups()
+    saved = '\n'.join(os.path.basename(path) for path in backups) if backups else "пока нет"
+    await message.answer(f"💾 {status}\n\nСохраненные копии ({BACKUP_DIR}):\n{saved}")
+
 @router.message(Command("addpoints"))
 async def quick_add_points_command(message: Message):
     """Быстрое добавление баллов: /addpoints телефон баллы"""
@@ -453,13 +531,15 @@ async def quick_add_points_command(message: Message):
     try:
         _, phone, points = message.text.split()
         points = int(points)
+        phone = normalize_phone(phone) or phone
         
-        session = Session()
+        session = async_session()
         try:
-            user = session.query(User).filter(User.phone == phone).first()
+            user = await session.scalar(select(User).where(User.phone == phone))
             if user:
                 user.points_manual += points
-                session.commit()
+                await session.commit()
+                user_cache.invalidate_user(user_id=user.id)
                 await message.answer(
                     f"✅ Добавлено {points} баллов пользователю {phone}\n"
                     f"📊 Теперь у него: {user.get_total_points()} баллов"
@@ -467,11 +547,406 @@ async def quick_add_points_command(message: Message):
             else:
                 await message.answer(f"❌ Пользователь с телефоном {phone} не найден")
         finally:
-            session.close()
+            await session.close()
             
     except ValueError:
         await message.answer("❌ Формат: /addpoints телефон баллы")
 
+# ========== ИМПОРТ КЛИЕНТОВ ==========
+
+IMPORT_HELP = (
+    "📥 *Импорт клиентов из CSV*\n\n"
+    "Отправьте файл .csv (до 20 МБ) с колонками:\n"
+    "`телефон;имя;фамилия;баллы`\n\n"
+    "• Строка заголовков необязательна, разделитель - `;` `,` или табуляция\n"
+    "• Новые номера будут созданы, существующим добавятся баллы\n"
+    "• Файл из Excel: «Сохранить как» → CSV"
+)
+
+def is_csv_document(message: Message) -> bool:
+    return (message.document.file_name or '').lower().endswith(('.csv', '.txt'))
+
+@router.message(Command("import"))
+async def import_command(message: Message, state: FSMContext):
+    """Массовый импорт клиентов: /import, затем файл"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    await message.answer(IMPORT_HELP, parse_mode="Markdown")
+    await state.set_state(AdminState.waiting_for_import_file)
+
+@router.callback_query(F.data == "admin_import")
+async def admin_import_handler(callback: CallbackQuery, state: FSMContext):
+    """📥 Импорт клиентов"""
+    await callback.message.edit_text(
+        IMPORT_HELP,
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="❌ Отмена", callback_data="admin_back_main")]
+        ])
+    )
+    await state.set_state(AdminState.waiting_for_import_file)
+    await callback.answer()
+
+@router.message(AdminState.waiting_for_import_file, F.document)
+async def process_import_file(message: Message, state: FSMContext, bot: Bot):
+    if not is_admin(message.from_user.id):
+        return
+    
+    if not is_csv_document(message):
+        await message.answer("❌ Нужен файл .csv. Из Excel: «Сохранить как» → CSV")
+        return
+    
+    await state.clear()
+    status = await message.answer("⏳ Импортирую...")
+    
+    buffer = await bot.download(message.document, destination=BytesIO())
+    result = await import_users(read_users_csv(buffer))
+    
+    text = (
+        f"✅ Импорт завершен\n\n"
+        f"🆕 Создано: {result['inserted']}\n"
+        f"🔄 Объединено с существующими: {result['merged']}\n"
+        f"🚫 Отклонено: {result['rejected']}"
+    )
+    if result['errors']:
+        text += "\n\nПримеры ошибок:\n" + "\n".join(result['errors'])
+    await status.edit_text(text)
+
+@router.message(AdminState.waiting_for_import_file)
+async def process_import_not_file(message: Message):
+    await message.answer("📎 Отправьте CSV-файл документом или /admin для выхода")
+
+# ========== НАЧИСЛЕНИЯ ПО ДНЯМ ==========
+
+CHART_PERIODS = (7, 30, 90)
+CHART_WIDTH = 12  # символов в самом длинном столбике
+
+def format_points_chart(rows, start, end) -> str:
+    """Текстовый график начислений по дням и итоги по типам"""
+    by_day = defaultdict(int)
+    by_type = defaultdict(int)
+    operations = 0
+    for row in rows:
+        by_day[row.date] += row.total
+        by_type[row.points_type or 'другое'] += row.total
+        operations += row.count
+    
+    days = [end - timedelta(days=i) for i in range((end - start).days + 1)]
+    peak = max([by_day[day.strftime('%Y-%m-%d')] for day in days] + [1])
+    lines = []
+    for day in days:
+        total = by_day[day.strftime('%Y-%m-%d')]
+        bar = '▇' * round(max(total, 0) / peak * CHART_WIDTH)
+        lines.append(f"{day:%d.%m} {bar:<{CHART_WIDTH}} {total}")
+    
+    text = "```\n" + "\n".join(lines) + "\n```\n"
+    text += f"💰 Итого: {sum(by_day.values())} баллов, начислений: {operations}\n"
+    if by_type:
+        text += "По типам: " + ", ".join(f"{name} {total}" for name, total in sorted(by_type.items()))
+    return text
+
+async def points_chart_text(days: int) -> str:
+    end = datetime.now().date()
+    start = end - timedelta(days=days - 1)
+    rows = await get_points_statistics(start, end)
+    return f"📈 *Начисления за {days} дн.*\n\n" + format_points_chart(rows, start, end)
+
+def points_chart_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"{days} дн.", callback_data=f"admin_points_chart_{days}") for days in CHART_PERIODS],
+        [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_points")]
+    ])
+
+@router.message(Command("pointsstats"))
+async def points_stats_command(message: Message):
+    """График начислений: /pointsstats [дней]"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    parts = message.text.split()
+    days = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 14
+    days = min(max(days, 1), 90)
+    await message.answer(await points_chart_text(days), parse_mode="Markdown", reply_markup=points_chart_keyboard())
+
+@router.callback_query(F.data.startswith("admin_points_chart_"))
+async def admin_points_chart_handler(callback: CallbackQuery):
+    """📈 Начисления по дням"""
+    days = int(callback.data.rsplit('_', 1)[1])
+    await callback.message.edit_text(
+        await points_chart_text(days),
+        parse_mode="Markdown",
+        reply_markup=points_chart_keyboard()
+    )
+    await callback.answer()
+
+# ========== СГОРАНИЕ БАЛЛОВ ==========
+
+@router.message(Command("expirepoints"))
+async def expire_points_command(message: Message):
+    """Списать баллы старше POINTS_EXPIRY_DAYS сейчас, не дожидаясь ночного запуска"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    # Задача планировщика points_expiry: первый запуск по большой истории
+    # долгий, обработчик апдейта его не ждет
+    if scheduler.trigger('points_expiry'):
+        status = "⏳ Списание запущено в фоне, результат - /jobs"
+    else:
+        status = "⏳ Списание уже выполняется, результат - /jobs"
+    await message.answer(f"🔥 Сгорание баллов старше {POINTS_EXPIRY_DAYS} дней\n\n{status}")
+
+# ========== ВЫГРУЗКА ==========
+
+@router.message(Command("export"))
+async def export_command(message: Message, bot: Bot):
+    """Выгрузка таблицы в CSV: /export users|history|referrals|tickets [gz]"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    parts = message.text.split()
+    name = parts[1].lower() if len(parts) > 1 else None
+    if name not in EXPORT_TABLES:
+        await message.answer(
+            "📤 Формат: /export таблица [gz]\n\n"
+            f"Таблицы: {', '.join(EXPORT_TABLES)}\n"
+            "gz - сжать файл (для больших выгрузок)"
+        )
+        return
+    compress = len(parts) > 2 and parts[2].lower() in ('gz', 'gzip')
+    
+    async with ChatActionSender.upload_document(bot=bot, chat_id=message.chat.id):
+        path, rows = await export_table(name, compress)
+        try:
+            filename = f"{name}_{datetime.now():%Y%m%d_%H%M}.csv" + ('.gz' if compress else '')
+            await message.answer_document(
+                FSInputFile(path, filename=filename),
+                caption=f"📤 {name}: {rows} строк"
+            )
+        finally:
+            os.remove(path)
+
+# ========== РАССЫЛКА ==========
+
+BROADCAST_HELP = (
+    "📢 *Новая рассылка*\n\n"
+    "Отправьте текст сообщения - его получат все клиенты, открывавшие бота.\n"
+    "Жирный, курсив и ссылки сохранятся."
+)
+
+def broadcast_keyboard(broadcast) -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(text="🔄 Обновить", callback_data=f"admin_broadcast_status_{broadcast.id}")]]
+    if broadcast.status == 'running':
+        rows.append([InlineKeyboardButton(text="⏸ Пауза", callback_data=f"admin_broadcast_pause_{broadcast.id}")])
+    if broadcast.status == 'paused':
+        rows.append([InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"admin_broadcast_resume_{broadcast.id}")])
+    if broadcast.status in ('running', 'paused'):
+        rows.append([InlineKeyboardButton(text="⛔ Отменить", callback_data=f"admin_broadcast_cancel_{broadcast.id}")])
+    rows.append([InlineKeyboardButton(text="🔙 Назад", callback_data="admin_broadcast")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+@router.callback_query(F.data == "admin_broadcast")
+async def admin_broadcast_handler(callback: CallbackQuery, state: FSMContext):
+    """📢 Рассылка: последние рассылки и новая"""
+    await state.clear()
+    recent = await get_recent_broadcasts()
+    
+    text = "📢 *Рассылки*\n\n"
+    text += "\n".join(
+        f"#{b.id} {b.created_at:%d.%m %H:%M} - {b.status}, доставлено {b.sent}" for b in recent
+    ) if recent else "Рассылок еще не было"
+    
+    buttons = [[InlineKeyboardButton(text="✉️ Новая рассылка", callback_data="admin_broadcast_new")]]
+    buttons += [
+        [InlineKeyboardButton(text=f"📊 #{b.id}", callback_data=f"admin_broadcast_status_{b.id}")] for b in recent
+    ]
+    buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back_main")])
+    await callback.message.edit_text(text, parse_mode="Markdown", reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+    await callback.answer()
+
+@router.message(Command("broadcast"))
+async def broadcast_command(message: Message, state: FSMContext):
+    """Рассылка всем клиентам: /broadcast, затем текст"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    await state.clear()
+    await message.answer(BROADCAST_HELP, parse_mode="Markdown")
+    await state.set_state(AdminState.waiting_for_broadcast_text)
+
+@router.callback_query(F.data == "admin_broadcast_new")
+async def admin_broadcast_new_handler(callback: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+    segment = data.get('segment')
+    await callback.message.edit_text(
+        BROADCAST_HELP + (f"\n\n🎯 Получатели: сегмент `{segment}`" if segment else ""),
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="❌ Отмена", callback_data="admin_broadcast")]
+        ])
+    )
+    await state.set_state(AdminState.waiting_for_broadcast_text)
+    await callback.answer()
+
+@router.message(AdminState.waiting_for_broadcast_text, F.text)
+async def process_broadcast_text(message: Message, state: FSMContext):
+    if not is_admin(message.from_user.id):
+        return
+    
+    await state.update_data(broadcast_text=message.html_text)
+    data = await state.get_data()
+    await message.answer(message.html_text, parse_mode="HTML")
+    await message.answer(
+        "👆 Так сообщение увидят клиенты. " +
+        (f"Отправить сегменту «{data['segment']}»?" if data.get('segment') else "Отправить всем?"),
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="✅ Отправить", callback_data="admin_broadcast_confirm")],
+            [InlineKeyboardButton(text="✏️ Изменить текст", callback_data="admin_broadcast_new")],
+            [InlineKeyboardButton(text="❌ Отмена", callback_data="admin_broadcast")]
+        ])
+    )
+
+@router.callback_query(F.data == "admin_broadcast_confirm", AdminState.waiting_for_broadcast_text)
+async def admin_broadcast_confirm_handler(callback: CallbackQuery, state: FSMContext, bot: Bot):
+    if not is_admin(callback.from_user.id):
+        return
+    
+    data = await state.get_data()
+    await state.clear()
+    broadcast_id = await create_broadcast(data['broadcast_text'], callback.from_user.id, data.get('segment'))
+    start_broadcast(bot, broadcast_id)
+    logger.info(f"Админ {callback.from_user.id} запустил рассылку {broadcast_id}")
+    
+    broadcast = await get_broadcast(broadcast_id)
+    await callback.message.edit_text(format_broadcast(broadcast), reply_markup=broadcast_keyboard(broadcast))
+    await callback.answer("Рассылка запущена")
+
+@router.callback_query(F.data.regexp(r"^admin_broadcast_(status|pause|resume|cancel)_\d+$"))
+async def admin_broadcast_action_handler(callback: CallbackQuery, bot: Bot):
+    """Статус, пауза, продолжение и отмена рассылки"""
+    if not is_admin(callback.from_user.id):
+        return
+    
+    action, broadcast_id = callback.data.removeprefix("admin_broadcast_").rsplit('_', 1)
+    broadcast_id = int(broadcast_id)
+    if action == 'pause':
+        await set_broadcast_status(broadcast_id, 'paused')
+    elif action == 'resume':
+        if await set_broadcast_status(broadcast_id, 'running'):
+            start_broadcast(bot, broadcast_id)
+    elif action == 'cancel':
+        await set_broadcast_status(broadcast_id, 'cancelled')
+    
+    broadcast = await get_broadcast(broadcast_id)
+    if broadcast is None:
+        await callback.answer("Рассылка не найдена", show_alert=True)
+        return
+    try:
+        await callback.message.edit_text(format_broadcast(broadcast), reply_markup=broadcast_keyboard(broadcast))
+    except TelegramBadRequest:
+        pass  # message is not modified - ничего не изменилось с прошлого обновления
+    await callback.answer()
+
+# ========== СЕГМЕНТЫ ==========
+
+@router.message(Command("segment"))
+async def segment_command(message: Message, state: FSMContext):
+    """Выборка клиентов по условиям: /segment points>1000 inactive=90"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    spec = message.text.partition(' ')[2].strip()
+    if not spec:
+        await message.answer(SEGMENT_HELP)
+        return
+    
+    try:
+        total = await count_segment(spec)
+        sample = await sample_segment(spec)
+    except ValueError as e:
+        await message.answer(f"❌ {e}\n\n{SEGMENT_HELP}")
+        return
+    
+    text = f"🎯 Сегмент: {spec}\n👥 Пользователей: {total}\n"
+    if sample:
+        text += "\nПоследние добавленные:\n"
+    for user in sample:
+        name_display = f"{user.first_name or ''} {user.last_name or ''}".strip() or "Без имени"
+        text += f"🆔 {user.id} - {name_display} - 📱 {user.phone or 'нет'} - ⭐ {user.get_total_points()}\n"
+    
+    # Сегмент запоминаем для кнопки рассылки: в callback_data он может не поместиться
+    await state.clear()
+    await state.update_data(segment=spec)
+    await message.answer(
+        text,
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="📢 Рассылка по сегменту", callback_data="admin_broadcast_new")]
+        ]) if total else None
+    )
+
+# ========== КЭШБЭК ЗА ЗАКАЗЫ ==========
+
+CASHBACK_HELP = (
+    f"🛍️ *Кэшбэк {CASHBACK_PERCENT}% за заказы*\n\n"
+    "Отправьте выгрузку заказов .csv с колонками:\n"
+    "`телефон;сумма;номер заказа`\n\n"
+    "• Кэшбэк за каждый заказ начисляется один раз - файл можно загружать повторно\n"
+    "• Клиенты, которых нет в базе, пропускаются"
+)
+
+@router.message(Command("cashback"))
+async def cashback_command(message: Message, state: FSMContext):
+    """Начисление кэшбэка по выгрузке заказов: /cashback, затем файл"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    await message.answer(CASHBACK_HELP, parse_mode="Markdown")
+    await state.set_state(AdminState.waiting_for_cashback_file)
+
+@router.callback_query(F.data == "admin_cashback")
+async def admin_cashback_handler(callback: CallbackQuery, state: FSMContext):
+    """🛍️ Кэшбэк за заказы"""
+    await callback.message.edit_text(
+        CASHBACK_HELP,
+        parse_mode="Markdown",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="❌ Отмена", callback_data="admin_back_main")]
+        ])
+    )
+    await state.set_state(AdminState.waiting_for_cashback_file)
+    await callback.answer()
+
+@router.message(AdminState.waiting_for_cashback_file, F.document)
+async def process_cashback_file(message: Message, state: FSMContext, bot: Bot):
+    if not is_admin(message.from_user.id):
+        return
+    
+    if not is_csv_document(message):
+        await message.answer("❌ Нужен файл .csv. Из Excel: «Сохранить как» → CSV")
+        return
+    
+    await state.clear()
+    status = await message.answer("⏳ Начисляю кэшбэк...")
+    
+    buffer = await bot.download(message.document, destination=BytesIO())
+    result = await accrue_cashback(read_orders_csv(buffer))
+    
+    text = (
+        f"✅ Кэшбэк начислен\n\n"
+        f"🛍️ Заказов: {result['accrued']}\n"
+        f"⭐ Баллов: {result['points']}\n"
+        f"🔁 Уже начислены ранее: {result['duplicates']}\n"
+        f"❓ Клиент не найден: {result['unknown']}\n"
+        f"🚫 Отклонено: {result['rejected']}"
+    )
+    if result['errors']:
+        text += "\n\nПримеры ошибок:\n" + "\n".join(result['errors'])
+    await status.edit_text(text)
+
+@router.message(AdminState.waiting_for_cashback_file)
+async def process_cashback_not_file(message: Message):
+    await message.answer("📎 Отправьте CSV-файл документом или /admin для выхода")
+
 @router.callback_query(F.data == "admin_add_user_full")
 async def admin_add_user_full_handler(callback: CallbackQuery, state: FSMContext):
     """Полный режим добавления пользователя"""
@@ -539,7 +1014,7 @@ async def process_add_user_points_full(message: Message, state: FSMContext):
         first_name = data.get('first_name')
         
         # Добавляем пользователя
-        success, result_msg, user_data = add_user_with_details(
+        success, result_msg, user_data = await add_user_with_details(
             phone=phone,
             points=points,
             first_name=first_name
@@ -583,14 +1058,14 @@ async def add_user_command(message: Message, state: FSMContext):
         if len(parts) == 2:
             # Только телефон
             phone = parts[1]
-            result = quick_add_user(phone, 0)
+            result = await quick_add_user(phone, 0)
             await message.answer(result)
             
         elif len(parts) == 3:
             # Телефон + баллы
             phone = parts[1]
             points = int(parts[2])
-            result = quick_add_user(phone, points)
+            result = await quick_add_user(phone, points)
             await message.answer(result)
             
         else:
@@ -634,7 +1109,7 @@ async def skip_points_handler(callback: CallbackQuery, state: FSMContext):
     phone = data.get('phone')
     
     # Добавляем пользователя без баллов
-    result = quick_add_user(phone, 0)
+    result = await quick_add_user(phone, 0)
     
     await callback.message.edit_text(result)
     await state.clear()
@@ -649,7 +1124,7 @@ async def process_add_user_points(message: Message, state: FSMContext):
         phone = data.get('phone')
         
         # Добавляем пользователя
-        result = quick_add_user(phone, points)
+        result = await quick_add_user(phone, points)
         
         await message.answer(result)
         await state.clear()
@@ -676,12 +1151,12 @@ async def points_history_command(message: Message):
     """Показать историю начисления баллов: /history"""
     from requests import get_points_history, get_user_by_tg_id
     
-    user = get_user_by_tg_id(message.from_user.id)
+    user = await get_user_by_tg_id(message.from_user.id)
     if not user:
         await message.answer("❌ Пользователь не найден")
         return
     
-    history = get_points_history(user.id, limit=10)
+    history = await get_points_history(user.id, limit=10)
     
     if not history:
         await message.answer("📭 У вас еще нет истории начисления баллов")
@@ -695,7 +1170,8 @@ async def points_history_command(message: Message):
             'manual': '🖊️',
             'referral': '👥',
             'welcome': '🎁',
-            'admin': '👑'
+            'admin': '👑',
+            'cashback': '🛍️'
         }.get(record.points_type, '💰')
         
         text += f"{type_emoji} *{date}*\n"
@@ -706,7 +1182,7 @@ async def points_history_command(message: Message):
     
     # Добавляем итоги
     from requests import get_user_points_summary
-    summary = get_user_points_summary(user.id)
+    summary = await get_user_points_summary(user.id)
     
     if summary:
         text += f"💰 *Итого:* {summary['total_points']} баллов\n"
@@ -728,42 +1204,33 @@ async def user_history_command(message: Message):
     try:
         phone = message.text.split()[1]
         
-        session = Session()
-        try:
-            user = session.query(User).filter(User.phone == phone).first()
-            if not user:
-                await message.answer("❌ Пользователь не найден")
-                return
-            
-            history = session.query(PointsHistory)\
-                .filter(PointsHistory.user_id == user.id)\
-                .order_by(PointsHistory.created_at.desc())\
-                .limit(20)\
-                .all()
-            
-            if not history:
-                await message.answer(f"📭 У пользователя {phone} нет истории баллов")
-                return
-            
-            text = f"📊 *История баллов пользователя {phone}:*\n\n"
-            
-            total_added = 0
-            for record in history:
-                date = record.created_at.strftime("%d.%m.%Y")
-                total_added += record.points_amount
-                
-                text += f"• {date}: {record.points_amount} баллов"
-                if record.description:
-                    text += f" ({record.description})"
-                text += "\n"
-            
-            text += f"\n💰 Всего начислено: {total_added} баллов"
-            text += f"\n📊 Текущий баланс: {user.get_total_points()} баллов"
-            
-            await message.answer(text, parse_mode="Markdown")
+        user = await get_user_by_phone(phone)
+        if not user:
+            await message.answer("❌ Пользователь не найден")
+            return
+        
+        history = await get_points_history(user.id, limit=20)
+        
+        if not history:
+            await message.answer(f"📭 У пользователя {phone} нет истории баллов")
+            return
+        
+        text = f"📊 *История баллов пользователя {phone}:*\n\n"
+        
+        total_added = 0
+        for record in history:
+            date = record.created_at.strftime("%d.%m.%Y")
+            total_added += record.points_amount
             
-        finally:
-            session.close()
+            text += f"• {date}: {record.points_amount} баллов"
+            if record.description:
+                text += f" ({record.description})"
+            text += "\n"
+        
+        text += f"\n💰 Всего начислено: {total_added} баллов"
+        text += f"\n📊 Текущий баланс: {user.get_total_points()} баллов"
+        
+        await message.answer(text, parse_mode="Markdown")
             
     except IndexError:
         await message.answer("❌ Формат: /userhistory телефон")
\ No newline at end of file
@@ -0,0 +1,102 @@
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from config import BACKUP_DIR, BACKUP_PAGES, BACKUP_PAUSE, BACKUP_KEEP, BACKUP_MAX_AGE_DAYS
+from models import connect_sqlite
+
+logger = logging.getLogger(__name__)
+
+BACKUP_PREFIX = 'backup_'
+BACKUP_SUFFIX = '.db.gz'
+
+
+def create_backup(backup_dir: str = BACKUP_DIR, pages: int = BACKUP_PAGES, pause: float = BACKUP_PAUSE) -> dict:
+    """
+    Резервная копия базы (синхронно - вызывать в потоке: планировщик, to_thread).
+    Копирует через SQLite backup API порциями по pages страниц с паузой pause
+    секунд между ними, чтобы не занимать диск и блокировку надолго.
+    На время копии на источнике открыта читающая транзакция: в WAL она не
+    мешает боту писать, а копия остается согласованным снимком и не
+    начинается заново от каждой записи.
+    Результат сжимается gzip, старые копии удаляются (rotate_backups).
+    Возвращает path, size, db_size (байт), seconds, removed
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    started = time.perf_counter()
+    path = os.path.join(backup_dir, f"{BACKUP_PREFIX}{datetime.now():%Y%m%d_%H%M%S}{BACKUP_SUFFIX}")
+    raw_path = path.removesuffix('.gz') + '.part'
+    packed_path = path + '.part'
+
+    source = connect_sqlite()
+    try:
+        target = sqlite3.connect(raw_path)
+        try:
+            source.execute("BEGIN")
+            source.execute("SELECT count(*) FROM sqlite_master").fetchone()
+            source.backup(target, pages=pages, progress=lambda status, remaining, total: time.sleep(pause))
+        finally:
+            target.close()
+            source.rollback()
+
+        with open(raw_path, 'rb') as raw, gzip.open(packed_path, 'wb', compresslevel=6) as packed:
+            shutil.copyfileobj(raw, packed, 1024 * 1024)
+        db_size = os.path.getsize(raw_path)
+        # Переименование - последним шагом: в каталоге не бывает недописанных копий
+        os.replace(packed_path, path)
+    finally:
+        source.close()
+        for leftover in (raw_path, packed_path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    removed = rotate_backups(backup_dir)
+    result = {
+        'path': path,
+        'size': os.path.getsize(path),
+        'db_size': db_size,
+        'seconds': time.perf_counter() - started,
+        'removed': removed,
+    }
+    logger.info(
+        f"Резервная копия {path}: {result['db_size'] / 2**20:.1f} МБ -> {result['size'] / 2**20:.1f} МБ "
+        f"за {result['seconds']:.1f} с, удалено старых: {removed}"
+    )
+    return result
+
+def list_backups(backup_dir: str = BACKUP_DIR) -> list[str]:
+    """Копии от новых к старым (время создания - в имени файла)"""
+    if not os.path.isdir(backup_dir):
+        return []
+    names = [
+        name for name in os.listdir(backup_dir)
+        if name.startswith(BACKUP_PREFIX) and name.endswith(BACKUP_SUFFIX)
+    ]
+    return [os.path.join(backup_dir, name) for name in sorted(names, reverse=True)]
+
+def rotate_backups(backup_dir: str = BACKUP_DIR, keep: int = BACKUP_KEEP,
+                   max_age_days: int = BACKUP_MAX_AGE_DAYS) -> int:
+    """
+    Оставляет не больше keep последних копий и удаляет копии старше
+    max_age_days дней. Самая свежая копия не удаляется никогда.
+    Возвращает число удаленных файлов
+    """
+    expires_before = time.time() - timedelta(days=max_age_days).total_seconds()
+    removed = 0
+    for number, path in enumerate(list_backups(backup_dir)):
+        if number == 0:
+            continue
+        if number >= keep or os.path.getmtime(path) < expires_before:
+            os.remove(path)
+            removed += 1
+    return removed
+
+def format_backup_result(result: dict) -> str:
+    return (
+        f"{os.path.basename(result['path'])}: {result['db_size'] / 2**20:.1f} МБ -> "
+        f"{result['size'] / 2**20:.1f} МБ за {result['seconds']:.1f} с"
+    )
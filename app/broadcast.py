@@ -0,0 +1,284 @@
+import asyncio
+import logging
+import time
+from contextlib import aclosing
+from itertools import takewhile
+from datetime import datetime
+
+from aiogram import Bot
+from aiogram.exceptions import (TelegramRetryAfter, TelegramForbiddenError, TelegramNetworkError,
+                                TelegramServerError, TelegramAPIError)
+from sqlalchemy import select, insert, update
+
+from config import BROADCAST_RATE, BROADCAST_BATCH_SIZE, BROADCAST_MAX_RETRIES, BROADCAST_SHUTDOWN_TIMEOUT
+from models import async_engine, User, Broadcast
+from app.segments import count_segment, iter_segment
+
+logger = logging.getLogger(__name__)
+
+broadcasts = Broadcast.__table__
+users = User.__table__
+
+# Статусы, из которых рассылку можно перевести в другой
+ACTIVE_STATUSES = ('running', 'paused')
+
+
+class TokenBucket:
+    """
+    Ограничитель скорости на весь бот: rate токенов в секунду, запас не больше
+    capacity. Ответ 429 от Telegram останавливает выдачу токенов всем отправителям
+    на retry_after секунд и снижает rate - раз лимит превышен, шлем медленнее.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self.rate = max(self.rate * 0.8, 1)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+        self.updated = self.blocked_until
+
+    async def acquire(self):
+        # Под замком: ожидающие получают токены по очереди, без гонки за пополнение
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+async def deliver(bot: Bot, bucket: TokenBucket, chat_id: int, text: str, attempted: set = None) -> str:
+    """
+    Отправка одного сообщения рассылки: 'sent', 'blocked' или 'failed'.
+    Каждому чату уходит одно сообщение, а повтор в тот же чат бывает только
+    после паузы не меньше секунды - лимит 1 сообщение/с на чат соблюдается сам.
+    В attempted добавляется chat_id перед первой попыткой.
+    """
+    retries = 0
+    while True:
+        await bucket.acquire()
+        if attempted is not None:
+            attempted.add(chat_id)
+        try:
+            await bot.send_message(chat_id, text, parse_mode="HTML")
+            return 'sent'
+        except TelegramRetryAfter as e:
+            logger.warning(f"Рассылка: флуд-контроль, пауза {e.retry_after} с")
+            bucket.pause(e.retry_after)
+        except TelegramForbiddenError:
+            return 'blocked'
+        except (TelegramNetworkError, TelegramServerError) as e:
+            retries += 1
+            if retries > BROADCAST_MAX_RETRIES:
+                logger.warning(f"Рассылка: чат {chat_id} недоступен: {e}")
+                return 'failed'
+            await asyncio.sleep(2 ** retries)
+        except TelegramAPIError as e:
+            # chat not found, user is deactivated и прочие 400 - повтор не поможет
+            logger.info(f"Рассылка: чат {chat_id}: {e}")
+            return 'failed'
+
+
+# ========== ХРАНЕНИЕ ==========
+
+def _recipients_segment(segment: str | None) -> str:
+    """Сообщение можно отправить только тем, кто открывал бота"""
+    return f"tg=yes {segment or ''}"
+
+async def create_broadcast(text: str, created_by: int = None, segment: str = None) -> int:
+    """Новая рассылка пользователям с tg_id (из сегмента, если задан), возвращает ее id"""
+    total = await count_segment(_recipients_segment(segment))
+    async with async_engine.begin() as conn:
+        result = await conn.execute(insert(broadcasts).values(
+            text=text, segment=segment or None, status='running', created_by=created_by,
+            total=total, created_at=datetime.now()
+        ))
+        return result.inserted_primary_key[0]
+
+async def get_broadcast(broadcast_id: int):
+    async with async_engine.connect() as conn:
+        return (await conn.execute(select(broadcasts).where(broadcasts.c.id == broadcast_id))).first()
+
+async def get_recent_broadcasts(limit: int = 5) -> list:
+    async with async_engine.connect() as conn:
+        return (await conn.execute(select(broadcasts).order_by(broadcasts.c.id.desc()).limit(limit))).all()
+
+async def set_broadcast_status(broadcast_id: int, status: str) -> bool:
+    """Пауза/продолжение/отмена; завершенную рассылку не трогает"""
+    values = {'status': status}
+    if status == 'cancelled':
+        values['finished_at'] = datetime.now()
+    async with async_engine.begin() as conn:
+        result = await conn.execute(
+            update(broadcasts)
+            .where(broadcasts.c.id == broadcast_id, broadcasts.c.status.in_(ACTIVE_STATUSES))
+            .values(**values)
+        )
+        return result.rowcount > 0
+
+async def _save_progress(broadcast_id: int, last_user_id: int, counts: dict, elapsed: float, done: bool) -> str:
+    """Сдвигает курсор и счетчики, возвращает текущий статус (админ мог поставить паузу)"""
+    values = {
+        'last_user_id': last_user_id,
+        'sent': broadcasts.c.sent + counts['sent'],
+        'blocked': broadcasts.c.blocked + counts['blocked'],
+        'failed': broadcasts.c.failed + counts['failed'],
+        'elapsed': broadcasts.c.elapsed + elapsed,
+    }
+    async with async_engine.begin() as conn:
+        await conn.execute(update(broadcasts).where(broadcasts.c.id == broadcast_id).values(**values))
+        if done:
+            await conn.execute(
+                update(broadcasts)
+                .where(broadcasts.c.id == broadcast_id, broadcasts.c.status == 'running')
+                .values(status='done', finished_at=datetime.now())
+            )
+        return await conn.scalar(select(broadcasts.c.status).where(broadcasts.c.id == broadcast_id))
+
+
+# ========== ЗАПУСК ==========
+
+# id рассылки -> задача; одна задача на рассылку в процессе
+_tasks: dict[int, asyncio.Task] = {}
+_stopping = asyncio.Event()
+# Один лимит на все рассылки: параллельные рассылки делят BROADCAST_RATE, 429 тормозит всех
+_bucket = TokenBucket(BROADCAST_RATE)
+
+
+async def _run_broadcast(bot: Bot, broadcast_id: int):
+    broadcast = await get_broadcast(broadcast_id)
+    cursor = broadcast.last_user_id
+    status = broadcast.status
+    logger.info(f"Рассылка {broadcast_id}: старт с users.id > {cursor}")
+
+    recipients_batches = iter_segment(
+        _recipients_segment(broadcast.segment), (users.c.id, users.c.tg_id),
+        after_id=cursor, batch_size=BROADCAST_BATCH_SIZE
+    )
+    async with aclosing(recipients_batches) as batches:
+        # Курсор всегда указывает на получателя, до которого включительно
+        # сообщения уже ушли: после перезапуска никто не получит его дважды
+        while status == 'running' and not _stopping.is_set():
+            recipients = await anext(batches, [])
+            started = time.perf_counter()
+            attempted = set()
+            sends = [
+                asyncio.ensure_future(deliver(bot, _bucket, tg_id, broadcast.text, attempted))
+                for _, tg_id in recipients
+            ]
+            try:
+                await _wait_batch(sends, recipients, attempted)
+            except asyncio.CancelledError:
+                # Остановка не дождалась даже начатых отправок - сохраняем, что успели
+                for send in sends:
+                    send.cancel()
+                await _save_batch(broadcast_id, cursor, recipients, sends, started)
+                raise
+            cursor, status = await _save_batch(broadcast_id, cursor, recipients, sends, started)
+
+    logger.info(f"Рассылка {broadcast_id}: {status}")
+
+async def _wait_batch(sends: list, recipients: list, attempted: set):
+    """
+    Ждет пачку целиком, а при остановке бота отменяет еще не начатые отправки
+    и дожидается начатых (в том числе ждущих повтора после 429).
+    Первые попытки идут в порядке получателей, так что отмененные - хвост пачки.
+    """
+    batch = asyncio.gather(*sends, return_exceptions=True)
+    stopping = asyncio.ensure_future(_stopping.wait())
+    try:
+        await asyncio.wait([batch, stopping], return_when=asyncio.FIRST_COMPLETED)
+        if not batch.done():
+            for send, recipient in zip(sends, recipients):
+                if recipient.tg_id not in attempted:
+                    send.cancel()
+            await batch
+    finally:
+        stopping.cancel()
+
+async def _save_batch(broadcast_id: int, cursor: int, recipients: list, sends: list,
+                      started: float) -> tuple[int, str]:
+    """Сохраняет результат завершенного без пропусков начала пачки, возвращает (курсор, статус)"""
+    finished = takewhile(lambda send: send.done() and not send.cancelled(), sends)
+    results = [send.result() for send in finished]
+    counts = {key: results.count(key) for key in ('sent', 'blocked', 'failed')}
+    if results:
+        cursor = recipients[len(results) - 1].id
+    status = await _save_progress(
+        broadcast_id, cursor, counts, time.perf_counter() - started,
+        done=len(recipients) < BROADCAST_BATCH_SIZE and len(results) == len(recipients)
+    )
+    return cursor, status
+
+def start_broadcast(bot: Bot, broadcast_id: int) -> bool:
+    """Запустить отправку в фоне; False - уже идет"""
+    task = _tasks.get(broadcast_id)
+    if task is not None and not task.done():
+        return False
+    if all(running.done() for running in _tasks.values()):
+        # Других рассылок нет - снижение скорости после прошлых 429 больше не действует
+        _bucket.rate = BROADCAST_RATE
+    _stopping.clear()
+    task = asyncio.create_task(_run_broadcast(bot, broadcast_id))
+    task.add_done_callback(_log_task_error)
+    _tasks[broadcast_id] = task
+    return True
+
+def _log_task_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        logger.error("Рассылка упала", exc_info=task.exception())
+
+async def resume_broadcasts(bot: Bot):
+    """При старте бота: продолжить рассылки, прерванные остановкой"""
+    async with async_engine.connect() as conn:
+        ids = (await conn.execute(select(broadcasts.c.id).where(broadcasts.c.status == 'running'))).scalars().all()
+    for broadcast_id in ids:
+        start_broadcast(bot, broadcast_id)
+
+async def stop_broadcasts():
+    """При остановке бота: дослать текущие пачки и сохранить прогресс"""
+    _stopping.set()
+    tasks = [task for task in _tasks.values() if not task.done()]
+    if not tasks:
+        return
+    logger.info(f"Ожидаем сохранения {len(tasks)} рассылок")
+    _, pending = await asyncio.wait(tasks, timeout=BROADCAST_SHUTDOWN_TIMEOUT)
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.wait(pending)
+
+
+def format_broadcast(broadcast) -> str:
+    """Прогресс рассылки для админки"""
+    processed = broadcast.sent + broadcast.blocked + broadcast.failed
+    rate = processed / broadcast.elapsed if broadcast.elapsed else 0
+    status = {
+        'running': '▶️ идет', 'paused': '⏸ пауза', 'done': '✅ завершена', 'cancelled': '⛔ отменена'
+    }.get(broadcast.status, broadcast.status)
+
+    text = (
+        f"📢 Рассылка #{broadcast.id} от {broadcast.created_at:%d.%m %H:%M} - {status}\n"
+        f"🎯 Сегмент: {broadcast.segment or 'все'}\n"
+        f"Обработано: {processed} из ~{broadcast.total}\n"
+        f"✅ Доставлено: {broadcast.sent}\n"
+        f"🚫 Заблокировали бота: {broadcast.blocked}\n"
+        f"❌ Ошибок: {broadcast.failed}\n"
+        f"⚡ Скорость: {rate:.1f} сообщ/с"
+    )
+    if broadcast.status == 'running' and rate:
+        text += f"\n⏳ Осталось: ~{max(broadcast.total - processed, 0) / rate / 60:.0f} мин"
+    return text
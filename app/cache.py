@@ -0,0 +1,102 @@
+import time
+from collections import OrderedDict
+
+from config import USER_CACHE_SIZE, USER_CACHE_TTL, STATS_CACHE_TTL
+
+
+class TTLCache:
+    """LRU-кэш в памяти процесса с ограничением времени жизни записей"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        # Растет при каждой инвалидации: значение, прочитанное из БД до
+        # инвалидации, уже не попадет в кэш (см. set(..., generation=))
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, generation: int = None):
+        """Сохранить значение; generation - значение self.generation на момент чтения из БД"""
+        if generation is not None and generation != self.generation:
+            return
+
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        self._on_set(key, value)
+
+        while len(self._data) > self.maxsize:
+            oldest = next(iter(self._data))
+            self._remove(oldest)
+
+    def invalidate(self, key):
+        self.generation += 1
+        self._remove(key)
+
+    def clear(self):
+        self.generation += 1
+        self._data.clear()
+
+    def _remove(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self._on_remove(key, item[1])
+
+    def _on_set(self, key, value):
+        pass
+
+    def _on_remove(self, key, value):
+        pass
+
+    def __len__(self):
+        return len(self._data)
+
+
+class UserProfileCache(TTLCache):
+    """Снимки профилей пользователей (как get_user_data) по tg_id"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        super().__init__(maxsize, ttl)
+        self._tg_by_user_id = {}
+
+    def invalidate_user(self, tg_id: int = None, user_id: int = None):
+        """Сбросить профиль по tg_id и/или id в базе"""
+        self.generation += 1
+        if user_id is not None:
+            tg_id_by_user = self._tg_by_user_id.get(user_id)
+            if tg_id_by_user is not None:
+                self._remove(tg_id_by_user)
+        if tg_id is not None:
+            self._remove(tg_id)
+
+    def clear(self):
+        super().clear()
+        self._tg_by_user_id.clear()
+
+    def _on_set(self, key, value):
+        self._tg_by_user_id[value['id']] = key
+
+    def _on_remove(self, key, value):
+        self._tg_by_user_id.pop(value['id'], None)
+
+
+user_cache = UserProfileCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+# Агрегаты для админки: несколько ключей, устаревают не позже STATS_CACHE_TTL
+stats_cache = TTLCache(16, STATS_CACHE_TTL)
@@ -0,0 +1,95 @@
+import codecs
+import csv
+from typing import BinaryIO, Iterator
+
+# Заголовки колонок, которые понимает импорт (в нижнем регистре)
+USER_COLUMNS = {
+    'phone': ('phone', 'телефон', 'номер', 'номер телефона'),
+    'first_name': ('first_name', 'name', 'имя'),
+    'last_name': ('last_name', 'surname', 'фамилия'),
+    'points': ('points', 'баллы', 'бонусы'),
+}
+ORDER_COLUMNS = {
+    'phone': USER_COLUMNS['phone'],
+    'order_total': ('order_total', 'total', 'sum', 'amount', 'сумма', 'сумма заказа'),
+    'order_id': ('order_id', 'order', 'id', 'заказ', 'номер заказа'),
+}
+
+
+def _detect_encoding(sample: bytes) -> str:
+    try:
+        sample.decode('utf-8')
+        return 'utf-8-sig'
+    except UnicodeDecodeError as e:
+        # Обрезанный на границе образца многобайтный символ - это все еще utf-8
+        if e.start >= len(sample) - 3:
+            return 'utf-8-sig'
+        return 'cp1251'  # Excel в русской локали
+
+
+def _detect_delimiter(text_sample: str) -> str:
+    """
+    Разделитель по первой непустой строке: ';', затем tab, затем ','.
+    Не csv.Sniffer: в "89991234567;1234,50;A1" он выбирает запятую из суммы
+    """
+    first_line = next((line for line in text_sample.splitlines() if line.strip()), '')
+    for delimiter in (';', '\t'):
+        if delimiter in first_line:
+            return delimiter
+    return ','
+
+
+def _header_columns(row: list, known_columns: dict) -> dict:
+    """Индексы известных колонок, если строка - заголовок с колонкой телефона"""
+    header = [cell.strip().lower() for cell in row]
+    columns = {}
+    for field, names in known_columns.items():
+        for index, cell in enumerate(header):
+            if cell in names:
+                columns[field] = index
+                break
+    return columns if 'phone' in columns else {}
+
+
+def read_csv_records(stream: BinaryIO, known_columns: dict) -> Iterator[dict]:
+    """
+    Потоково читает CSV-выгрузку. Кодировка (utf-8/cp1251) и разделитель
+    (',', ';', tab) определяются по началу файла, строка заголовков
+    необязательна: без нее колонки идут в порядке known_columns.
+    Отдает словари с номером строки line и полями из known_columns.
+    """
+    sample = stream.read(64 * 1024)
+    stream.seek(0)
+    encoding = _detect_encoding(sample)
+    delimiter = _detect_delimiter(sample.decode(encoding, errors='ignore'))
+
+    reader = csv.reader(codecs.getreader(encoding)(stream, errors='replace'), delimiter=delimiter)
+    columns = None
+    for row in reader:
+        if not any(cell.strip() for cell in row):
+            continue
+
+        if columns is None:
+            columns = _header_columns(row, known_columns)
+            if columns:
+                continue
+            columns = {field: index for index, field in enumerate(known_columns)}
+            # Незнакомый заголовок (в первой ячейке нет цифр) - пропускаем
+            if not any(char.isdigit() for char in row[0]):
+                continue
+
+        record = {'line': reader.line_num}
+        for field in known_columns:
+            index = columns.get(field)
+            record[field] = row[index] if index is not None and index < len(row) else None
+        yield record
+
+
+def read_users_csv(stream: BinaryIO) -> Iterator[dict]:
+    """Клиенты: телефон, имя, фамилия, баллы"""
+    return read_csv_records(stream, USER_COLUMNS)
+
+
+def read_orders_csv(stream: BinaryIO) -> Iterator[dict]:
+    """Заказы для кэшбэка: телефон, сумма заказа, номер заказа"""
+    return read_csv_records(stream, ORDER_COLUMNS)
@@ -0,0 +1,51 @@
+import csv
+import gzip
+import os
+import tempfile
+
+from sqlalchemy import select
+
+from models import async_engine, User, PointsHistory, Referral, SupportTicket
+
+# Таблицы, доступные для выгрузки: имя в команде -> таблица
+EXPORT_TABLES = {
+    'users': User.__table__,
+    'history': PointsHistory.__table__,
+    'referrals': Referral.__table__,
+    'tickets': SupportTicket.__table__,
+}
+EXPORT_BATCH_SIZE = 1000  # строк, читаемых из курсора за раз
+
+
+async def export_table(name: str, compress: bool = False) -> tuple[str, int]:
+    """
+    Выгружает таблицу во временный CSV (или .csv.gz), возвращает (путь, строк).
+    Строки читаются серверным курсором пачками по EXPORT_BATCH_SIZE и сразу
+    пишутся в файл - память не растет с размером таблицы, а между пачками
+    цикл событий обслуживает других пользователей.
+    Файл удаляет вызывающий.
+    """
+    table = EXPORT_TABLES[name]
+    fd, path = tempfile.mkstemp(prefix=f'{name}_', suffix='.csv.gz' if compress else '.csv')
+    os.close(fd)
+
+    opener = gzip.open if compress else open
+    rows = 0
+    try:
+        # utf-8-sig и ';' - чтобы Excel в русской локали открыл файл как есть
+        with opener(path, 'wt', encoding='utf-8-sig', newline='') as file:
+            writer = csv.writer(file, delimiter=';')
+            writer.writerow(table.columns.keys())
+
+            async with async_engine.connect() as conn:
+                result = await conn.stream(
+                    select(table).order_by(table.c.id).execution_options(yield_per=EXPORT_BATCH_SIZE)
+                )
+                async for partition in result.partitions():
+                    writer.writerows(partition)
+                    rows += len(partition)
+    except BaseException:
+        os.remove(path)
+        raise
+
+    return path, rows
@@ -0,0 +1,165 @@
+import asyncio
+import json
+import logging
+import time
+from contextlib import suppress
+from datetime import datetime, timedelta
+from typing import Any, Mapping
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+from sqlalchemy import select, delete, bindparam
+from sqlalchemy.dialects.sqlite import insert
+
+from app.cache import TTLCache
+from config import FSM_STATE_TTL, FSM_FLUSH_INTERVAL, FSM_CACHE_SIZE
+from models import async_engine, FSMRecord
+
+logger = logging.getLogger(__name__)
+
+fsm_states = FSMRecord.__table__
+
+CLEANUP_INTERVAL = 60 * 60  # секунд между удалениями просроченных состояний
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище в SQLite вместо MemoryStorage.
+    Состояния переживают перезапуск, изменения пишутся пачками раз в
+    flush_interval, а брошенные диалоги старше ttl удаляются из таблицы.
+    Прочитанные и записанные состояния держатся в LRU-кэше: get_state
+    вызывается на каждый апдейт, и повторные нажатия не ходят в БД.
+    """
+
+    def __init__(self, engine=async_engine, ttl: float = FSM_STATE_TTL,
+                 flush_interval: float = FSM_FLUSH_INTERVAL, cache_size: int = FSM_CACHE_SIZE):
+        self.engine = engine
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        # Записи, еще не сохраненные в БД: key -> (state, data)
+        self._pending: dict[str, tuple[str | None, dict]] = {}
+        self._flushing: dict[str, tuple[str | None, dict]] = {}
+        self._cache = TTLCache(cache_size, ttl)
+        self._flush_task = None
+        self._last_cleanup = float('-inf')
+
+    @staticmethod
+    def _make_key(key: StorageKey) -> str:
+        return ':'.join(str(part) if part is not None else '' for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id,
+            key.business_connection_id, key.destiny
+        ))
+
+    async def _load(self, key: str) -> tuple[str | None, dict]:
+        record = self._pending.get(key) or self._flushing.get(key) or self._cache.get(key)
+        if record is not None:
+            return record
+
+        generation = self._cache.generation
+        expires_before = datetime.now() - timedelta(seconds=self.ttl)
+        async with self.engine.connect() as conn:
+            row = (await conn.execute(
+                select(fsm_states.c.state, fsm_states.c.data)
+                .where(fsm_states.c.key == key, fsm_states.c.updated_at >= expires_before)
+            )).first()
+
+        if row is None:
+            record = None, {}
+        else:
+            record = row.state, json.loads(row.data) if row.data else {}
+        # Если состояние изменилось, пока шел запрос, прочитанное в кэш не попадет
+        self._cache.set(key, record, generation)
+        return record
+
+    def _store(self, key: str, state: str | None, data: dict):
+        self._pending[key] = (state, data)
+        self._cache.invalidate(key)
+        if state is not None or data:
+            # Завершенный диалог из кэша убираем - строка будет удалена при flush
+            self._cache.set(key, (state, data))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self._make_key(key)
+        _, data = await self._load(storage_key)
+        self._store(storage_key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        state, _ = await self._load(self._make_key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        storage_key = self._make_key(key)
+        state, _ = await self._load(storage_key)
+        self._store(storage_key, state, dict(data))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        _, data = await self._load(self._make_key(key))
+        return dict(data)
+
+    async def _flush_loop(self):
+        while self._pending:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка сохранения состояний FSM: {e}")
+
+    async def flush(self):
+        """Записать накопленные изменения одной транзакцией"""
+        if not self._pending:
+            return
+
+        self._flushing, self._pending = self._pending, {}
+        try:
+            now = datetime.now()
+            upserts = []
+            deletes = []
+            for key, (state, data) in self._flushing.items():
+                if state is None and not data:
+                    # Диалог завершен (state.clear()) - строка не нужна
+                    deletes.append({'b_key': key})
+                else:
+                    upserts.append({
+                        'key': key,
+                        'state': state,
+                        'data': json.dumps(data, ensure_ascii=False, default=str),
+                        'updated_at': now
+                    })
+
+            async with self.engine.begin() as conn:
+                if upserts:
+                    stmt = insert(fsm_states)
+                    await conn.execute(stmt.on_conflict_do_update(
+                        index_elements=[fsm_states.c.key],
+                        set_={
+                            'state': stmt.excluded.state,
+                            'data': stmt.excluded.data,
+                            'updated_at': stmt.excluded.updated_at
+                        }
+                    ), upserts)
+                if deletes:
+                    await conn.execute(
+                        delete(fsm_states).where(fsm_states.c.key == bindparam('b_key')), deletes
+                    )
+                if time.monotonic() - self._last_cleanup > CLEANUP_INTERVAL:
+                    await conn.execute(delete(fsm_states).where(
+                        fsm_states.c.updated_at < now - timedelta(seconds=self.ttl)
+                    ))
+                    self._last_cleanup = time.monotonic()
+        except BaseException:
+            # Не теряем изменения (в т.ч. при отмене задачи): вернем их в очередь, более новые не трогаем
+            for key, record in self._flushing.items():
+                self._pending.setdefault(key, record)
+            raise
+        finally:
+            self._flushing = {}
+
+    async def close(self) -> None:
+        task, self._flush_task = self._flush_task, None
+        if task is not None:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+        await self.flush()
@@ -5,9 +5,9 @@ from aiogram.filters import CommandStart, Command
 from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-import asyncio
 
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.utils.chat_action import ChatActionSender
 
 
 
@@ -17,7 +17,7 @@ import app.keyboards as kb
 from requests import (get_or_create_user, get_user_data, get_user_by_tg_id, 
                       get_user_points,create_support_ticket, update_ticket_with_answer, 
                       get_ticket_by_group_message, get_user_tickets,
-                      close_ticket, update_phone_universal)
+                      close_ticket, bind_phone)
 import logging
 import re
 
@@ -46,7 +46,7 @@ async def cmd_start(message: Message):
     username = message.from_user.username
     
     # Создаем или получаем пользователя (теперь с именем)
-    user_id = get_or_create_user(
+    user_id = await get_or_create_user(
         tg_id=message.from_user.id,
         first_name=first_name,      # ← Передаем имя
         last_name=last_name,        # ← Передаем фамилию
@@ -56,7 +56,7 @@ async def cmd_start(message: Message):
     
     if user_id:
         # Получаем данные пользователя
-        user_data = get_user_data(message.from_user.id)
+        user_data = await get_user_data(message.from_user.id)
         if user_data and user_data.get('phone'):
             await message.answer(
                 f'Привет! Я бонусный помощник PONNY PRINT 🎁\n\n'
@@ -105,18 +105,15 @@ async def enter_manual_handler(callback: CallbackQuery, state: FSMContext):
 async def process_manual_phone(message: Message, state: FSMContext, bot: Bot):
     phone = message.text.strip()
     
-    # Показываем "печатает..."
-    await bot.send_chat_action(message.chat.id, "typing")
-    await asyncio.sleep(1)
-    
-    # Используем универсальную функцию
-    success, result_msg = update_phone_universal(message.from_user.id, phone)
+    # "печатает..." показываем, пока идет работа с БД
+    async with ChatActionSender.typing(bot=bot, chat_id=message.chat.id):
+        # Привязка телефона (с объединением аккаунтов) одной транзакцией
+        success, result_msg, _ = await bind_phone(message.from_user.id, phone)
+        
+        # Получаем текущие баллы пользователя
+        user_data = await get_user_data(message.from_user.id) if success else None
     
     if success:
-        # Получаем текущие баллы пользователя
-        from requests import get_user_data
-        user_data = get_user_data(message.from_user.id)
-        
         total_points = 0
         if user_data:
             total_points = user_data.get('points_manual', 0) + user_data.get('points_referral', 0)
@@ -164,10 +161,10 @@ async def back_to_phone_menu(callback: CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data == 'mypoints')
 async def mypoints_handler(callback: CallbackQuery):
-    user_data = get_user_data(callback.from_user.id)
+    user_data = await get_user_data(callback.from_user.id)
     
     if user_data and user_data.get('phone'):
-        points = get_user_points(callback.from_user.id)
+        points = await get_user_points(callback.from_user.id)
         
         # Проверяем, есть ли хоть какие-то баллы
         has_points = points['manual'] > 0 or points['referral'] > 0
@@ -233,7 +230,7 @@ async def change_phone_handler(callback: CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data == 'referral')
 async def referral_handler(callback: CallbackQuery):
-    user = get_user_by_tg_id(callback.from_user.id)
+    user = await get_user_by_tg_id(callback.from_user.id)
     
     if user and user.phone:
         bot_username = "@testtestoksanabotbot_bot"  # ЗАМЕНИ НА СВОЙ
@@ -269,11 +266,11 @@ async def process_phone(message: Message):
         phone = message.contact.phone_number
         logger.info(f"User {message.from_user.id} sent phone: {phone}")
         
-        # Используй отдельную функцию для обновления телефона
-        from requests import update_user_phone
+        success, result_msg, _ = await bind_phone(message.from_user.id, phone)
         
-        if update_user_phone(message.from_user.id, phone):
+        if success:
             await message.answer(
+                f"{result_msg}\n\n"
                 f"Отлично, номер успешно привязан👌🏻\n\n"
                 f"Теперь вы можете использовать бонусы PONNY PRINT\n"
                 f'А ещё:\n• Посмотреть свои баллы\n• Получить скидку для друга\n• Узнать условия',
@@ -281,7 +278,7 @@ async def process_phone(message: Message):
             )
         else:
             await message.answer(
-                "❌ Произошла ошибка. Попробуйте позже.",
+                result_msg,
                 reply_markup=kb.main
             )
 
@@ -354,29 +351,27 @@ async def otherquestions(call: CallbackQuery, state: FSMContext, bot: Bot):
 async def process_user_question(message: Message, state: FSMContext, bot: Bot):
     user_question = message.text
     
-    # Показываем "печатает..."
-    await bot.send_chat_action(message.chat.id, "typing")
-    await asyncio.sleep(2)
-    
     try:
-        # 1. Отправляем вопрос в группу
-        group_message = await bot.send_message(
-            chat_id=SUPPORT_GROUP_ID,
-            text=f"🆘 *НОВЫЙ ВОПРОС ОТ ПОЛЬЗОВАТЕЛЯ*\n\n"
-                 f"👤 *Пользователь:* {message.from_user.first_name}\n"
-                 f"🔹 Username: @{message.from_user.username if message.from_user.username else 'нет'}\n"
-                 f"🔹 ID: `{message.from_user.id}`\n\n"
-                 f"❓ *Вопрос:*\n{user_question}\n\n"
-                 f"👇 *Ответьте на это сообщение, чтобы отправить ответ пользователю*",
-            parse_mode="Markdown"
-        )
-        
-        # 2. Сохраняем тикет в БД
-        ticket_id = create_support_ticket(
-            user_id=message.from_user.id,
-            question=user_question,
-            group_message_id=group_message.message_id
-        )
+        # "печатает..." показываем, пока вопрос уходит в группу и сохраняется
+        async with ChatActionSender.typing(bot=bot, chat_id=message.chat.id):
+            # 1. Отправляем вопрос в группу
+            group_message = await bot.send_message(
+                chat_id=SUPPORT_GROUP_ID,
+                text=f"🆘 *НОВЫЙ ВОПРОС ОТ ПОЛЬЗОВАТЕЛЯ*\n\n"
+                     f"👤 *Пользователь:* {message.from_user.first_name}\n"
+                     f"🔹 Username: @{message.from_user.username if message.from_user.username else 'нет'}\n"
+                     f"🔹 ID: `{message.from_user.id}`\n\n"
+                     f"❓ *Вопрос:*\n{user_question}\n\n"
+                     f"👇 *Ответьте на это сообщение, чтобы отправить ответ пользователю*",
+                parse_mode="Markdown"
+            )
+            
+            # 2. Сохраняем тикет в БД
+            ticket_id = await create_support_ticket(
+                user_id=message.from_user.id,
+                question=user_question,
+                group_message_id=group_message.message_id
+            )
         
         # 3. Подтверждаем пользователю
         await message.answer(
@@ -413,7 +408,7 @@ async def handle_group_reply(message: Message, bot: Bot):
     replied_message_id = message.reply_to_message.message_id
     
     # Ищем тикет по ID сообщения в группе
-    ticket = get_ticket_by_group_message(replied_message_id)
+    ticket = await get_ticket_by_group_message(replied_message_id)
     
     if ticket and not ticket.is_answered:
         # Отправляем ответ пользователю
@@ -432,7 +427,7 @@ async def handle_group_reply(message: Message, bot: Bot):
             )
             
             # Обновляем тикет
-            update_ticket_with_answer(ticket.id, message.text)
+            await update_ticket_with_answer(ticket.id, message.text)
             
             # Подтверждаем в группе
             await message.reply(
@@ -456,7 +451,7 @@ async def close_ticket_handler(callback: CallbackQuery):
         
         # Функция для закрытия тикета (добавь в requests.py)
         from requests import close_ticket
-        if close_ticket(ticket_id):
+        if await close_ticket(ticket_id):
             # Редактируем сообщение
             await callback.message.edit_text(
                 f"🗒️ Тикет #{ticket_id} закрыт",
@@ -473,7 +468,7 @@ async def close_ticket_handler(callback: CallbackQuery):
 @router.message(Command("mytickets"))
 async def my_tickets_command(message: Message):
     """Показывает все вопросы пользователя"""
-    tickets = get_user_tickets(message.from_user.id)
+    tickets = await get_user_tickets(message.from_user.id)
     
     if not tickets:
         await message.answer("📭 У вас еще не было вопросов к поддержке.")
@@ -528,7 +523,7 @@ async def deleteask (call: CallbackQuery):
 @router.message(Command('debug'))
 async def debug_command(message: Message):
     from requests import get_user_by_tg_id
-    user = get_user_by_tg_id(message.from_user.id)
+    user = await get_user_by_tg_id(message.from_user.id)
     
     if user:
         debug_info = f"""
@@ -553,5 +548,5 @@ async def delete_no_phone_command(message: Message):
     if not is_admin(message.from_user.id):
         return
     
-    count, msg = delete_users_without_phone()
+    count, msg = await delete_users_without_phone()
     await message.answer(msg)'''
\ No newline at end of file
@@ -0,0 +1,37 @@
+from app.backup import create_backup, format_backup_result
+from app.scheduler import scheduler
+from config import POINTS_EXPIRY_INTERVAL, CLEANUP_INTERVAL, DB_MAINTENANCE_INTERVAL, BACKUP_INTERVAL
+from requests import expire_points, delete_empty_users, clean_duplicate_phones, optimize_database
+
+
+async def expire_points_job():
+    result = await expire_points()
+    if 'error' in result:
+        raise RuntimeError(result['error'])
+    return f"сгорело {result['points']} баллов у {result['users']} из {result['checked']} пользователей"
+
+async def clean_empty_users_job():
+    _, msg = await delete_empty_users()
+    return msg
+
+async def clean_duplicates_job():
+    _, msg = await clean_duplicate_phones()
+    return msg
+
+def backup_job():
+    return format_backup_result(create_backup())
+
+
+def setup_jobs():
+    """Регистрирует фоновые задачи бота; запуск - scheduler.start() при старте диспетчера"""
+    scheduler.add_job('points_expiry', expire_points_job, POINTS_EXPIRY_INTERVAL,
+                      timeout=60 * 60, description="сгорание баллов")
+    scheduler.add_job('clean_empty_users', clean_empty_users_job, CLEANUP_INTERVAL,
+                      timeout=10 * 60, description="удаление пустых записей")
+    scheduler.add_job('clean_duplicates', clean_duplicates_job, CLEANUP_INTERVAL,
+                      timeout=10 * 60, description="удаление дубликатов телефонов")
+    scheduler.add_job('db_maintenance', optimize_database, DB_MAINTENANCE_INTERVAL,
+                      description="статистика SQLite и checkpoint WAL")
+    scheduler.add_job('backup', backup_job, BACKUP_INTERVAL,
+                      description="резервная копия базы")
+    return scheduler
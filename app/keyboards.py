@@ -102,6 +102,7 @@ admin_main = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text="👤 Добавить пользователя", callback_data="admin_add_user")],
     [InlineKeyboardButton(text="💰 Управление баллами", callback_data="admin_points")],
     [InlineKeyboardButton(text="🧹 Очистка базы", callback_data="admin_cleanup")],
+    [InlineKeyboardButton(text="📢 Рассылка", callback_data="admin_broadcast")],
     [InlineKeyboardButton(text="⚙️ Настройки", callback_data="admin_settings")],
     [InlineKeyboardButton(text="🚪 Выйти из админки", callback_data="admin_exit")]
 ])
@@ -110,6 +111,7 @@ admin_main = InlineKeyboardMarkup(inline_keyboard=[
 admin_users_menu = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text="🔍 Поиск пользователя", callback_data="admin_search")],
     [InlineKeyboardButton(text="📋 Список пользователей", callback_data="admin_users_list")],
+    [InlineKeyboardButton(text="📥 Импорт из CSV", callback_data="admin_import")],
     [InlineKeyboardButton(text="👤 Информация о себе", callback_data="admin_my_info")],
     [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
 ])
@@ -119,6 +121,8 @@ admin_points_menu = InlineKeyboardMarkup(inline_keyboard=[
     [InlineKeyboardButton(text="➕ Добавить баллы", callback_data="admin_add_points")],
     [InlineKeyboardButton(text="➖ Убрать баллы", callback_data="admin_remove_points")],
     [InlineKeyboardButton(text="✏️ Установить баллы", callback_data="admin_set_points")],
+    [InlineKeyboardButton(text="🛍️ Кэшбэк за заказы", callback_data="admin_cashback")],
+    [InlineKeyboardButton(text="📈 Начисления по дням", callback_data="admin_points_chart_7")],
     [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")]
 ])
 
@@ -0,0 +1,92 @@
+import time
+from bisect import bisect_left
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+# Верхние границы корзин гистограммы, мс
+LATENCY_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class LatencyHistogram:
+    """Гистограмма времени ответа обработчика с фиксированными корзинами"""
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя корзина - все, что дольше
+        self.total = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms: float):
+        self.counts[bisect_left(self.buckets, ms)] += 1
+        self.total += 1
+        self.sum_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, p: float) -> float:
+        """Оценка перцентиля сверху: граница корзины, в которую он попал"""
+        if not self.total:
+            return 0.0
+        rank = p / 100 * self.total
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+    @property
+    def avg_ms(self) -> float:
+        return self.sum_ms / self.total if self.total else 0.0
+
+
+# Имя обработчика -> гистограмма
+handler_latency: dict[str, LatencyHistogram] = {}
+
+
+class LatencyMiddleware(BaseMiddleware):
+    """
+    Внутренний middleware роутера: меряет полное время работы обработчика
+    (включая ответы в Telegram) и пишет его в handler_latency.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any]
+    ) -> Any:
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object else type(event).__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            histogram = handler_latency.get(name)
+            if histogram is None:
+                histogram = handler_latency[name] = LatencyHistogram()
+            histogram.observe((time.perf_counter() - started) * 1000)
+
+
+def setup_latency_metrics(router):
+    """Подключить замер времени к сообщениям и колбэкам роутера"""
+    middleware = LatencyMiddleware()
+    router.message.middleware(middleware)
+    router.callback_query.middleware(middleware)
+
+
+def format_latency_report(limit: int = 20) -> str:
+    """Текстовый отчет для админки: самые медленные обработчики по p95"""
+    if not handler_latency:
+        return "Замеров пока нет"
+
+    rows = sorted(handler_latency.items(), key=lambda item: item[1].percentile(95), reverse=True)
+    lines = ["обработчик: вызовов | сред | p50 | p95 | макс (мс)"]
+    for name, histogram in rows[:limit]:
+        lines.append(
+            f"{name}: {histogram.total} | {histogram.avg_ms:.0f} | {histogram.percentile(50):.0f} | "
+            f"{histogram.percentile(95):.0f} | {histogram.max_ms:.0f}"
+        )
+    return '\n'.join(lines)
@@ -0,0 +1,212 @@
+import logging
+
+from sqlalchemy import text, inspect
+
+from models import engine, User, PointsHistory, Referral, SupportTicket, FSMRecord, UserStats, PointsDaily, Broadcast, JobState
+
+logger = logging.getLogger(__name__)
+
+
+# ========== МИГРАЦИИ ==========
+# Текущая версия схемы хранится в PRAGMA user_version.
+# Каждая миграция должна быть идемпотентной: база могла быть создана
+# старым create_all без версии.
+
+def _create_base_tables(conn):
+    """Исходные таблицы бота"""
+    tables = [User.__table__, PointsHistory.__table__, Referral.__table__, SupportTicket.__table__]
+    for table in tables:
+        table.create(conn, checkfirst=True)
+
+def _table_columns(conn, table) -> set:
+    return {column['name'] for column in inspect(conn).get_columns(table.name)}
+
+def _add_lookup_indexes(conn):
+    """Индексы для истории, тикетов, рефералов и приглашенных"""
+    for table in (User.__table__, PointsHistory.__table__, Referral.__table__, SupportTicket.__table__):
+        columns = _table_columns(conn, table)
+        for index in table.indexes:
+            # Индексы по колонкам из более поздних миграций создадут они сами
+            if all(column.name in columns for column in index.columns):
+                index.create(conn, checkfirst=True)
+    conn.execute(text("ANALYZE"))
+
+def _create_fsm_states(conn):
+    """Таблица состояний FSM (app/fsm_storage.py)"""
+    FSMRecord.__table__.create(conn, checkfirst=True)
+
+def _add_history_order_id(conn):
+    """points_history.order_id - защита от повторного начисления кэшбэка за заказ"""
+    table = PointsHistory.__table__
+    if 'order_id' not in _table_columns(conn, table):
+        conn.execute(text("ALTER TABLE points_history ADD COLUMN order_id VARCHAR(64)"))
+    for index in table.indexes:
+        if index.name == 'ux_points_history_order_id':
+            index.create(conn, checkfirst=True)
+
+# Полнотекстовый индекс (триграммы) для поиска в админке по подстроке
+# имени, username и телефона. Внешнее содержимое - таблица users,
+# синхронизация триггерами; смена баллов индекс не трогает.
+USERS_SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+        first_name, last_name, username, phone,
+        content='users', content_rowid='id', tokenize='trigram'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN
+        INSERT INTO users_fts(rowid, first_name, last_name, username, phone)
+        VALUES (new.id, new.first_name, new.last_name, new.username, new.phone);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN
+        INSERT INTO users_fts(users_fts, rowid, first_name, last_name, username, phone)
+        VALUES ('delete', old.id, old.first_name, old.last_name, old.username, old.phone);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF first_name, last_name, username, phone ON users BEGIN
+        INSERT INTO users_fts(users_fts, rowid, first_name, last_name, username, phone)
+        VALUES ('delete', old.id, old.first_name, old.last_name, old.username, old.phone);
+        INSERT INTO users_fts(rowid, first_name, last_name, username, phone)
+        VALUES (new.id, new.first_name, new.last_name, new.username, new.phone);
+    END""",
+    "INSERT INTO users_fts(users_fts) VALUES ('rebuild')",
+]
+
+def _create_users_search(conn):
+    """FTS5-индекс пользователей для поиска в админке"""
+    for statement in USERS_SEARCH_DDL:
+        conn.execute(text(statement))
+
+# Вклад одной строки users в каждый счетчик user_stats ({row} - new или old)
+_USER_STATS_TERMS = {
+    'total_users': '1',
+    'users_with_phone': '({row}.phone IS NOT NULL)',
+    'users_with_tg': '({row}.tg_id IS NOT NULL)',
+    'empty_users': '({row}.phone IS NULL AND {row}.tg_id IS NULL)',
+    'total_points': '(coalesce({row}.points_manual, 0) + coalesce({row}.points_referral, 0))',
+}
+
+def _user_stats_update(*changes) -> str:
+    """UPDATE user_stats для триггера: changes - пары (знак, строка), например ('-', 'old'), ('+', 'new')"""
+    assignments = ', '.join(
+        f"{name} = {name}" + ''.join(f" {sign} {term.format(row=row)}" for sign, row in changes)
+        for name, term in _USER_STATS_TERMS.items()
+    )
+    return f"UPDATE user_stats SET {assignments} WHERE id = 1;"
+
+USER_STATS_DDL = [
+    """INSERT OR REPLACE INTO user_stats (id, total_users, users_with_phone, users_with_tg, empty_users, total_points)
+    SELECT 1, count(*), count(phone), count(tg_id),
+           coalesce(sum(phone IS NULL AND tg_id IS NULL), 0),
+           coalesce(sum(coalesce(points_manual, 0) + coalesce(points_referral, 0)), 0)
+    FROM users""",
+    f"""CREATE TRIGGER IF NOT EXISTS user_stats_ai AFTER INSERT ON users BEGIN
+        {_user_stats_update(('+', 'new'))}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS user_stats_ad AFTER DELETE ON users BEGIN
+        {_user_stats_update(('-', 'old'))}
+    END""",
+    # Старую строку вычитаем, новую прибавляем - одним UPDATE
+    f"""CREATE TRIGGER IF NOT EXISTS user_stats_au
+    AFTER UPDATE OF phone, tg_id, points_manual, points_referral ON users BEGIN
+        {_user_stats_update(('-', 'old'), ('+', 'new'))}
+    END""",
+]
+
+def _create_user_stats(conn):
+    """Материализованные счетчики для админки вместо агрегатов по users"""
+    UserStats.__table__.create(conn, checkfirst=True)
+    for statement in USER_STATS_DDL:
+        conn.execute(text(statement))
+
+# Ключ строки points_daily для строки истории ({row} - new или old)
+_POINTS_DAY = "coalesce(date({row}.created_at), date('now', 'localtime'))"
+_POINTS_TYPE = "coalesce({row}.points_type, '')"
+
+def _points_daily_add(row: str) -> str:
+    return f"""INSERT INTO points_daily (day, points_type, total, count)
+        VALUES ({_POINTS_DAY.format(row=row)}, {_POINTS_TYPE.format(row=row)}, coalesce({row}.points_amount, 0), 1)
+        ON CONFLICT (day, points_type) DO UPDATE SET total = total + excluded.total, count = count + 1;"""
+
+def _points_daily_subtract(row: str) -> str:
+    return f"""UPDATE points_daily SET total = total - coalesce({row}.points_amount, 0), count = count - 1
+        WHERE day = {_POINTS_DAY.format(row=row)} AND points_type = {_POINTS_TYPE.format(row=row)};"""
+
+POINTS_DAILY_DDL = [
+    """INSERT OR REPLACE INTO points_daily (day, points_type, total, count)
+    SELECT coalesce(date(created_at), date('now', 'localtime')), coalesce(points_type, ''),
+           coalesce(sum(points_amount), 0), count(*)
+    FROM points_history GROUP BY 1, 2""",
+    f"""CREATE TRIGGER IF NOT EXISTS points_daily_ai AFTER INSERT ON points_history BEGIN
+        {_points_daily_add('new')}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS points_daily_ad AFTER DELETE ON points_history BEGIN
+        {_points_daily_subtract('old')}
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS points_daily_au
+    AFTER UPDATE OF points_type, points_amount, created_at ON points_history BEGIN
+        {_points_daily_subtract('old')}
+        {_points_daily_add('new')}
+    END""",
+]
+
+def _create_points_daily(conn):
+    """Дневная сводка начислений вместо GROUP BY по всей истории"""
+    PointsDaily.__table__.create(conn, checkfirst=True)
+    for statement in POINTS_DAILY_DDL:
+        conn.execute(text(statement))
+
+def _create_broadcasts(conn):
+    """Рассылки и их прогресс (app/broadcast.py)"""
+    Broadcast.__table__.create(conn, checkfirst=True)
+
+# Индекс по выражению models.USER_TOTAL_POINTS. Не объявлен через Index():
+# SQLAlchemy не умеет проверять существование индексов по выражению
+USERS_TOTAL_POINTS_INDEX = (
+    "CREATE INDEX IF NOT EXISTS ix_users_total_points "
+    "ON users (coalesce(points_manual, 0) + coalesce(points_referral, 0))"
+)
+
+def _add_segment_support(conn):
+    """Индекс по сумме баллов для сегментов и сегмент у рассылки"""
+    if 'segment' not in _table_columns(conn, Broadcast.__table__):
+        conn.execute(text("ALTER TABLE broadcasts ADD COLUMN segment TEXT"))
+    conn.execute(text(USERS_TOTAL_POINTS_INDEX))
+    conn.execute(text("ANALYZE users"))
+
+def _create_job_state(conn):
+    """Курсоры фоновых задач (сгорание баллов и др.)"""
+    JobState.__table__.create(conn, checkfirst=True)
+
+
+MIGRATIONS = [
+    (1, "Базовые таблицы", _create_base_tables),
+    (2, "Индексы для частых выборок", _add_lookup_indexes),
+    (3, "Хранилище состояний FSM", _create_fsm_states),
+    (4, "Номер заказа в истории баллов", _add_history_order_id),
+    (5, "Поисковый индекс пользователей", _create_users_search),
+    (6, "Счетчики статистики пользователей", _create_user_stats),
+    (7, "Дневная сводка начислений", _create_points_daily),
+    (8, "Рассылки", _create_broadcasts),
+    (9, "Сегменты пользователей", _add_segment_support),
+    (10, "Состояние фоновых задач", _create_job_state),
+]
+
+
+def get_schema_version(conn) -> int:
+    return conn.execute(text("PRAGMA user_version")).scalar()
+
+def run_migrations(bind=None) -> int:
+    """Применить все новые миграции, возвращает итоговую версию схемы"""
+    bind = bind or engine
+
+    with bind.begin() as conn:
+        version = get_schema_version(conn)
+
+        for number, description, migrate in MIGRATIONS:
+            if number <= version:
+                continue
+            logger.info(f"Миграция {number}: {description}")
+            migrate(conn)
+            # PRAGMA не поддерживает параметры, number - константа из списка выше
+            conn.execute(text(f"PRAGMA user_version = {number}"))
+            version = number
+
+    return version
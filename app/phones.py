@@ -0,0 +1,62 @@
+from typing import Iterable
+
+# Разделители, которые люди пишут в номерах: +7 (999) 123-45-67, 8.999.123.45.67
+PHONE_SEPARATORS = str.maketrans('', '', ' +()-.\t ')
+
+
+def normalize_phone(phone) -> str | None:
+    """
+    Приводит российский номер к виду 8XXXXXXXXXX.
+    Понимает +79991234567, 89991234567, 79991234567, 9991234567 и те же
+    номера с пробелами, скобками и дефисами. None - если это не номер.
+    """
+    if phone is None:
+        return None
+    phone = str(phone).strip()
+
+    # Быстрый путь: номер уже в базовом виде (так приходит большинство)
+    if len(phone) == 11 and phone.isdigit():
+        if phone[0] == '8':
+            return phone
+        if phone[0] == '7':
+            return '8' + phone[1:]
+        return None
+
+    digits = phone.translate(PHONE_SEPARATORS)
+    if not digits.isdigit():
+        return None
+    if len(digits) == 11 and digits[0] in '78':
+        return '8' + digits[1:]
+    if len(digits) == 10 and digits[0] == '9':
+        return '8' + digits
+    return None
+
+
+def phone_digits(text) -> str | None:
+    """
+    Цифры номера, в том числе неполного (для поиска), в том виде, как номера
+    хранятся в базе: "+7 (999) 12" -> "899912". None - если это не номер.
+    """
+    text = str(text).strip()
+    digits = text.translate(PHONE_SEPARATORS)
+    if not digits.isdigit():
+        return None
+    if text.startswith('+7') or (len(digits) == 11 and digits[0] == '7'):
+        return '8' + digits[1:]
+    return digits
+
+
+def normalize_phones(phones: Iterable) -> list[str | None]:
+    """
+    Пакетная нормализация для импорта: результат в том же порядке, что и
+    вход, неверные номера - None. Повторяющиеся строки разбираются один раз.
+    """
+    seen = {}
+    result = []
+    append = result.append
+    for phone in phones:
+        normalized = seen.get(phone, seen)
+        if normalized is seen:
+            normalized = seen[phone] = normalize_phone(phone)
+        append(normalized)
+    return result
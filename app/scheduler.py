@@ -0,0 +1,197 @@
+import asyncio
+import inspect
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Callable
+
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+
+from app.metrics import LatencyHistogram
+from config import SCHEDULER_WORKERS, SCHEDULER_JITTER, SCHEDULER_SHUTDOWN_TIMEOUT
+from models import async_engine, JobState
+
+logger = logging.getLogger(__name__)
+
+job_state = JobState.__table__
+
+# Границы корзин гистограммы длительности задач, мс: от 100 мс до 30 минут
+JOB_BUCKETS = (100, 1000, 10000, 60000, 300000, 1800000)
+
+
+class ScheduledJob:
+    """Периодическая задача: функция, интервал и статистика запусков"""
+
+    def __init__(self, name: str, func: Callable[[], Any], interval: float | None,
+                 jitter: float = SCHEDULER_JITTER, timeout: float = None, description: str = ''):
+        self.name = name
+        self.func = func
+        self.interval = interval  # None - только ручной запуск (trigger)
+        self.jitter = jitter
+        self.timeout = timeout  # только для async-задач: поток прервать нельзя
+        self.description = description
+        self.histogram = LatencyHistogram(JOB_BUCKETS)
+        self.running = False
+        self.failures = 0
+        self.last_run_at: datetime | None = None
+        self.next_run_at: datetime | None = None
+        self.last_result = None
+        self.last_error: str | None = None
+
+    def next_delay(self) -> float:
+        """Интервал со случайным разбросом: задачи не стартуют все разом"""
+        return self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+
+class Scheduler:
+    """
+    Планировщик фоновых задач внутри процесса бота.
+    async-задачи выполняются в цикле событий (их запросы к БД и так идут
+    через поток aiosqlite), синхронные - в отдельном пуле потоков, чтобы
+    sqlite3 и работа с файлами не останавливали обработку апдейтов.
+    Одна задача не запускается повторно, пока не закончилась предыдущая.
+    Время последнего запуска хранится в job_state: перезапуск бота не
+    сбивает суточные задачи.
+    """
+
+    def __init__(self, workers: int = SCHEDULER_WORKERS):
+        self.jobs: dict[str, ScheduledJob] = {}
+        self.workers = workers
+        self._executor = None
+        self._loops: list[asyncio.Task] = []
+        self._runs: set[asyncio.Task] = set()
+
+    def add_job(self, name: str, func: Callable[[], Any], interval: float | None, **kwargs) -> ScheduledJob:
+        job = ScheduledJob(name, func, interval, **kwargs)
+        self.jobs[name] = job
+        return job
+
+    async def start(self):
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='job')
+        last_runs = await self._load_last_runs()
+        now = datetime.now()
+        for job in self.jobs.values():
+            job.last_run_at = last_runs.get(job.name)
+            if job.interval is None:
+                continue
+            delay = 0 if job.last_run_at is None else (job.last_run_at - now).total_seconds() + job.interval
+            # Просроченные задачи стартуют вскоре после запуска бота, но не все разом
+            delay = max(delay, random.uniform(10, 60))
+            self._loops.append(asyncio.create_task(self._loop(job, delay)))
+        logger.info(f"Планировщик: {len(self._loops)} задач по расписанию, всего {len(self.jobs)}")
+
+    async def stop(self):
+        for task in self._loops:
+            task.cancel()
+        self._loops.clear()
+        if self._runs:
+            logger.info(f"Ожидаем завершения {len(self._runs)} фоновых задач")
+            _, pending = await asyncio.wait(self._runs, timeout=SCHEDULER_SHUTDOWN_TIMEOUT)
+            for task in pending:
+                task.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def _loop(self, job: ScheduledJob, delay: float):
+        while True:
+            job.next_run_at = datetime.now() + timedelta(seconds=delay)
+            await asyncio.sleep(delay)
+            # Следующий отсчет - после окончания запуска; shield - остановка
+            # планировщика не отменяет запуск вместе с циклом
+            await asyncio.shield(self._spawn(job))
+            delay = job.next_delay()
+
+    def _spawn(self, job: ScheduledJob) -> asyncio.Task:
+        # Отдельная задача: остановка планировщика не прерывает запуск на середине
+        task = asyncio.create_task(self.run_job(job))
+        self._runs.add(task)
+        task.add_done_callback(self._runs.discard)
+        return task
+
+    def trigger(self, name: str) -> bool:
+        """Запустить задачу вне расписания в фоне; False - уже выполняется или нет такой"""
+        job = self.jobs.get(name)
+        if job is None or job.running:
+            return False
+        self._spawn(job)
+        return True
+
+    async def run_job(self, job: ScheduledJob) -> bool:
+        if job.running:
+            logger.warning(f"Задача {job.name} еще выполняется, запуск пропущен")
+            return False
+
+        job.running = True
+        started = time.perf_counter()
+        try:
+            if inspect.iscoroutinefunction(job.func):
+                job.last_result = await asyncio.wait_for(job.func(), job.timeout)
+            else:
+                loop = asyncio.get_running_loop()
+                job.last_result = await loop.run_in_executor(self._executor, job.func)
+            job.last_error = None
+        except Exception as e:
+            job.failures += 1
+            job.last_error = str(e) or type(e).__name__
+            logger.error(f"Задача {job.name} упала: {e}", exc_info=True)
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            job.histogram.observe(elapsed_ms)
+            job.running = False
+            job.last_run_at = datetime.now()
+            logger.info(f"Задача {job.name}: {elapsed_ms:.0f} мс")
+
+        await self._save_last_run(job)
+        return True
+
+    async def _load_last_runs(self) -> dict[str, datetime]:
+        async with async_engine.connect() as conn:
+            rows = await conn.execute(
+                select(job_state.c.name, job_state.c.last_run_at)
+                .where(job_state.c.name.in_(list(self.jobs)), job_state.c.last_run_at.isnot(None))
+            )
+            return dict(rows.all())
+
+    async def _save_last_run(self, job: ScheduledJob):
+        try:
+            async with async_engine.begin() as conn:
+                await conn.execute(
+                    insert(job_state).values(name=job.name, last_run_at=job.last_run_at)
+                    .on_conflict_do_update(index_elements=['name'], set_={'last_run_at': job.last_run_at})
+                )
+        except Exception as e:
+            # Не сохранили - после перезапуска задача выполнится раньше срока, не страшно
+            logger.warning(f"Не удалось сохранить время запуска {job.name}: {e}")
+
+    def format_report(self) -> str:
+        """Текстовый отчет для админки: расписание и длительность задач"""
+        if not self.jobs:
+            return "Фоновых задач нет"
+
+        blocks = []
+        for job in self.jobs.values():
+            histogram = job.histogram
+            status = "⏳ выполняется" if job.running else (f"❌ {job.last_error[:80]}" if job.last_error else "✅")
+            last_run = f"{job.last_run_at:%d.%m %H:%M}" if job.last_run_at else "не было"
+            schedule = f"каждые {job.interval / 3600:g} ч" if job.interval is not None else "по запросу"
+            lines = [
+                f"{job.name} - {job.description}",
+                f"  {schedule}, {status}",
+                f"  последний: {last_run}" + (f", следующий: {job.next_run_at:%d.%m %H:%M}" if job.next_run_at else ""),
+            ]
+            if histogram.total:
+                lines.append(
+                    f"  запусков: {histogram.total}, ошибок: {job.failures}, "
+                    f"сред {histogram.avg_ms / 1000:.1f} с, макс {histogram.max_ms / 1000:.1f} с"
+                )
+            if job.last_result is not None and not job.last_error:
+                lines.append(f"  итог: {str(job.last_result)[:100]}")
+            blocks.append('\n'.join(lines))
+        return '\n\n'.join(blocks)
+
+
+scheduler = Scheduler()
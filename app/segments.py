@@ -0,0 +1,136 @@
+import operator
+import re
+from datetime import datetime, timedelta
+from typing import AsyncIterator
+
+from sqlalchemy import select, func
+
+from models import async_engine, User, PointsHistory, Referral, UserListItem, USER_LIST_COLUMNS, USER_TOTAL_POINTS
+
+users = User.__table__
+history = PointsHistory.__table__
+referrals = Referral.__table__
+
+SEGMENT_BATCH_SIZE = 1000  # id за одну выборку при потоковом чтении
+
+SEGMENT_HELP = (
+    "🎯 Сегмент - условия через пробел, все должны выполняться:\n\n"
+    "points>1000 - баллов больше (также < >= <= = !=)\n"
+    "phone=yes / phone=no - есть ли телефон\n"
+    "tg=yes / tg=no - открывал ли бота\n"
+    "invited_by=КОД - приглашен по реферальному коду\n"
+    "referrals>=3 - сколько человек пригласил\n"
+    "active=30 - были начисления за последние N дней\n"
+    "inactive=90 - не было начислений N дней\n\n"
+    "Пример: /segment phone=yes points=0"
+)
+
+OPERATORS = {
+    '>=': operator.ge, '<=': operator.le, '!=': operator.ne,
+    '>': operator.gt, '<': operator.lt, '=': operator.eq,
+}
+CONDITION = re.compile(r'^([a-z_]+)(>=|<=|!=|>|<|=)(.+)$')
+YES = {'yes', 'да', '1', 'true'}
+NO = {'no', 'нет', '0', 'false'}
+
+
+def _number(field: str, value: str) -> int:
+    if not value.lstrip('-').isdigit():
+        raise ValueError(f"{field}: нужно целое число, получено '{value}'")
+    return int(value)
+
+def _flag(field: str, value: str) -> bool:
+    value = value.lower()
+    if value not in YES | NO:
+        raise ValueError(f"{field}: нужно yes или no, получено '{value}'")
+    return value in YES
+
+def _referrals_filter(compare, count: int):
+    """
+    Условие на число приглашенных. Считаем группировкой по индексу referrals
+    один раз, а не подзапросом на каждого пользователя. Если условию
+    удовлетворяет и ноль приглашенных, берем всех, кроме неподходящих.
+    """
+    invited = func.count()
+    if compare(0, count):
+        codes = select(referrals.c.referrer_code).group_by(referrals.c.referrer_code).having(~compare(invited, count))
+        return users.c.referral_code.not_in(codes) | users.c.referral_code.is_(None)
+    codes = select(referrals.c.referrer_code).group_by(referrals.c.referrer_code).having(compare(invited, count))
+    return users.c.referral_code.in_(codes)
+
+def _recent_activity(days: int):
+    """id пользователей с начислениями за days дней - диапазон по индексу created_at"""
+    since = datetime.now() - timedelta(days=days)
+    return select(history.c.user_id).where(history.c.created_at >= since, history.c.user_id.isnot(None))
+
+def _compile_condition(field: str, op: str, value: str):
+    compare = OPERATORS[op]
+    if field == 'points':
+        return compare(USER_TOTAL_POINTS, _number(field, value))
+    if field == 'referrals':
+        return _referrals_filter(compare, _number(field, value))
+
+    if op not in ('=', '!='):
+        raise ValueError(f"{field}: поддерживается только = и !=")
+    negate = op == '!='
+    if field in ('phone', 'tg'):
+        column = users.c.phone if field == 'phone' else users.c.tg_id
+        return column.isnot(None) if _flag(field, value) != negate else column.is_(None)
+    if field == 'invited_by':
+        return users.c.invited_by != value if negate else users.c.invited_by == value
+    if field in ('active', 'inactive'):
+        days = _number(field, value)
+        if days <= 0:
+            raise ValueError(f"{field}: число дней должно быть больше нуля")
+        active = (field == 'active') != negate
+        return users.c.id.in_(_recent_activity(days)) if active else users.c.id.not_in(_recent_activity(days))
+    raise ValueError(f"Неизвестное условие '{field}'")
+
+def parse_segment(spec: str | None) -> list:
+    """
+    Разбирает описание сегмента ("points>1000 inactive=90") в список условий
+    WHERE по таблице users. Пустое описание - все пользователи.
+    Ошибки в описании - ValueError с понятным админу текстом.
+    """
+    conditions = []
+    for part in (spec or '').split():
+        match = CONDITION.match(part.strip())
+        if not match:
+            raise ValueError(f"Не понял условие '{part}'")
+        field, op, value = match.groups()
+        conditions.append(_compile_condition(field.lower(), op, value))
+    return conditions
+
+async def count_segment(spec: str | None) -> int:
+    conditions = parse_segment(spec)
+    async with async_engine.connect() as conn:
+        return await conn.scalar(select(func.count()).select_from(users).where(*conditions))
+
+async def sample_segment(spec: str | None, limit: int = 10) -> list[UserListItem]:
+    """Первые пользователи сегмента (новые сверху) - для проверки админом"""
+    conditions = parse_segment(spec)
+    async with async_engine.connect() as conn:
+        rows = (await conn.execute(
+            select(*USER_LIST_COLUMNS).where(*conditions).order_by(users.c.id.desc()).limit(limit)
+        )).all()
+    return [UserListItem(*row) for row in rows]
+
+async def iter_segment(spec: str | None, columns: tuple = (users.c.id,), after_id: int = 0,
+                       batch_size: int = SEGMENT_BATCH_SIZE) -> AsyncIterator[list]:
+    """
+    Потоково отдает пользователей сегмента пачками по возрастанию id
+    (первая колонка columns должна быть users.c.id), начиная после after_id.
+    Курсор по id вместо OFFSET, соединение не держится между пачками -
+    перебор большого сегмента не блокирует запись в базу.
+    """
+    conditions = parse_segment(spec)
+    while True:
+        async with async_engine.connect() as conn:
+            rows = (await conn.execute(
+                select(*columns).where(users.c.id > after_id, *conditions)
+                .order_by(users.c.id).limit(batch_size)
+            )).all()
+        if not rows:
+            return
+        yield rows
+        after_id = rows[-1].id
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import secrets
+import signal
+from contextlib import suppress
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from config import (WEBHOOK_BASE_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT,
+                    WEBHOOK_MAX_CONCURRENCY, WEBHOOK_SHUTDOWN_TIMEOUT)
+
+logger = logging.getLogger(__name__)
+
+
+class LimitedRequestHandler(SimpleRequestHandler):
+    """
+    Обработчик вебхука: сразу отвечает Telegram, а апдейты обрабатывает в
+    фоне не более max_concurrency одновременно. При остановке дожидается
+    уже принятых апдейтов.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, max_concurrency: int = WEBHOOK_MAX_CONCURRENCY,
+                 shutdown_timeout: float = WEBHOOK_SHUTDOWN_TIMEOUT, **kwargs):
+        super().__init__(dispatcher, bot, handle_in_background=True, **kwargs)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.shutdown_timeout = shutdown_timeout
+
+    async def _background_feed_update(self, bot: Bot, update: dict) -> None:
+        async with self._semaphore:
+            await super()._background_feed_update(bot, update)
+
+    async def close(self) -> None:
+        tasks = set(self._background_feed_update_tasks)
+        if tasks:
+            logger.info(f"Ожидаем завершения {len(tasks)} апдейтов")
+            _, pending = await asyncio.wait(tasks, timeout=self.shutdown_timeout)
+            for task in pending:
+                task.cancel()
+        await super().close()
+
+
+def create_webhook_app(dispatcher: Dispatcher, bot: Bot, secret_token: str = None) -> web.Application:
+    """aiohttp-приложение с маршрутом вебхука и startup/shutdown диспетчера"""
+    app = web.Application()
+    handler = LimitedRequestHandler(dispatcher, bot, secret_token=secret_token)
+    # Регистрируем до setup_application: при остановке сначала дождемся
+    # апдейтов, потом диспетчер закроет хранилище FSM
+    handler.register(app, path=WEBHOOK_PATH)
+    setup_application(app, dispatcher, bot=bot)
+    return app
+
+
+async def run_webhook(dispatcher: Dispatcher, bot: Bot):
+    """Запуск бота в режиме вебхука (вместо dp.start_polling)"""
+    secret_token = WEBHOOK_SECRET
+    if WEBHOOK_BASE_URL:
+        secret_token = secret_token or secrets.token_urlsafe(32)
+
+        async def set_webhook(bot: Bot):
+            await bot.set_webhook(
+                f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}",
+                secret_token=secret_token,
+                allowed_updates=dispatcher.resolve_used_update_types(),
+                max_connections=WEBHOOK_MAX_CONCURRENCY,
+            )
+
+        dispatcher.startup.register(set_webhook)
+    elif not secret_token:
+        logger.warning("WEBHOOK_SECRET не задан: запросы к вебхуку не проверяются")
+
+    app = create_webhook_app(dispatcher, bot, secret_token)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logger.info(f"Вебхук слушает http://{WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
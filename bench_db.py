@@ -0,0 +1,90 @@
+"""
+Бенчмарк конкурентного чтения/записи SQLite: без настроек и с профилем SQLITE_PRAGMAS.
+
+Запуск: python bench_db.py [секунд] [писателей] [читателей]
+Работает на временной базе, bot.app.db не трогает.
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from sqlalchemy import select, update, insert
+
+from app.migrations import run_migrations
+from config import SQLITE_PRAGMAS
+from models import create_db_engine, create_async_db_engine, User, PointsHistory
+
+USERS = 1000
+
+
+async def writer(engine, deadline, stats):
+    users = User.__table__
+    i = 0
+    while time.perf_counter() < deadline:
+        user_id = i % USERS + 1
+        try:
+            async with engine.begin() as conn:
+                await conn.execute(
+                    update(users).where(users.c.id == user_id).values(points_manual=users.c.points_manual + 1)
+                )
+                await conn.execute(insert(PointsHistory.__table__).values(
+                    user_id=user_id, points_type='manual', points_amount=1, created_at=datetime.now()
+                ))
+            stats['writes'] += 1
+        except Exception:
+            stats['errors'] += 1
+        i += 7
+
+async def reader(engine, deadline, stats):
+    i = 0
+    while time.perf_counter() < deadline:
+        try:
+            async with engine.connect() as conn:
+                await conn.execute(select(User.__table__).where(User.tg_id == i % USERS + 1))
+            stats['reads'] += 1
+        except Exception:
+            stats['errors'] += 1
+        i += 13
+
+async def run_case(name, pragmas, seconds, writers, readers):
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    url = f'sqlite:///{path}'
+
+    sync_engine = create_db_engine(url, pragmas)
+    run_migrations(sync_engine)
+    with sync_engine.begin() as conn:
+        conn.execute(insert(User.__table__), [
+            {'tg_id': i, 'phone': f'8999{i:07d}', 'referral_code': f'code{i}', 'points_manual': 0, 'points_referral': 0}
+            for i in range(1, USERS + 1)
+        ])
+    sync_engine.dispose()
+
+    engine = create_async_db_engine(url, pragmas)
+    stats = {'reads': 0, 'writes': 0, 'errors': 0}
+    deadline = time.perf_counter() + seconds
+    await asyncio.gather(
+        *(writer(engine, deadline, stats) for _ in range(writers)),
+        *(reader(engine, deadline, stats) for _ in range(readers)),
+    )
+    await engine.dispose()
+
+    print(
+        f"{name:<10} чтений/с: {stats['reads'] / seconds:>8.0f}   "
+        f"записей/с: {stats['writes'] / seconds:>7.0f}   ошибок: {stats['errors']}"
+    )
+
+async def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    writers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    readers = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+
+    print(f"{seconds:g} с, писателей: {writers}, читателей: {readers}")
+    await run_case('default', {}, seconds, writers, readers)
+    await run_case('tuned', SQLITE_PRAGMAS, seconds, writers, readers)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,117 @@
+"""
+Бенчмарк и проверка конкурентности привязки телефона (requests.bind_phone).
+
+Запуск: python bench_phone.py [пользователей] [параллельно]
+Работает на временной базе, bot.app.db не трогает.
+
+Проверки:
+  * повторная одновременная отправка контакта одним пользователем -
+    приветственные баллы начисляются один раз;
+  * одновременная привязка одного номера разными аккаунтами - номер
+    остается ровно у одной записи, баллы и история не теряются.
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from sqlalchemy import select, insert, func
+
+from app.migrations import run_migrations
+from config import STARTPOINTS
+from models import create_db_engine, create_async_db_engine, async_session, User, PointsHistory
+from requests import bind_phone
+
+
+def prepare_db(users: int):
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    url = f'sqlite:///{path}'
+    sync_engine = create_db_engine(url)
+    run_migrations(sync_engine)
+    with sync_engine.begin() as conn:
+        conn.execute(insert(User.__table__), [
+            {'tg_id': i, 'referral_code': f'code{i}', 'points_manual': 0, 'points_referral': 0}
+            for i in range(1, users + 1)
+        ])
+        # Записи, заведенные админом по телефону, без tg_id - их будем объединять
+        conn.execute(insert(User.__table__), [
+            {'phone': f'8900{i:07d}', 'referral_code': f'old{i}', 'points_manual': 100, 'points_referral': 0}
+            for i in range(1, users + 1)
+        ])
+        conn.execute(insert(PointsHistory.__table__), [
+            {'user_id': users + i, 'points_type': 'manual', 'points_amount': 100}
+            for i in range(1, users + 1)
+        ])
+    sync_engine.dispose()
+
+    # Все функции requests работают через async_session - переключаем его на временную базу
+    engine = create_async_db_engine(url)
+    async_session.configure(bind=engine)
+    return engine
+
+async def gather_limited(parallel: int, coros):
+    semaphore = asyncio.Semaphore(parallel)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(run(coro) for coro in coros))
+
+async def totals(session):
+    users = User.__table__
+    return (
+        await session.scalar(select(func.count()).select_from(users)),
+        await session.scalar(select(func.sum(users.c.points_manual + users.c.points_referral))),
+        await session.scalar(select(func.sum(PointsHistory.points_amount))),
+    )
+
+async def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    parallel = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    engine = prepare_db(users)
+
+    # 1. Новые номера: приветственные баллы
+    started = time.perf_counter()
+    results = await gather_limited(parallel, (bind_phone(i, f'+7999{i:07d}') for i in range(1, users // 2 + 1)))
+    elapsed = time.perf_counter() - started
+    print(f"новый номер:   {len(results) / elapsed:>6.0f}/с, ошибок: {sum(not ok for ok, _, _ in results)}")
+
+    # 2. Номера старых записей: объединение аккаунтов
+    started = time.perf_counter()
+    results = await gather_limited(parallel, (bind_phone(i, f'8900{i:07d}') for i in range(users // 2 + 1, users + 1)))
+    elapsed = time.perf_counter() - started
+    print(f"объединение:   {len(results) / elapsed:>6.0f}/с, ошибок: {sum(not ok for ok, _, _ in results)}")
+
+    # 3. Один пользователь жмет "поделиться контактом" много раз одновременно
+    results = await asyncio.gather(*(bind_phone(1, '+79990000000') for _ in range(parallel)))
+    welcome = sum(credited for _, _, credited in results)
+    assert welcome == 0, f"повторная привязка начислила {welcome} баллов"
+
+    # 4. Несколько аккаунтов одновременно привязывают один и тот же номер
+    session = async_session()
+    try:
+        count_before, points_before, history_before = await totals(session)
+        contenders = range(users // 2 + 1, users // 2 + 1 + min(parallel, users // 2))
+        results = await asyncio.gather(*(bind_phone(i, '+79995550000') for i in contenders))
+        await session.rollback()
+        count_after, points_after, history_after = await totals(session)
+        owners = await session.scalar(select(func.count()).where(User.phone == '89995550000'))
+    finally:
+        await session.close()
+
+    assert all(ok for ok, _, _ in results), results
+    assert owners == 1, f"номер у {owners} записей"
+    # Каждая привязка, кроме первой, поглотила предыдущего владельца
+    assert count_after == count_before - (len(results) - 1), (count_before, count_after)
+    # Баллы и история сохранились, плюс не больше одного приветственного бонуса
+    assert points_after - points_before == history_after - history_before, 'баланс и история разошлись'
+    assert points_after - points_before in (0, STARTPOINTS), (points_before, points_after)
+    print(f"конкурентность: OK ({len(results)} одновременных привязок одного номера)")
+
+    await engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,45 @@
+"""
+Проверка разбора CSV-выгрузок (app/csv_import.py).
+
+Запуск: python check_csv_import.py
+Базу не трогает - только чтение файлов из памяти.
+
+Проверки:
+  * выгрузка заказов без заголовка с ';' и суммами через запятую
+    ("1234,50") делится по ';', а не по запятой из суммы;
+  * разделители tab и ',' и строка заголовков по-прежнему понимаются;
+  * cp1251 из русского Excel читается так же, как utf-8.
+"""
+from io import BytesIO
+
+from app.csv_import import read_orders_csv, read_users_csv
+
+
+def orders(text: str, encoding: str = 'utf-8') -> list[tuple]:
+    return [
+        (record['phone'], record['order_total'], record['order_id'])
+        for record in read_orders_csv(BytesIO(text.encode(encoding)))
+    ]
+
+
+def main():
+    decimal_comma = "89991234567;1234,50;A1\r\n+7 999 765-43-21;1 234,50;A2\r\n\r\n89990000000;10,00;A3\r\n"
+    assert orders(decimal_comma) == [
+        ('89991234567', '1234,50', 'A1'),
+        ('+7 999 765-43-21', '1 234,50', 'A2'),
+        ('89990000000', '10,00', 'A3'),
+    ], orders(decimal_comma)
+
+    assert orders("телефон;сумма;номер заказа\n89991234567;99,90;B1\n") == [('89991234567', '99,90', 'B1')]
+    assert orders("phone\torder_id\tamount\n89991234567\tC1\t1234,50\n") == [('89991234567', '1234,50', 'C1')]
+    assert orders('89991234567,"1234,50",D1\n') == [('89991234567', '1234,50', 'D1')]
+    assert orders("Телефон;Сумма;Заказ\n89991234567;500,00;E1\n", 'cp1251') == [('89991234567', '500,00', 'E1')]
+
+    users = list(read_users_csv(BytesIO("89991234567;Иван;Петров;100\n".encode())))
+    assert [(user['phone'], user['first_name'], user['points']) for user in users] == [('89991234567', 'Иван', '100')]
+
+    print("OK: разделители и суммы с запятой разобраны верно")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,66 @@ DATABASE_URL = 'sqlite:///bot.app.db'
 REFERRAL_POINTS = 500  # Баллы за приглашение
 NEW_USER_POINTS = 500   # Баллы новому пользователю
 STARTPOINTS = 250 #Приветственные бонусы
+CASHBACK_PERCENT = 5 # Кэшбэк баллами от суммы заказа
+POINTS_EXPIRY_DAYS = 90 # Баллы сгорают через 3 месяца после начисления
 
 
 ADMIN_IDS = [] #tg_id админов
+
+
+# Настройки SQLite, применяются к каждому соединению (ORM и sqlite3)
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',          # читатели не блокируют писателя
+    'synchronous': 'NORMAL',        # fsync только на checkpoint (безопасно в WAL)
+    'mmap_size': 268435456,         # 256 МБ
+    'cache_size': -65536,           # 64 МБ (отрицательное значение - в КБ)
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,           # мс ожидания блокировки вместо "database is locked"
+}
+
+# Кэш профилей пользователей (get_user_data) в памяти процесса
+USER_CACHE_SIZE = 10000  # максимум профилей
+USER_CACHE_TTL = 60      # секунд
+
+# Счетчики для админки (user_stats) - допустимое отставание, секунд
+STATS_CACHE_TTL = 30
+
+# Хранилище состояний FSM в SQLite (app/fsm_storage.py)
+FSM_STATE_TTL = 7 * 24 * 60 * 60  # секунд, брошенные диалоги удаляются
+FSM_FLUSH_INTERVAL = 1.0          # секунд между пакетными записями
+FSM_CACHE_SIZE = 10000            # состояний в памяти, повторные апдейты не читают БД
+
+# Режим получения апдейтов: 'polling' или 'webhook' (app/webhook.py)
+BOT_MODE = 'polling'
+WEBHOOK_BASE_URL = ''            # https://bot.example.com; пусто - set_webhook не вызывается
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_SECRET = ''              # X-Telegram-Bot-Api-Secret-Token; пусто - сгенерируется
+WEBHOOK_HOST = '127.0.0.1'       # слушаем локально, наружу - через reverse proxy
+WEBHOOK_PORT = 8080
+WEBHOOK_MAX_CONCURRENCY = 20     # апдейтов в обработке одновременно
+WEBHOOK_SHUTDOWN_TIMEOUT = 10    # секунд на завершение начатых апдейтов при остановке
+
+# Свой Bot API сервер (telegram-bot-api --local или fake_bot_api.py); пусто - api.telegram.org
+TELEGRAM_API_URL = ''
+
+# Фоновые задачи (app/scheduler.py, app/jobs.py), интервалы в секундах
+SCHEDULER_WORKERS = 2                   # потоков для синхронных задач (sqlite3, файлы)
+SCHEDULER_JITTER = 0.1                  # случайный разброс интервала, доля
+SCHEDULER_SHUTDOWN_TIMEOUT = 30         # секунд на завершение идущих задач при остановке
+POINTS_EXPIRY_INTERVAL = 24 * 60 * 60
+CLEANUP_INTERVAL = None                 # удаление пустых записей и дубликатов: None - только по кнопке и /jobs run
+DB_MAINTENANCE_INTERVAL = 6 * 60 * 60
+BACKUP_INTERVAL = 24 * 60 * 60
+
+# Резервные копии (app/backup.py)
+BACKUP_DIR = 'backups'
+BACKUP_PAGES = 1024              # страниц базы за шаг копирования (4 МБ при странице 4 КБ)
+BACKUP_PAUSE = 0.05              # секунд паузы между шагами - бот успевает писать
+BACKUP_KEEP = 7                  # сколько последних копий хранить
+BACKUP_MAX_AGE_DAYS = 30         # копии старше удаляются
+
+# Рассылки (app/broadcast.py)
+BROADCAST_RATE = 25              # сообщений в секунду на весь бот (лимит Telegram ~30)
+BROADCAST_BATCH_SIZE = 100       # получателей за выборку; прогресс сохраняется после каждой пачки
+BROADCAST_MAX_RETRIES = 3        # повторов при сетевых ошибках и 5xx
+BROADCAST_SHUTDOWN_TIMEOUT = 10  # секунд на досылку текущей пачки при остановке
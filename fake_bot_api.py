@@ -0,0 +1,165 @@
+"""
+Локальный фейковый Bot API для проверки рассылок (app/broadcast.py).
+
+Запуск: python fake_bot_api.py [получателей] [лимит в секунду]
+Работает на временной базе, bot.app.db не трогает.
+
+Сервер принимает sendMessage и, как настоящий Telegram, отвечает 429 с
+retry_after при превышении лимита в секунду на бота или 1 сообщения в
+секунду в один чат, а каждому 50-му чату - 403 (бот заблокирован).
+Рассылка прерывается остановкой бота на середине и продолжается заново;
+в конце проверяется, что каждый чат получил сообщение ровно один раз.
+
+Для ручной проверки сервер можно оставить запущенным
+(python fake_bot_api.py serve) и указать в config.py
+TELEGRAM_API_URL = 'http://127.0.0.1:8081'.
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from collections import Counter, deque
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+from sqlalchemy import insert
+
+import app.broadcast as broadcast
+import app.segments as segments
+from app.migrations import run_migrations
+from models import create_db_engine, create_async_db_engine, User
+
+FAKE_API_HOST = '127.0.0.1'
+FAKE_API_PORT = 8081
+FAKE_TOKEN = '42:fake'
+BLOCKED_EVERY = 50  # каждый N-й чат "заблокировал бота"
+
+
+class FakeBotAPI:
+    def __init__(self, global_rate: int):
+        self.global_rate = global_rate
+        self.recent = deque()  # время последних принятых сообщений
+        self.last_by_chat = {}
+        self.delivered = Counter()  # chat_id -> сколько сообщений получил
+        self.responses = Counter()  # код ответа -> сколько
+
+    def reply(self, status: int, payload: dict) -> web.Response:
+        self.responses[status] += 1
+        return web.json_response(payload, status=status)
+
+    def too_many(self, retry_after: int) -> web.Response:
+        return self.reply(429, {
+            'ok': False, 'error_code': 429,
+            'description': f'Too Many Requests: retry after {retry_after}',
+            'parameters': {'retry_after': retry_after},
+        })
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if request.match_info['method'].lower() != 'sendmessage':
+            return self.reply(200, {'ok': True, 'result': True})
+
+        form = await request.post()
+        chat_id = int(form['chat_id'])
+        now = time.monotonic()
+
+        while self.recent and now - self.recent[0] >= 1:
+            self.recent.popleft()
+        if len(self.recent) >= self.global_rate:
+            return self.too_many(1)
+        if now - self.last_by_chat.get(chat_id, float('-inf')) < 1:
+            return self.too_many(1)
+        if chat_id % BLOCKED_EVERY == 0:
+            return self.reply(403, {
+                'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'
+            })
+
+        self.recent.append(now)
+        self.last_by_chat[chat_id] = now
+        self.delivered[chat_id] += 1
+        return self.reply(200, {'ok': True, 'result': {
+            'message_id': sum(self.delivered.values()),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': form.get('text', ''),
+        }})
+
+    async def start(self) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, FAKE_API_HOST, FAKE_API_PORT).start()
+        return runner
+
+
+def prepare_db(recipients: int):
+    path = os.path.join(tempfile.mkdtemp(), 'broadcast.db')
+    url = f'sqlite:///{path}'
+    sync_engine = create_db_engine(url)
+    run_migrations(sync_engine)
+    with sync_engine.begin() as conn:
+        conn.execute(insert(User.__table__), [
+            {'tg_id': 1000 + i, 'referral_code': f'code{i}', 'points_manual': 0, 'points_referral': 0}
+            for i in range(recipients)
+        ])
+        # Клиенты, заведенные по телефону без Telegram, рассылку не получают
+        conn.execute(insert(User.__table__), [
+            {'phone': f'8900{i:07d}', 'referral_code': f'old{i}', 'points_manual': 0, 'points_referral': 0}
+            for i in range(recipients // 10)
+        ])
+    sync_engine.dispose()
+
+    # app.broadcast и app.segments работают через models.async_engine - подменяем на временную базу
+    engine = create_async_db_engine(url)
+    broadcast.async_engine = segments.async_engine = engine
+    return engine
+
+async def main():
+    recipients = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 600
+    global_rate = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    api = FakeBotAPI(global_rate)
+    runner = await api.start()
+
+    if sys.argv[1:2] == ['serve']:
+        print(f"Фейковый Bot API: http://{FAKE_API_HOST}:{FAKE_API_PORT}, Ctrl+C для остановки")
+        await asyncio.Event().wait()
+
+    engine = prepare_db(recipients)
+    session = AiohttpSession(api=TelegramAPIServer.from_base(f'http://{FAKE_API_HOST}:{FAKE_API_PORT}'))
+    bot = Bot(token=FAKE_TOKEN, session=session)
+
+    broadcast_id = await broadcast.create_broadcast('<b>+1000 баллов</b> всем клиентам!')
+    started = time.perf_counter()
+
+    # Половина рассылки, затем "перезапуск бота"
+    broadcast.start_broadcast(bot, broadcast_id)
+    await asyncio.sleep(recipients / global_rate / 2)
+    await broadcast.stop_broadcasts()
+    interrupted = await broadcast.get_broadcast(broadcast_id)
+    print(f"остановка: status={interrupted.status}, курсор users.id={interrupted.last_user_id}")
+
+    await broadcast.resume_broadcasts(bot)
+    await asyncio.gather(*broadcast._tasks.values())
+    elapsed = time.perf_counter() - started
+
+    result = await broadcast.get_broadcast(broadcast_id)
+    print(broadcast.format_broadcast(result))
+    print(f"ответы API: {dict(api.responses)}, всего {elapsed:.1f} с")
+
+    blocked = sum(1 for i in range(recipients) if (1000 + i) % BLOCKED_EVERY == 0)
+    assert result.status == 'done', result.status
+    assert result.sent == recipients - blocked and result.blocked == blocked, (result.sent, result.blocked)
+    assert len(api.delivered) == recipients - blocked, len(api.delivered)
+    assert max(api.delivered.values()) == 1, 'повторная доставка после перезапуска'
+    print("OK: каждый чат получил сообщение один раз")
+
+    await bot.session.close()
+    await runner.cleanup()
+    await engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
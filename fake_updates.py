@@ -0,0 +1,72 @@
+"""
+Локальный генератор апдейтов Telegram для проверки режима вебхука.
+
+Запуск бота: BOT_MODE = 'webhook' в config.py, python main.py
+Запуск генератора: python fake_updates.py [апдейтов] [параллельно] [секрет]
+
+Шлет фейковые /start на http://WEBHOOK_HOST:WEBHOOK_PORT/WEBHOOK_PATH с
+заголовком X-Telegram-Bot-Api-Secret-Token и печатает статусы и задержку
+ответа вебхука. Ответы бота в Telegram при фейковом токене не дойдут,
+это нормально - проверяется прием и обработка апдейтов.
+"""
+import asyncio
+import sys
+import time
+from collections import Counter
+
+from aiohttp import ClientSession
+
+from config import WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET
+
+
+def make_update(update_id: int) -> dict:
+    user_id = 10_000_000 + update_id
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private', 'first_name': f'Test{update_id}'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'Test{update_id}'},
+            'text': '/start',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        },
+    }
+
+async def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    parallel = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    secret = sys.argv[3] if len(sys.argv) > 3 else WEBHOOK_SECRET
+
+    url = f'http://{WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}'
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+    statuses = Counter()
+    latencies = []
+    queue = asyncio.Queue()
+    for update_id in range(1, total + 1):
+        queue.put_nowait(update_id)
+
+    async def worker(session):
+        while not queue.empty():
+            update_id = queue.get_nowait()
+            started = time.perf_counter()
+            async with session.post(url, json=make_update(update_id), headers=headers) as response:
+                await response.read()
+                statuses[response.status] += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    async with ClientSession() as session:
+        await asyncio.gather(*(worker(session) for _ in range(parallel)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"{total} апдейтов за {elapsed:.2f} с ({total / elapsed:.0f}/с), статусы: {dict(statuses)}")
+    print(
+        f"задержка ответа: p50 {latencies[len(latencies) // 2] * 1000:.1f} мс, "
+        f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f} мс"
+    )
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,22 +1,50 @@
 import asyncio
 import logging
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 
 from app.handlers import router as main_router
 from app.admin_handlers import router as admin_router  # Импортируем админ-роутер
-from config import TOKEN
+from app.migrations import run_migrations
+from app.fsm_storage import SQLiteStorage
+from app.webhook import run_webhook
+from app.metrics import setup_latency_metrics
+from app.broadcast import resume_broadcasts, stop_broadcasts
+from app.jobs import setup_jobs
+from config import TOKEN, BOT_MODE, TELEGRAM_API_URL
 
 async def main():
-    bot = Bot(token=TOKEN)
-    storage = MemoryStorage()
+    # Создаем/обновляем схему БД до запуска обработки апдейтов
+    run_migrations()
+    
+    session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+    bot = Bot(token=TOKEN, session=session)
+    # Состояния FSM хранятся в БД и переживают перезапуск
+    storage = SQLiteStorage()
     dp = Dispatcher(storage=storage)
+    dp.shutdown.register(storage.close)
+    # Рассылки, прерванные перезапуском, продолжаются с сохраненного места
+    dp.startup.register(resume_broadcasts)
+    dp.shutdown.register(stop_broadcasts)
+    # Периодическое обслуживание (сгорание баллов, очистка, SQLite) - в фоне,
+    # вне обработки апдейтов; состояние задач - админ-команда /jobs
+    scheduler = setup_jobs()
+    dp.startup.register(scheduler.start)
+    dp.shutdown.register(scheduler.stop)
     
     # Подключаем оба роутера
     dp.include_router(main_router)
     dp.include_router(admin_router)  # Подключаем админ-роутер
     
-    await dp.start_polling(bot)
+    # Время ответа каждого обработчика (админ-команда /latency)
+    setup_latency_metrics(main_router)
+    setup_latency_metrics(admin_router)
+    
+    if BOT_MODE == 'webhook':
+        await run_webhook(dp, bot)
+    else:
+        await dp.start_polling(bot)
 
 if __name__ == '__main__':
     logging.basicConfig(
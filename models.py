@@ -1,9 +1,14 @@
-from sqlalchemy import create_engine, Column, Integer, String, BigInteger, ForeignKey, Boolean, Text, DateTime
+from sqlalchemy import create_engine, event, func, literal_column, Column, Integer, String, BigInteger, ForeignKey, Boolean, Text, DateTime, Float, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 import sqlite3
+from dataclasses import dataclass, fields
 from datetime import datetime
 
+from config import DATABASE_URL, SQLITE_PRAGMAS
+
 Base = declarative_base()
 
 class User(Base):
@@ -36,6 +41,7 @@ class PointsHistory(Base):
     points_amount = Column(Integer)
     description = Column(String(255), nullable=True)  # Описание начисления
     created_at = Column(DateTime, default=datetime.now)
+    order_id = Column(String(64), nullable=True)  # Заказ, за который начислен кэшбэк
     
     # Связь с пользователем
     user = relationship('User', backref='points_history')
@@ -60,7 +66,162 @@ class SupportTicket(Base):
     created_at = Column(DateTime, default=datetime.now)
     answered_at = Column(DateTime, nullable=True)
 
-# Создание таблиц
-engine = create_engine('sqlite:///bot.app.db')
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
\ No newline at end of file
+class FSMRecord(Base):
+    __tablename__ = 'fsm_states'
+    
+    key = Column(String(255), primary_key=True)  # bot:chat:user:thread:business:destiny
+    state = Column(String(255), nullable=True)
+    data = Column(Text, nullable=True)  # JSON
+    updated_at = Column(DateTime, default=datetime.now, index=True)
+
+class UserStats(Base):
+    """Счетчики по таблице users, одна строка; ведутся триггерами (миграция 6)"""
+    __tablename__ = 'user_stats'
+    
+    id = Column(Integer, primary_key=True)
+    total_users = Column(Integer, default=0, nullable=False)
+    users_with_phone = Column(Integer, default=0, nullable=False)
+    users_with_tg = Column(Integer, default=0, nullable=False)
+    empty_users = Column(Integer, default=0, nullable=False)  # без телефона и без tg_id
+    total_points = Column(Integer, default=0, nullable=False)
+
+class PointsDaily(Base):
+    """Начисления по дням и типам баллов; ведется триггерами (миграция 7)"""
+    __tablename__ = 'points_daily'
+    
+    day = Column(String(10), primary_key=True)  # YYYY-MM-DD
+    points_type = Column(String(20), primary_key=True)
+    total = Column(Integer, default=0, nullable=False)
+    count = Column(Integer, default=0, nullable=False)
+
+class Broadcast(Base):
+    """Рассылка админа; по курсору last_user_id продолжается после перезапуска"""
+    __tablename__ = 'broadcasts'
+    
+    id = Column(Integer, primary_key=True)
+    text = Column(Text, nullable=False)  # HTML
+    segment = Column(Text, nullable=True)  # условия app/segments.py; пусто - все пользователи
+    status = Column(String(20), default='running', nullable=False)  # running, paused, done, cancelled
+    created_by = Column(BigInteger, nullable=True)  # tg_id админа
+    total = Column(Integer, default=0, nullable=False)  # получателей на момент запуска
+    last_user_id = Column(Integer, default=0, nullable=False)  # users.id последнего обработанного
+    sent = Column(Integer, default=0, nullable=False)
+    blocked = Column(Integer, default=0, nullable=False)  # бот заблокирован или аккаунт удален
+    failed = Column(Integer, default=0, nullable=False)
+    elapsed = Column(Float, default=0, nullable=False)  # секунд отправки, для скорости
+    created_at = Column(DateTime, default=datetime.now)
+    finished_at = Column(DateTime, nullable=True)
+
+class JobState(Base):
+    """Состояние фоновых задач: курсор инкрементальной обработки, время запуска"""
+    __tablename__ = 'job_state'
+    
+    name = Column(String(50), primary_key=True)
+    cursor = Column(String(64), nullable=True)  # до чего обработано, формат задает задача
+    last_run_at = Column(DateTime, nullable=True)
+
+# ========== ЛЕГКИЕ ОБЪЕКТЫ ДЛЯ ЧТЕНИЯ ==========
+# Строятся напрямую из кортежей колонок, без ORM-гидратации и identity map.
+# Порядок полей совпадает с порядком колонок в select(*columns_of(...)).
+
+@dataclass(frozen=True, slots=True)
+class UserInfo:
+    id: int
+    tg_id: int
+    first_name: str
+    last_name: str
+    username: str
+    phone: str
+    referral_code: str
+    points_referral: int
+    points_manual: int
+    invited_by: str
+    last_manual_points_update: datetime
+    last_referral_points_update: datetime
+
+    def get_total_points(self):
+        return (self.points_referral or 0) + (self.points_manual or 0)
+
+@dataclass(frozen=True, slots=True)
+class PointsRecord:
+    id: int
+    user_id: int
+    points_type: str
+    points_amount: int
+    description: str
+    created_at: datetime
+
+@dataclass(frozen=True, slots=True)
+class UserListItem:
+    """Строка списка пользователей в админке - только выводимые поля"""
+    id: int
+    first_name: str
+    last_name: str
+    phone: str
+    referral_code: str
+    points_referral: int
+    points_manual: int
+
+    def get_total_points(self):
+        return (self.points_referral or 0) + (self.points_manual or 0)
+
+def columns_of(info_class, model):
+    """Колонки модели для полей легкого объекта"""
+    return [getattr(model, field.name) for field in fields(info_class)]
+
+USER_INFO_COLUMNS = columns_of(UserInfo, User)
+POINTS_RECORD_COLUMNS = columns_of(PointsRecord, PointsHistory)
+USER_LIST_COLUMNS = columns_of(UserListItem, User)
+
+# Индексы для частых выборок (создаются миграциями в app/migrations.py)
+Index('ix_users_invited_by', User.invited_by)
+# Сумма баллов. Условия по баллам должны использовать ровно это выражение
+# (с константой 0, а не параметром), иначе SQLite не возьмет индекс по нему -
+# ix_users_total_points, создается миграцией 9 (USERS_TOTAL_POINTS_INDEX)
+USER_TOTAL_POINTS = (func.coalesce(User.points_manual, literal_column('0'))
+                     + func.coalesce(User.points_referral, literal_column('0')))
+Index('ix_points_history_user_created', PointsHistory.user_id, PointsHistory.created_at.desc())
+Index('ix_points_history_created_at', PointsHistory.created_at)
+Index('ux_points_history_order_id', PointsHistory.order_id, unique=True,
+      sqlite_where=PointsHistory.order_id.isnot(None))
+Index('ix_referrals_referrer_code', Referral.referrer_code)
+Index('ix_support_tickets_group_message_id', SupportTicket.group_message_id)
+Index('ix_support_tickets_user_created', SupportTicket.user_id, SupportTicket.created_at.desc())
+
+# ========== ПОДКЛЮЧЕНИЕ К БД ==========
+
+DATABASE_PATH = make_url(DATABASE_URL).database
+
+def apply_sqlite_pragmas(dbapi_connection, pragmas: dict = None):
+    """Применить профиль настроек SQLite к соединению"""
+    pragmas = SQLITE_PRAGMAS if pragmas is None else pragmas
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+def create_db_engine(url: str = DATABASE_URL, pragmas: dict = None):
+    """Синхронный движок с профилем настроек SQLite"""
+    db_engine = create_engine(url)
+    event.listen(db_engine, 'connect', lambda conn, record: apply_sqlite_pragmas(conn, pragmas))
+    return db_engine
+
+def create_async_db_engine(url: str = DATABASE_URL, pragmas: dict = None):
+    """Асинхронный (aiosqlite) движок с профилем настроек SQLite"""
+    db_engine = create_async_engine(make_url(url).set(drivername='sqlite+aiosqlite'))
+    event.listen(db_engine.sync_engine, 'connect', lambda conn, record: apply_sqlite_pragmas(conn, pragmas))
+    return db_engine
+
+def connect_sqlite(path: str = DATABASE_PATH, pragmas: dict = None) -> sqlite3.Connection:
+    """Прямое sqlite3-соединение с тем же профилем настроек"""
+    conn = sqlite3.connect(path)
+    apply_sqlite_pragmas(conn, pragmas)
+    return conn
+
+# Таблицы создаются и обновляются через app/migrations.py (run_migrations)
+engine = create_db_engine()
+Session = sessionmaker(bind=engine)
+
+# Асинхронный движок для хендлеров (aiosqlite), чтобы запросы к БД не блокировали event loop
+async_engine = create_async_db_engine()
+async_session = async_sessionmaker(async_engine, expire_on_commit=False)
\ No newline at end of file
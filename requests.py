@@ -1,15 +1,25 @@
+from sqlalchemy import (select, delete, update, insert, func, bindparam, text, case, or_, literal_column,
+                        table as sql_table, column as sql_column)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.exc import IntegrityError
-from models import Session, User, Referral, SupportTicket, PointsHistory
+from models import (async_session, connect_sqlite, User, Referral, SupportTicket, PointsHistory,
+                    UserInfo, PointsRecord, UserListItem, USER_INFO_COLUMNS, POINTS_RECORD_COLUMNS,
+                    USER_LIST_COLUMNS, UserStats, PointsDaily, JobState)
+from app.cache import user_cache, stats_cache
+from app.phones import normalize_phone, normalize_phones, phone_digits
+from app.backup import create_backup, format_backup_result
+import asyncio
 import secrets
 import string
 import logging
-from datetime import datetime
-import sqlite3
+from datetime import datetime, date, timedelta
+from decimal import Decimal, InvalidOperation
+from collections import defaultdict
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-from config import REFERRAL_POINTS, STARTPOINTS, NEW_USER_POINTS
+from config import REFERRAL_POINTS, STARTPOINTS, NEW_USER_POINTS, CASHBACK_PERCENT, POINTS_EXPIRY_DAYS
 
 
 def generate_referral_code(length=8):
@@ -17,152 +27,226 @@ def generate_referral_code(length=8):
     alphabet = string.ascii_letters + string.digits
     return ''.join(secrets.choice(alphabet) for _ in range(length))
 
-def get_or_create_user(tg_id: int, first_name: str = None, last_name: str = None, 
-                       username: str = None, phone: str = None, referrer_code: str = None):
+REFERRAL_CODE_ATTEMPTS = 5
+
+async def insert_user(session, **values) -> tuple[int, str]:
+    """
+    INSERT нового пользователя со свободным реферальным кодом (без commit).
+    Код заранее не проверяется: при совпадении ON CONFLICT DO NOTHING ничего
+    не вставит, и попытка повторится с новым кодом.
+    Возвращает (id, referral_code)
+    """
+    users = User.__table__
+    for _ in range(REFERRAL_CODE_ATTEMPTS):
+        referral_code = generate_referral_code()
+        user_id = await session.scalar(
+            sqlite_insert(users)
+            .values(referral_code=referral_code, **values)
+            .on_conflict_do_nothing(index_elements=[users.c.referral_code])
+            .returning(users.c.id)
+        )
+        if user_id is not None:
+            return user_id, referral_code
+    raise RuntimeError("Не удалось подобрать свободный реферальный код")
+
+async def allocate_referral_codes(session, count: int, chunk_size: int = 500) -> list[str]:
+    """Пул свободных реферальных кодов для массового создания: один SELECT на пачку кодов"""
+    codes = set()
+    while len(codes) < count:
+        candidates = {generate_referral_code() for _ in range(min(count - len(codes), chunk_size))} - codes
+        taken = set((await session.scalars(
+            select(User.referral_code).where(User.referral_code.in_(candidates))
+        )).all())
+        codes |= candidates - taken
+    return list(codes)
+
+async def get_or_create_user(tg_id: int, first_name: str = None, last_name: str = None, 
+                             username: str = None, phone: str = None, referrer_code: str = None):
     """Получить или создать пользователя"""
-    session = Session()
+    # Повторный /start: профиль в кэше и дополнять нечего - БД не трогаем
+    cached = user_cache.get(tg_id)
+    if cached and not _profile_needs_update(cached, first_name, last_name, username, phone):
+        return cached['id']
+    
+    session = async_session()
     try:
         # Пытаемся найти пользователя по tg_id
-        user = session.query(User).filter(User.tg_id == tg_id).first()
+        user = await session.scalar(select(User).where(User.tg_id == tg_id))
         
         if user:
             # Обновляем данные если они переданы
-            if first_name and not user.first_name:
-                user.first_name = first_name
-            if last_name and not user.last_name:
-                user.last_name = last_name
-            if username and not user.username:
-                user.username = username
-            if phone and not user.phone:
-                user.phone = phone
-                session.commit()
+            if _profile_needs_update(_user_snapshot(user), first_name, last_name, username, phone):
+                if first_name and not user.first_name:
+                    user.first_name = first_name
+                if last_name and not user.last_name:
+                    user.last_name = last_name
+                if username and not user.username:
+                    user.username = username
+                if phone and not user.phone:
+                    user.phone = phone
+                await session.commit()
+                user_cache.invalidate_user(tg_id=tg_id)
             return user.id
         
-        # Создаем нового пользователя
-        referral_code = generate_referral_code()
-        while session.query(User).filter(User.referral_code == referral_code).first():
-            referral_code = generate_referral_code()
-        
-        user = User(
+        # Создаем нового пользователя (один INSERT, код подбирается в insert_user)
+        user_id, _ = await insert_user(
+            session,
             tg_id=tg_id,
             first_name=first_name,
             last_name=last_name,
             username=username,
             phone=phone,
-            referral_code=referral_code,
             invited_by=referrer_code
         )
         
-        session.add(user)
-        session.commit()
-        
-        # Если есть реферер, начисляем баллы через add_points_with_history
+        # Если есть реферер, начисляем баллы в той же транзакции
+        referrer_id = None
         if referrer_code:
-            award_referral_points(referrer_code, tg_id)
+            referrer_id = await _award_referral(session, referrer_code, user_id, phone or first_name, phone)
         
-        return user.id
+        await session.commit()
+        if referrer_id:
+            user_cache.invalidate_user(user_id=referrer_id)
+        return user_id
         
     except IntegrityError as e:
-        session.rollback()
+        await session.rollback()
         logger.error(f"IntegrityError in get_or_create_user: {e}")
         
         # Если ошибка из-за дублирования телефона
         if phone:
             try:
                 # Пытаемся найти пользователя по телефону
-                user_by_phone = session.query(User).filter(User.phone == phone).first()
+                user_by_phone = await session.scalar(select(User).where(User.phone == phone))
                 if user_by_phone:
                     # Если нашли по телефону, привязываем к этому Telegram ID
                     user_by_phone.tg_id = tg_id
-                    session.commit()
+                    await session.commit()
+                    user_cache.invalidate_user(tg_id=tg_id)
                     return user_by_phone.id
             except Exception as inner_e:
-                session.rollback()
+                await session.rollback()
                 logger.error(f"Error handling duplicate phone: {inner_e}")
         
         return None
     except Exception as e:
-        session.rollback()
+        await session.rollback()
         logger.error(f"Error in get_or_create_user: {e}")
         return None
     finally:
-        session.close()
+        await session.close()
+
+
+async def _fetch_user_infos(session, query) -> list[UserInfo]:
+    """Выполнить select(*USER_INFO_COLUMNS) и собрать UserInfo из кортежей"""
+    result = await session.execute(query)
+    return [UserInfo(*row) for row in result]
 
+async def _fetch_user_info(session, *conditions):
+    users = await _fetch_user_infos(session, select(*USER_INFO_COLUMNS).where(*conditions).limit(1))
+    return users[0] if users else None
 
-def get_user_by_phone(phone: str):
+async def get_user_by_phone(phone: str):
     """Найти пользователя по номеру телефона"""
-    session = Session()
+    phone = normalize_phone(phone)
+    if phone is None:
+        return None
+    
+    session = async_session()
     try:
-        return session.query(User).filter(User.phone == phone).first()
+        return await _fetch_user_info(session, User.phone == phone)
     finally:
-        session.close()
+        await session.close()
 
-def get_user_by_tg_id(tg_id: int):
+async def get_user_by_tg_id(tg_id: int):
     """Найти пользователя по Telegram ID"""
-    session = Session()
+    session = async_session()
     try:
-        return session.query(User).filter(User.tg_id == tg_id).first()
+        return await _fetch_user_info(session, User.tg_id == tg_id)
     finally:
-        session.close()
+        await session.close()
+
+async def _award_referral(session, referrer_code: str, referred_id: int, referred_label: str = None,
+                          referred_phone: str = None):
+    """Начисления за реферала в рамках переданной сессии (без commit), возвращает id реферера"""
+    referrer_id = await session.scalar(select(User.id).where(User.referral_code == referrer_code))
+    if referrer_id is None:
+        return None
+    
+    now = datetime.now()
+    
+    # Начисляем рефереру
+    await apply_points(
+        session,
+        referrer_id,
+        'referral',
+        REFERRAL_POINTS,
+        f'Реферал: {referred_label}',
+        now
+    )
+    
+    # Начисляем новому пользователю
+    await apply_points(
+        session,
+        referred_id,
+        'referral',
+        NEW_USER_POINTS,
+        f'Приветственные за регистрацию по реф. ссылке',
+        now
+    )
+    
+    # Создаем запись о реферале
+    session.add(Referral(
+        referrer_code=referrer_code,
+        referred_phone=referred_phone,
+        points_awarded=100
+    ))
+    return referrer_id
 
-def award_referral_points(referrer_code: str, referred_tg_id: int):
-    """Начислить баллы за реферала с историей"""
-    session = Session()
+async def award_referral_points(referrer_code: str, referred_tg_id: int):
+    """Начислить баллы за реферала с историей (одной транзакцией)"""
+    session = async_session()
     try:
-        referrer = session.query(User).filter(User.referral_code == referrer_code).first()
-        referred = session.query(User).filter(User.tg_id == referred_tg_id).first()
-        
-        if referrer and referred:
-            # Начисляем рефереру
-            add_points_with_history(
-                referrer.id,
-                'referral',
-                REFERRAL_POINTS,
-                f'Реферал: {referred.phone or referred.first_name}'
-            )
-            
-            # Начисляем новому пользователю
-            add_points_with_history(
-                referred.id,
-                'referral',
-                NEW_USER_POINTS,
-                f'Приветственные за регистрацию по реф. ссылке'
-            )
-            
-            # Создаем запись о реферале
-            referral = Referral(
-                referrer_code=referrer_code,
-                referred_phone=referred.phone,
-                points_awarded=100
-            )
-            session.add(referral)
-            session.commit()
+        referred = await session.scalar(select(User).where(User.tg_id == referred_tg_id))
+        if not referred:
+            return False
+        
+        referrer_id = await _award_referral(
+            session, referrer_code, referred.id, referred.phone or referred.first_name, referred.phone
+        )
+        if referrer_id:
+            await session.commit()
+            user_cache.invalidate_user(tg_id=referred_tg_id, user_id=referrer_id)
             return True
         return False
     except Exception as e:
-        session.rollback()
+        await session.rollback()
         logger.error(f"Error in award_referral_points: {e}")
         return False
     finally:
-        session.close()
+        await session.close()
 
-def add_welcome_bonus(user_id: int):
+async def add_welcome_bonus(user_id: int):
     """Добавить приветственные 250 баллов с историей"""
-    return add_points_with_history(
+    return await add_points_with_history(
         user_id,
         'welcome',
         250,
         'Приветственные баллы за привязку телефона'
     )
 
-def add_manual_points(phone: str, points: int):
+async def add_manual_points(phone: str, points: int):
     """Добавить баллы вручную"""
-    session = Session()
+    phone = normalize_phone(phone)
+    if phone is None:
+        return False
+    
+    session = async_session()
     try:
-        user = session.query(User).filter(User.phone == phone).first()
+        user = await session.scalar(select(User).where(User.phone == phone))
         if user:
             # Используем add_points_with_history вместо прямого изменения
-            return add_points_with_history(
+            return await add_points_with_history(
                 user.id,
                 'manual',
                 points,
@@ -170,445 +254,179 @@ def add_manual_points(phone: str, points: int):
             )
         return False
     except Exception as e:
-        session.rollback()
+        await session.rollback()
         logger.error(f"Error in add_manual_points: {e}")
         return False
     finally:
-        session.close()
+        await session.close()
+
+async def _begin_immediate(session):
+    """
+    Открывает транзакцию с блокировкой записи сразу (BEGIN IMMEDIATE):
+    параллельные привязки одного номера выполняются по очереди и видят
+    результат друг друга, а не падают на апгрейде блокировки
+    """
+    await session.execute(text("BEGIN IMMEDIATE"))
 
-def update_phone_with_welcome_bonus(tg_id: int, phone: str) -> tuple[bool, str, int]:
-    """Обновляет телефон с начислением приветственных баллов и историей"""
-    session = Session()
+async def bind_phone(tg_id: int, phone: str) -> tuple[bool, str, int]:
+    """
+    Привязка телефона к пользователю одной транзакцией.
+    Если номер уже принадлежит другой записи - аккаунты объединяются:
+    баллы и история переносятся на текущего пользователя, старая запись
+    удаляется. За первый телефон начисляются приветственные баллы.
+    Возвращает (успех, сообщение, начислено/перенесено баллов)
+    """
+    phone = normalize_phone(phone)
+    if phone is None:
+        return False, "❌ Неверный формат номера", 0
+    
+    users = User.__table__
+    session = async_session()
     try:
-        # Нормализация
-        if phone.startswith('+'):
-            phone = '8' + phone[2:]
-        elif phone.startswith('7'):
-            phone = '8' + phone[1:]
-        
-        if len(phone) != 11:
-            return False, "❌ Неверный формат номера", 0
-        
-        # Находим пользователя
-        user = session.query(User).filter(User.tg_id == tg_id).first()
-        if not user:
+        await _begin_immediate(session)
+        
+        # 1. Текущий пользователь (кто вводит номер)
+        current = (await session.execute(
+            select(users.c.id, users.c.phone).where(users.c.tg_id == tg_id)
+        )).first()
+        if current is None:
+            await session.rollback()
             return False, "❌ Пользователь не найден", 0
         
-        # Проверяем существование телефона
-        existing = session.query(User).filter(User.phone == phone).first()
+        if current.phone == phone:
+            await session.rollback()
+            return True, "✅ Этот номер уже привязан к вашему аккаунту", 0
         
-        welcome_bonus = 0
+        # 2. Прежний владелец номера
+        old = (await session.execute(
+            select(users).where(users.c.phone == phone, users.c.id != current.id)
+        )).first()
         
-        if existing and existing.id != user.id:
-            # Переносим все от существующего пользователя
-            # Переносим баллы с историей через add_points_with_history
-            if existing.points_manual > 0:
-                add_points_with_history(
-                    user.id,
-                    'manual',
-                    existing.points_manual,
-                    f'Перенос баллов от старого аккаунта {existing.phone}'
-                )
-            
-            if existing.points_referral > 0:
-                add_points_with_history(
-                    user.id,
-                    'referral',
-                    existing.points_referral,
-                    f'Перенос реферальных баллов от старого аккаунта'
-                )
-            
-            # Удаляем старого
-            session.delete(existing)
+        now = datetime.now()
+        values = {'phone': phone}
+        credited = 0
+        
+        if old is not None:
+            # 3. Объединение: история переходит целиком, баллы - одним UPDATE
+            await session.execute(
+                update(PointsHistory.__table__)
+                .where(PointsHistory.user_id == old.id)
+                .values(user_id=current.id)
+            )
+            # Старую запись удаляем до UPDATE - освобождаем уникальные phone и referral_code
+            await session.execute(delete(users).where(users.c.id == old.id))
             
-            msg = f"✅ Аккаунт объединен! Перенесено {existing.get_total_points()} баллов"
-        
-        elif user.phone is None:
-            # Первый телефон - начисляем приветственные через add_welcome_bonus
-            add_welcome_bonus(user.id)
-            welcome_bonus = 250
-            msg = "✅ Номер привязан! 🎉 +250 приветственных баллов!"
+            old_manual = old.points_manual or 0
+            old_referral = old.points_referral or 0
+            credited = old_manual + old_referral
+            values.update({
+                'points_manual': func.coalesce(users.c.points_manual, 0) + old_manual,
+                'points_referral': func.coalesce(users.c.points_referral, 0) + old_referral,
+                'first_name': func.coalesce(users.c.first_name, old.first_name),
+                'last_name': func.coalesce(users.c.last_name, old.last_name),
+                'referral_code': func.coalesce(users.c.referral_code, old.referral_code),
+                'invited_by': func.coalesce(users.c.invited_by, old.invited_by),
+            })
+            if old_manual:
+                values['last_manual_points_update'] = now
+            if old_referral:
+                values['last_referral_points_update'] = now
+            msg = f"✅ Найден старый аккаунт! Перенесено {credited} баллов"
+        
+        elif current.phone is None:
+            # 4. Первый телефон - приветственные баллы с записью в историю
+            await apply_points(session, current.id, 'welcome', STARTPOINTS,
+                               'Приветственные баллы за привязку телефона', now)
+            credited = STARTPOINTS
+            msg = f"✅ Номер привязан! 🎉 +{STARTPOINTS} приветственных баллов!"
         
         else:
-            # Просто меняем телефон
             msg = "✅ Номер телефона изменен"
         
-        # Сохраняем телефон
-        user.phone = phone
-        session.commit()
+        # 5. Привязываем телефон
+        await session.execute(update(users).where(users.c.id == current.id).values(values))
+        await session.commit()
         
-        return True, msg, welcome_bonus
+        user_cache.invalidate_user(tg_id=tg_id, user_id=old.id if old is not None else None)
+        if old is not None and old.tg_id is not None:
+            user_cache.invalidate_user(tg_id=old.tg_id)
+        return True, msg, credited
         
+    except IntegrityError as e:
+        await session.rollback()
+        logger.error(f"IntegrityError in bind_phone: {e}")
+        return False, "❌ Номер уже используется, попробуйте еще раз", 0
     except Exception as e:
-        session.rollback()
+        await session.rollback()
+        logger.error(f"Error in bind_phone: {e}")
         return False, f"❌ Ошибка: {str(e)[:50]}", 0
     finally:
-        session.close()
+        await session.close()
 
-def user_has_phone(tg_id: int) -> bool:
+async def user_has_phone(tg_id: int) -> bool:
     """Проверяет, есть ли у пользователя телефон"""
-    session = Session()
-    try:
-        user = session.query(User).filter(User.tg_id == tg_id).first()
-        return user is not None and user.phone is not None
-    finally:
-        session.close()
-
-def update_user_phone_simple(tg_id: int, phone: str) -> tuple[bool, str, int]:
-    """Обновление телефона с обработкой объединения аккаунтов"""
-    session = Session()
-    try:
-        # Нормализация номера
-        if phone.startswith('+'):
-            phone = '8' + phone[2:]
-        elif phone.startswith('7'):
-            phone = '8' + phone[1:]
-        
-        if len(phone) != 11 or not phone.isdigit():
-            return False, "❌ Неверный формат номера", 0
-        
-        # Находим текущего пользователя
-        current_user = session.query(User).filter(User.tg_id == tg_id).first()
-        if not current_user:
-            return False, "❌ Пользователь не найден", 0
-        
-        # Проверяем, был ли у пользователя уже телефон
-        is_first_phone = current_user.phone is None
-        
-        # Находим существующего владельца этого телефона (если есть)
-        existing_user = session.query(User).filter(User.phone == phone).first()
-        
-        transferred_points = 0
-        welcome_bonus = 0
-        
-        if existing_user:
-            # СИТУАЦИЯ 1: Телефон уже есть в БД у другого пользователя
-            if existing_user.id != current_user.id:
-                # 1. Переносим баллы через add_points_with_history
-                if existing_user.points_manual > 0:
-                    add_points_with_history(
-                        current_user.id,
-                        'manual',
-                        existing_user.points_manual,
-                        f'Перенос ручных баллов от аккаунта {existing_user.phone}'
-                    )
-                    transferred_points += existing_user.points_manual
-                
-                if existing_user.points_referral > 0:
-                    add_points_with_history(
-                        current_user.id,
-                        'referral',
-                        existing_user.points_referral,
-                        f'Перенос реферальных баллов от аккаунта {existing_user.phone}'
-                    )
-                    transferred_points += existing_user.points_referral
-                
-                # 2. Переносим имя/фамилию (если у текущего нет)
-                if not current_user.first_name and existing_user.first_name:
-                    current_user.first_name = existing_user.first_name
-                if not current_user.last_name and existing_user.last_name:
-                    current_user.last_name = existing_user.last_name
-                
-                # 3. Переносим реферальный код (если у текущего нет)
-                if not current_user.referral_code and existing_user.referral_code:
-                    current_user.referral_code = existing_user.referral_code
-                
-                # 4. Переносим кто пригласил (если у текущего нет)
-                if not current_user.invited_by and existing_user.invited_by:
-                    current_user.invited_by = existing_user.invited_by
-                
-                # 5. Удаляем старого пользователя из БД
-                session.delete(existing_user)
-                
-                message = f"✅ Найден старый аккаунт! Перенесено {transferred_points} баллов"
-            
-            else:
-                # СИТУАЦИЯ 2: Это тот же самый пользователь (уже имеет этот телефон)
-                message = "✅ Этот номер уже привязан к вашему аккаунту"
-        
-        else:
-            # СИТУАЦИЯ 3: Телефон НОВЫЙ (нет в БД)
-            if is_first_phone:
-                # Начисляем приветственные 250 баллов за первый телефон через add_welcome_bonus
-                add_welcome_bonus(current_user.id)
-                welcome_bonus = STARTPOINTS
-                message = f"✅ Номер привязан! 🎉 +{welcome_bonus} приветственных баллов!"
-            else:
-                # Просто меняем телефон (без бонуса)
-                message = "✅ Номер телефона изменен"
-        
-        # Привязываем/изменяем телефон
-        current_user.phone = phone
-        session.commit()
-        
-        total_bonus = transferred_points + welcome_bonus
-        
-        return True, message, total_bonus
-        
-    except Exception as e:
-        session.rollback()
-        logger.error(f"Error in update_user_phone_simple: {e}")
-        return False, f"❌ Ошибка: {str(e)[:50]}", 0
-    finally:
-        session.close()
-
-def update_phone_universal(tg_id: int, phone: str) -> tuple[bool, str]:
-    """Универсальная функция обновления телефона с правильным удалением дубликатов"""
-    session = Session()
-    try:
-        # Нормализация
-        if phone.startswith('+'):
-            phone = '8' + phone[2:]  # +7999... -> 8999...
-        elif phone.startswith('7'):
-            phone = '8' + phone[1:]  # 7999... -> 8999...
-        
-        if len(phone) != 11 or not phone.isdigit():
-            return False, "❌ Неверный формат номера"
-        
-        # 1. Находим текущего пользователя (кто вводит номер)
-        current_user = session.query(User).filter(User.tg_id == tg_id).first()
-        if not current_user:
-            return False, "❌ Пользователь не найден"
-        
-        # 2. Проверяем, не пытается ли пользователь привязать уже свой же телефон
-        if current_user.phone == phone:
-            return True, "✅ Этот номер уже привязан к вашему аккаунту"
-        
-        # 3. Ищем существующего пользователя с этим телефоном
-        existing_user = session.query(User).filter(User.phone == phone).first()
-        
-        if existing_user:
-            # 4. Если нашли другого пользователя с таким телефоном
-            if existing_user.id != current_user.id:
-                # ВАЖНО: Сначала удаляем существующего пользователя из сессии
-                # чтобы избежать конфликта уникальности
-                session.expunge(existing_user)  # Открепляем от сессии
-                
-                # Переносим баллы через add_points_with_history
-                transferred_points = 0
-                
-                if existing_user.points_manual > 0:
-                    add_points_with_history(
-                        current_user.id,
-                        'manual',
-                        existing_user.points_manual,
-                        f'Перенос ручных баллов от аккаунта {existing_user.phone}'
-                    )
-                    transferred_points += existing_user.points_manual
-                
-                if existing_user.points_referral > 0:
-                    add_points_with_history(
-                        current_user.id,
-                        'referral',
-                        existing_user.points_referral,
-                        f'Перенос реферальных баллов от аккаунта {existing_user.phone}'
-                    )
-                    transferred_points += existing_user.points_referral
-                
-                # Переносим другие данные
-                if not current_user.first_name and existing_user.first_name:
-                    current_user.first_name = existing_user.first_name
-                if not current_user.last_name and existing_user.last_name:
-                    current_user.last_name = existing_user.last_name
-                if not current_user.referral_code and existing_user.referral_code:
-                    current_user.referral_code = existing_user.referral_code
-                
-                # Теперь удаляем существующего пользователя из БД
-                session.delete(existing_user)
-                session.flush()  # Применяем удаление
-                
-                msg = f"✅ Найден старый аккаунт! Перенесено {transferred_points} баллов"
-            else:
-                return True, "✅ Этот номер уже привязан"
-        else:
-            # 5. Если телефон новый (нет в БД)
-            if current_user.phone is None:
-                # Первый телефон - начисляем бонус через add_welcome_bonus
-                add_welcome_bonus(current_user.id)
-                msg = "✅ Номер привязан! 🎉 +250 приветственных баллов!"
-            else:
-                # Просто меняем телефон (без бонуса)
-                msg = "✅ Номер телефона изменен"
-        
-        # 6. Привязываем телефон к текущему пользователю
-        current_user.phone = phone
-        session.commit()
-        
-        return True, msg
-        
-    except IntegrityError as e:
-        session.rollback()
-        logger.error(f"IntegrityError: {e}")
-        # Если все равно ошибка, используем радикальный метод
-        return force_update_phone(tg_id, phone)
-    
-    except Exception as e:
-        session.rollback()
-        logger.error(f"Error in update_phone_universal: {e}")
-        return False, f"❌ Ошибка: {str(e)[:50]}"
-    
-    finally:
-        session.close()
+    user_data = await get_user_data(tg_id)
+    return user_data is not None and user_data['phone'] is not None
 
-def force_update_phone(tg_id: int, phone: str) -> tuple[bool, str]:
-    """Принудительное обновление телефона через прямой SQL"""
-    try:
-        # Нормализация
-        if phone.startswith('+'):
-            phone = '8' + phone[2:]
-        elif phone.startswith('7'):
-            phone = '8' + phone[1:]
-        
-        if len(phone) != 11:
-            return False, "❌ Неверный формат номера"
-        
-        # Прямое подключение к SQLite
-        conn = sqlite3.connect('bot.app.db')
-        cursor = conn.cursor()
-        
-        # 1. Находим ID текущего пользователя
-        cursor.execute("SELECT id FROM users WHERE tg_id = ?", (tg_id,))
-        user_row = cursor.fetchone()
-        
-        if not user_row:
-            conn.close()
-            return False, "❌ Пользователь не найден"
-        
-        user_id = user_row[0]
-        
-        # 2. Находим старого владельца телефона
-        cursor.execute("SELECT id, points_manual, points_referral, first_name, last_name FROM users WHERE phone = ?", (phone,))
-        old_owner = cursor.fetchone()
-        
-        transferred_points = 0
-        
-        if old_owner:
-            old_id, old_manual, old_referral, old_first_name, old_last_name = old_owner
-            
-            if old_id != user_id:
-                # 3. Переносим баллы
-                transferred_points = old_manual + old_referral
-                cursor.execute(
-                    "UPDATE users SET points_manual = points_manual + ?, points_referral = points_referral + ? WHERE id = ?",
-                    (old_manual, old_referral, user_id)
-                )
-                
-                # 4. Переносим имя (если у нового нет)
-                cursor.execute("SELECT first_name FROM users WHERE id = ?", (user_id,))
-                current_first_name = cursor.fetchone()[0]
-                
-                if not current_first_name and old_first_name:
-                    cursor.execute(
-                        "UPDATE users SET first_name = ? WHERE id = ?",
-                        (old_first_name, user_id)
-                    )
-                
-                # 5. Удаляем старого пользователя
-                cursor.execute("DELETE FROM users WHERE id = ?", (old_id,))
-        
-        # 6. Проверяем, есть ли у пользователя уже телефон
-        cursor.execute("SELECT phone FROM users WHERE id = ?", (user_id,))
-        current_phone = cursor.fetchone()[0]
-        
-        welcome_bonus = 0
-        
-        if not current_phone:
-            # 7. Начисляем приветственные 250 баллов через отдельное обновление
-            cursor.execute(
-                "UPDATE users SET points_manual = points_manual + 250, last_manual_points_update = datetime('now') WHERE id = ?",
-                (user_id,)
-            )
-            welcome_bonus = STARTPOINTS
-        
-        # 8. Привязываем телефон
-        cursor.execute(
-            "UPDATE users SET phone = ? WHERE id = ?",
-            (phone, user_id)
-        )
-        
-        conn.commit()
-        conn.close()
-        
-        # Формируем сообщение
-        total_bonus = transferred_points + welcome_bonus
-        
-        if transferred_points > 0 and welcome_bonus > 0:
-            return True, f"✅ Объединены аккаунты! Перенесено {transferred_points} баллов + {welcome_bonus} приветственных!"
-        elif transferred_points > 0:
-            return True, f"✅ Найден старый аккаунт! Перенесено {transferred_points} баллов"
-        elif welcome_bonus > 0:
-            return True, f"✅ Номер привязан! 🎉 +{welcome_bonus} приветственных баллов!"
-        else:
-            return True, "✅ Номер телефона изменен"
-        
-    except Exception as e:
-        return False, f"❌ Ошибка SQL: {str(e)[:50]}"
+def _user_snapshot(user: User) -> dict:
+    """Профиль пользователя в виде словаря (то, что хранится в кэше)"""
+    return {
+        'id': user.id,
+        'tg_id': user.tg_id,
+        'first_name': user.first_name,
+        'last_name': user.last_name,
+        'username': user.username,
+        'phone': user.phone,
+        'referral_code': user.referral_code,
+        'points_referral': user.points_referral,
+        'points_manual': user.points_manual,
+        'last_manual_points_update': user.last_manual_points_update,
+        'last_referral_points_update': user.last_referral_points_update,
+        'invited_by': user.invited_by
+    }
 
-def update_user_phone_in_db(tg_id: int, new_phone: str) -> bool:
-    """Обновляет номер телефона пользователя"""
-    session = Session()
-    try:
-        user = session.query(User).filter(User.tg_id == tg_id).first()
-        if user:
-            # Нормализуем номер
-            if new_phone.startswith('+'):
-                new_phone = '8' + new_phone[2:]  # +7999... -> 8999...
-            elif new_phone.startswith('7'):
-                new_phone = '8' + new_phone[1:]  # 7999... -> 8999...
-            
-            user.phone = new_phone
-            session.commit()
-            return True
-        return False
-    except Exception as e:
-        session.rollback()
-        logger.error(f"Error updating phone: {e}")
-        return False
-    finally:
-        session.close()
+def _profile_needs_update(user_data: dict, first_name: str = None, last_name: str = None,
+                          username: str = None, phone: str = None) -> bool:
+    """Есть ли переданные данные, которых нет в профиле"""
+    return bool(
+        (first_name and not user_data['first_name']) or
+        (last_name and not user_data['last_name']) or
+        (username and not user_data['username']) or
+        (phone and not user_data['phone'])
+    )
 
-def get_user_data(tg_id: int):
-    """Получить все данные пользователя в виде словаря"""
-    session = Session()
+async def get_user_data(tg_id: int):
+    """Получить все данные пользователя в виде словаря (через кэш профилей)"""
+    cached = user_cache.get(tg_id)
+    if cached is not None:
+        return dict(cached)
+    
+    generation = user_cache.generation
+    session = async_session()
     try:
-        user = session.query(User).filter(User.tg_id == tg_id).first()
+        user = await session.scalar(select(User).where(User.tg_id == tg_id))
         if user:
-            return {
-                'id': user.id,
-                'tg_id': user.tg_id,
-                'first_name': user.first_name,
-                'last_name': user.last_name,
-                'username': user.username,
-                'phone': user.phone,
-                'referral_code': user.referral_code,
-                'points_referral': user.points_referral,
-                'points_manual': user.points_manual,
-                'last_manual_points_update': user.last_manual_points_update,
-                'last_referral_points_update': user.last_referral_points_update,
-                'invited_by': user.invited_by
-            }
+            user_data = _user_snapshot(user)
+            user_cache.set(tg_id, user_data, generation)
+            return dict(user_data)
         return None
     finally:
-        session.close()
+        await session.close()
 
-def get_user_points(tg_id: int):
+async def get_user_points(tg_id: int):
     """Получить баллы пользователя"""
-    session = Session()
-    try:
-        user = session.query(User).filter(User.tg_id == tg_id).first()
-        if user:
-            return {
-                'referral': user.points_referral,
-                'manual': user.points_manual,
-                'total': user.points_referral + user.points_manual
-            }
-        return None
-    finally:
-        session.close()
+    user_data = await get_user_data(tg_id)
+    if user_data:
+        return {
+            'referral': user_data['points_referral'],
+            'manual': user_data['points_manual'],
+            'total': user_data['points_referral'] + user_data['points_manual']
+        }
+    return None
 
-def create_support_ticket(user_id: int, question: str, group_message_id: int):
+async def create_support_ticket(user_id: int, question: str, group_message_id: int):
     """Создать тикет поддержки"""
-    session = Session()
+    session = async_session()
     try:
         ticket = SupportTicket(
             user_id=user_id,
@@ -618,79 +436,80 @@ def create_support_ticket(user_id: int, question: str, group_message_id: int):
             created_at=datetime.now()
         )
         session.add(ticket)
-        session.commit()
+        await session.commit()
         return ticket.id
     except Exception as e:
-        session.rollback()
+        await session.rollback()
         logger.error(f"Error creating ticket: {e}")
         return None
     finally:
-        session.close()
+        await session.close()
 
-def get_ticket_by_group_message(group_message_id: int):
+async def get_ticket_by_group_message(group_message_id: int):
     """Найти тикет по ID сообщения в группе"""
-    session = Session()
+    session = async_session()
     try:
-        return session.query(SupportTicket).filter(
+        return await session.scalar(select(SupportTicket).where(
             SupportTicket.group_message_id == group_message_id
-        ).first()
+        ))
     finally:
-        session.close()
+        await session.close()
 
-def update_ticket_with_answer(ticket_id: int, answer_text: str):
+async def update_ticket_with_answer(ticket_id: int, answer_text: str):
     """Обновить тикет с ответом"""
-    session = Session()
+    session = async_session()
     try:
-        ticket = session.query(SupportTicket).filter(SupportTicket.id == ticket_id).first()
+        ticket = await session.scalar(select(SupportTicket).where(SupportTicket.id == ticket_id))
         if ticket:
             ticket.is_answered = True
             ticket.answer_text = answer_text
             ticket.answered_at = datetime.now()
-            session.commit()
+            await session.commit()
             return True
         return False
     except Exception as e:
-        session.rollback()
+        await session.rollback()
         logger.error(f"Error updating ticket: {e}")
         return False
     finally:
-        session.close()
+        await session.close()
 
-def get_user_tickets(user_id: int):
+async def get_user_tickets(user_id: int):
     """Получить все тикеты пользователя"""
-    session = Session()
+    session = async_session()
     try:
-        return session.query(SupportTicket).filter(
+        result = await session.scalars(select(SupportTicket).where(
             SupportTicket.user_id == user_id
-        ).order_by(SupportTicket.created_at.desc()).all()
+        ).order_by(SupportTicket.created_at.desc()))
+        return result.all()
     finally:
-        session.close()
+        await session.close()
 
-def close_ticket(ticket_id: int):
+async def close_ticket(ticket_id: int):
     """Закрывает тикет (меняет статус)"""
-    session = Session()
+    session = async_session()
     try:
-        ticket = session.query(SupportTicket).filter(SupportTicket.id == ticket_id).first()
+        ticket = await session.scalar(select(SupportTicket).where(SupportTicket.id == ticket_id))
         if ticket:
             ticket.is_answered = True
-            session.commit()
+            await session.commit()
             return True
         return False
     except Exception as e:
-        session.rollback()
+        await session.rollback()
         logger.error(f"Error closing ticket: {e}")
         return False
     finally:
-        session.close()
+        await session.close()
 
-def delete_users_without_phone():
+async def delete_users_without_phone():
     """Удаляет всех пользователей без номера телефона"""
-    session = Session()
+    session = async_session()
     try:
         # Находим пользователей без телефона
-        users_to_delete = session.query(User).filter(
+        users_to_delete = (await session.scalars(select(User).where(
             (User.phone.is_(None)) | (User.phone == '')
-        ).all()
+        ))).all()
         
         count = len(users_to_delete)
         
@@ -699,92 +518,139 @@ def delete_users_without_phone():
         
         # Удаляем каждого
         for user in users_to_delete:
-            session.delete(user)
+            await session.delete(user)
         
-        session.commit()
+        await session.commit()
+        user_cache.clear()
+        stats_cache.clear()  # счетчики админки тоже сразу актуальны
         
         return count, f"✅ Удалено {count} пользователей без телефона"
         
     except Exception as e:
-        session.rollback()
+        await session.rollback()
         return 0, f"❌ Ошибка: {e}"
     finally:
-        session.close()
+        await session.close()
 
-def safe_clean_database():
+async def safe_clean_database():
     """Безопасная очистка с созданием резервной копии"""
     try:
-        # 1. Создаем резервную копию
-        backup_file = f"backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-        
-        source = sqlite3.connect('bot.app.db')
-        backup = sqlite3.connect(backup_file)
-        
-        source.backup(backup)
-        source.close()
-        backup.close()
+        # 1. Создаем резервную копию (в отдельном потоке, чтобы не блокировать бота)
+        backup = await asyncio.to_thread(create_backup)
         
         # 2. Выполняем очистку
-        count, msg = delete_users_without_phone()
+        count, msg = await delete_users_without_phone()
         
-        return f"✅ Резервная копия: {backup_file}\n{msg}"
+        return f"✅ Резервная копия: {format_backup_result(backup)}\n{msg}"
         
     except Exception as e:
         return f"❌ Ошибка при создании backup: {e}"
+
+def optimize_database() -> str:
+    """
+    Обслуживание SQLite (синхронно, для пула потоков планировщика):
+    PRAGMA optimize обновляет статистику планировщика запросов там, где
+    она устарела, checkpoint переносит WAL в основной файл и обрезает его
+    """
+    conn = connect_sqlite()
+    try:
+        conn.execute("PRAGMA optimize")
+        busy, wal_pages, moved = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    finally:
+        conn.close()
+    return f"WAL: перенесено {moved} из {wal_pages} страниц" + (", база занята" if busy else "")
+
+async def get_user_stats() -> dict:
+    """
+    Счетчики пользователей из user_stats (ведутся триггерами, миграция 6):
+    один SELECT по первичному ключу вместо агрегатов по всей таблице.
+    Результат кэшируется на STATS_CACHE_TTL секунд.
+    """
+    stats = stats_cache.get('users')
+    if stats is not None:
+        return stats
     
-def get_admin_stats():
-    """Статистика для админ-панели"""
-    session = Session()
+    generation = stats_cache.generation
+    session = async_session()
     try:
-        from sqlalchemy import func
-        
-        total_users = session.query(func.count(User.id)).scalar()
-        users_with_phone = session.query(func.count(User.id)).filter(User.phone.isnot(None)).scalar()
-        
-        # Сумма всех баллов
-        total_points = session.query(
-            func.sum(User.points_referral + User.points_manual)
-        ).scalar() or 0
-        
-        # Среднее количество баллов
-        avg_points = session.query(
-            func.avg(User.points_referral + User.points_manual)
-        ).scalar() or 0
-        
-        return {
-            'total_users': total_users,
-            'users_with_phone': users_with_phone,
-            'total_points': total_points,
-            'avg_points': round(avg_points, 2)
-        }
+        row = (await session.execute(
+            select(UserStats.total_users, UserStats.users_with_phone, UserStats.users_with_tg,
+                   UserStats.empty_users, UserStats.total_points).where(UserStats.id == 1)
+        )).first()
     finally:
-        session.close()    
+        await session.close()
+    
+    stats = dict(row._mapping) if row else {
+        'total_users': 0, 'users_with_phone': 0, 'users_with_tg': 0, 'empty_users': 0, 'total_points': 0
+    }
+    stats['avg_points'] = round(stats['total_points'] / stats['total_users'], 2) if stats['total_users'] else 0
+    stats_cache.set('users', stats, generation)
+    return stats
+
+async def get_admin_stats():
+    """Статистика для админ-панели"""
+    stats = await get_user_stats()
+    return {
+        'total_users': stats['total_users'],
+        'users_with_phone': stats['users_with_phone'],
+        'total_points': stats['total_points'],
+        'avg_points': stats['avg_points']
+    }
 
-def get_all_users(limit: int = 50):
+async def get_all_users(limit: int = 50):
     """Получить всех пользователей"""
-    session = Session()
+    session = async_session()
+    try:
+        return await _fetch_user_infos(session, select(*USER_INFO_COLUMNS).order_by(User.id.desc()).limit(limit))
+    finally:
+        await session.close()
+
+async def get_users_page(before_id: int = None, after_id: int = None,
+                         limit: int = 20) -> tuple[list[UserListItem], bool, bool]:
+    """
+    Страница списка пользователей, новые сверху, с курсором по id вместо OFFSET:
+    before_id - следующая страница (более старые), after_id - предыдущая.
+    Стоимость страницы не зависит от ее номера.
+    Возвращает (пользователи, есть более новые, есть более старые)
+    """
+    query = select(*USER_LIST_COLUMNS)
+    if after_id is not None:
+        query = query.where(User.id > after_id).order_by(User.id.asc())
+    else:
+        if before_id is not None:
+            query = query.where(User.id < before_id)
+        query = query.order_by(User.id.desc())
+    
+    session = async_session()
     try:
-        return session.query(User).order_by(User.id.desc()).limit(limit).all()
+        rows = (await session.execute(query.limit(limit + 1))).all()
     finally:
-        session.close()
+        await session.close()
+    
+    has_more = len(rows) > limit
+    users = [UserListItem(*row) for row in rows[:limit]]
+    if after_id is not None:
+        users.reverse()
+        return users, has_more, True
+    return users, before_id is not None, has_more
 
-def get_user_by_id(user_id: int):
+async def get_user_by_id(user_id: int):
     """Получить пользователя по ID в базе"""
-    session = Session()
+    session = async_session()
     try:
-        return session.query(User).filter(User.id == user_id).first()
+        return await _fetch_user_info(session, User.id == user_id)
     finally:
-        session.close()
+        await session.close()
 
-def update_user_points(user_id: int, points_type: str, points: int):
+async def update_user_points(user_id: int, points_type: str, points: int):
     """Обновить баллы пользователя"""
-    session = Session()
+    session = async_session()
     try:
-        user = session.query(User).filter(User.id == user_id).first()
+        user = await session.scalar(select(User).where(User.id == user_id))
         if user:
             if points_type == 'manual':
                 # Используем add_points_with_history вместо прямого изменения
-                return add_points_with_history(
+                return await add_points_with_history(
                     user_id,
                     'manual',
                     points,
@@ -792,7 +658,7 @@ def update_user_points(user_id: int, points_type: str, points: int):
                 )
             elif points_type == 'referral':
                 # Используем add_points_with_history вместо прямого изменения
-                return add_points_with_history(
+                return await add_points_with_history(
                     user_id,
                     'referral',
                     points,
@@ -800,7 +666,7 @@ def update_user_points(user_id: int, points_type: str, points: int):
                 )
             elif points_type == 'add_manual':
                 # Используем add_points_with_history вместо прямого изменения
-                return add_points_with_history(
+                return await add_points_with_history(
                     user_id,
                     'manual',
                     points,
@@ -808,7 +674,7 @@ def update_user_points(user_id: int, points_type: str, points: int):
                 )
             elif points_type == 'add_referral':
                 # Используем add_points_with_history вместо прямого изменения
-                return add_points_with_history(
+                return await add_points_with_history(
                     user_id,
                     'referral',
                     points,
@@ -818,152 +684,209 @@ def update_user_points(user_id: int, points_type: str, points: int):
             return True
         return False
     except Exception as e:
-        session.rollback()
+        await session.rollback()
         logger.error(f"Error updating user points: {e}")
         return False
     finally:
-        session.close()
+        await session.close()
 
-def get_statistics():
+async def get_statistics():
     """Получить статистику"""
-    session = Session()
-    try:
-        from sqlalchemy import func
-        
-        total_users = session.query(func.count(User.id)).scalar()
-        users_with_phone = session.query(func.count(User.id)).filter(User.phone.isnot(None)).scalar()
-        total_points = session.query(func.sum(User.points_manual + User.points_referral)).scalar() or 0
-        
-        return {
-            'total_users': total_users,
-            'users_with_phone': users_with_phone,
-            'total_points': total_points
-        }
-    finally:
-        session.close()
+    stats = await get_user_stats()
+    return {
+        'total_users': stats['total_users'],
+        'users_with_phone': stats['users_with_phone'],
+        'total_points': stats['total_points']
+    }
 
-def search_users_by_phone(phone_part: str):
-    """Поиск пользователей по номеру телефона"""
-    session = Session()
-    try:
-        return session.query(User).filter(User.phone.like(f"%{phone_part}%")).all()
-    finally:
-        session.close()
+# Поисковый индекс из миграции 5 (app/migrations.py)
+users_fts = sql_table('users_fts', sql_column('rowid'))
+SEARCH_MIN_TOKEN = 3     # триграммный индекс ищет подстроки от 3 символов
+SEARCH_CANDIDATES = 200  # сколько лучших совпадений (по _search_rank) ранжировать точно
 
-def search_users_by_name(name_part: str):
-    """Поиск пользователей по имени"""
-    session = Session()
+def _search_terms(query: str) -> list[str]:
+    """Слова запроса; номер телефона (в любом написании) - одним словом, как он хранится в базе"""
+    digits = phone_digits(query)
+    if digits is not None:
+        return [digits]
+    return query.split()
+
+def _search_score(user: UserInfo, terms: list[str]) -> int:
+    """Релевантность: совпадение поля целиком > начало поля > подстрока"""
+    fields = [(value or '').lower() for value in (user.first_name, user.last_name, user.username, user.phone)]
+    score = 0
+    for term in terms:
+        term = term.lower()
+        score += max(
+            3 if value == term else 2 if value.startswith(term) else 1 if term in value else 0
+            for value in fields
+        )
+    return score
+
+def _search_rank(terms: list[str]):
+    """
+    SQL-версия _search_score: сортировка по ней идет до LIMIT, поэтому точные
+    совпадения и совпадения с начала поля не теряются среди новых подстрок.
+    lower() в SQLite не знает кириллицу - регистр учитываем вариантами написания
+    """
+    searchable = (User.first_name, User.last_name, User.username, User.phone)
+    ranks = []
+    for term in terms:
+        variants = sorted({term, term.lower(), term.capitalize(), term.upper()})
+        ranks.append(func.max(*(
+            case(
+                (column.in_(variants), 3),
+                (func.substr(column, 1, len(term)).in_(variants), 2),
+                else_=1,
+            )
+            for column in searchable
+        )))
+    return sum(ranks[1:], ranks[0])
+
+async def search_users(query: str, limit: int = 20) -> list[UserInfo]:
+    """
+    Поиск пользователей по подстроке имени, фамилии, username или телефона.
+    Должны найтись все слова запроса. Совпадения из триграммного индекса
+    (слова короче 3 символов индекс не ищет - тогда LIKE) сортируются по
+    релевантности, при равной - новые выше.
+    """
+    terms = _search_terms(query)
+    if not terms:
+        return []
+    
+    session = async_session()
     try:
-        return session.query(User).filter(
-            (User.first_name.like(f"%{name_part}%")) | 
-            (User.last_name.like(f"%{name_part}%"))
-        ).all()
+        # Полный номер - точное совпадение по уникальному индексу
+        phone = normalize_phone(query)
+        if phone is not None:
+            user = await _fetch_user_info(session, User.phone == phone)
+            if user is not None:
+                return [user]
+        
+        if all(len(term) >= SEARCH_MIN_TOKEN for term in terms):
+            match = ' '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+            query = (
+                select(*USER_INFO_COLUMNS)
+                .join_from(User, users_fts, users_fts.c.rowid == User.id)
+                .where(literal_column('users_fts').op('MATCH')(match))
+            )
+        else:
+            searchable = (User.first_name, User.last_name, User.username, User.phone)
+            query = (
+                select(*USER_INFO_COLUMNS)
+                .where(*(or_(*(column.contains(term, autoescape=True) for column in searchable)) for term in terms))
+            )
+        query = query.order_by(_search_rank(terms).desc(), User.id.desc()).limit(SEARCH_CANDIDATES)
+        candidates = await _fetch_user_infos(session, query)
     finally:
-        session.close()
+        await session.close()
+    
+    candidates.sort(key=lambda user: _search_score(user, terms), reverse=True)
+    return candidates[:limit]
 
-def delete_empty_users():
+async def delete_empty_users():
     """Удаляет пользователей без телефона и без Telegram ID"""
-    session = Session()
+    session = async_session()
     try:
-        users_to_delete = session.query(User).filter(
+        users_to_delete = (await session.scalars(select(User).where(
             (User.phone.is_(None) | (User.phone == '')),
             (User.tg_id.is_(None) | (User.tg_id == 0))
-        ).all()
+        ))).all()
         
         count = len(users_to_delete)
         
         for user in users_to_delete:
-            session.delete(user)
+            await session.delete(user)
         
-        session.commit()
+        await session.commit()
+        user_cache.clear()
+        stats_cache.clear()
         
         return count, f"✅ Удалено {count} пустых пользователей"
         
     except Exception as e:
-        session.rollback()
+        await session.rollback()
         return 0, f"❌ Ошибка: {e}"
     finally:
-        session.close()
+        await session.close()
 
-def clean_duplicate_phones():
+async def clean_duplicate_phones():
     """Удаляет дубликаты телефонов, оставляя последнюю запись"""
-    session = Session()
+    session = async_session()
     try:
         from sqlalchemy import func
         
-        duplicates = session.query(
+        duplicates = (await session.execute(select(
             User.phone,
             func.count(User.id).label('count'),
             func.max(User.id).label('max_id')
-        ).filter(
+        ).where(
             User.phone.isnot(None)
         ).group_by(
             User.phone
         ).having(
             func.count(User.id) > 1
-        ).all()
+        ))).all()
         
         total_deleted = 0
         
         for phone, count, max_id in duplicates:
             # Удаляем все записи с этим телефоном, кроме последней
-            deleted = session.query(User).filter(
+            result = await session.execute(delete(User).where(
                 User.phone == phone,
                 User.id != max_id
-            ).delete(synchronize_session=False)
+            ).execution_options(synchronize_session=False))
             
-            total_deleted += deleted
+            total_deleted += result.rowcount
         
-        session.commit()
+        await session.commit()
+        user_cache.clear()
+        stats_cache.clear()
         
         return total_deleted, f"✅ Удалено {total_deleted} дубликатов телефонов"
         
     except Exception as e:
-        session.rollback()
+        await session.rollback()
         return 0, f"❌ Ошибка: {e}"
     finally:
-        session.close()
+        await session.close()
 
-def delete_user(user_id: int):
+async def delete_user(user_id: int):
     """Удалить пользователя"""
-    session = Session()
+    session = async_session()
     try:
-        user = session.query(User).filter(User.id == user_id).first()
+        user = await session.scalar(select(User).where(User.id == user_id))
         if user:
-            session.delete(user)
-            session.commit()
+            await session.delete(user)
+            await session.commit()
+            user_cache.invalidate_user(user_id=user_id)
             return True
         return False
     except Exception as e:
-        session.rollback()
+        await session.rollback()
         logger.error(f"Error deleting user: {e}")
         return False
     finally:
-        session.close()
+        await session.close()
 
-def add_user_with_details(phone: str, points: int = 0, first_name: str = None, 
-                          last_name: str = None) -> tuple[bool, str, dict]:
+async def add_user_with_details(phone: str, points: int = 0, first_name: str = None, 
+                                last_name: str = None) -> tuple[bool, str, dict]:
     """
     Добавить пользователя с деталями
     """
-    session = Session()
+    phone = normalize_phone(phone)
+    if phone is None:
+        return False, "❌ Неверный формат номера", {}
+    
+    session = async_session()
     try:
-        # Нормализация
-        if phone.startswith('+'):
-            phone = '8' + phone[2:]
-        elif phone.startswith('7'):
-            phone = '8' + phone[1:]
-        
-        if len(phone) != 11:
-            return False, "❌ Неверный формат номера", {}
-        
         # Проверяем существование
-        existing = session.query(User).filter(User.phone == phone).first()
+        existing = await session.scalar(select(User).where(User.phone == phone))
         
         if existing:
             # Обновляем существующего через add_points_with_history
             if points > 0:
-                add_points_with_history(
+                await add_points_with_history(
                     existing.id,
                     'manual',
                     points,
@@ -975,7 +898,8 @@ def add_user_with_details(phone: str, points: int = 0, first_name: str = None,
             if last_name and not existing.last_name:
                 existing.last_name = last_name
             
-            session.commit()
+            await session.commit()
+            user_cache.invalidate_user(user_id=existing.id)
             
             return True, f"✅ Обновлен существующий пользователь", {
                 'id': existing.id,
@@ -984,33 +908,19 @@ def add_user_with_details(phone: str, points: int = 0, first_name: str = None,
                 'is_new': False
             }
         
-        # Создаем нового
-        referral_code = generate_referral_code()
-        while session.query(User).filter(User.referral_code == referral_code).first():
-            referral_code = generate_referral_code()
-        
-        new_user = User(
+        # Создаем нового, баллы с историей - в той же транзакции
+        new_user_id, referral_code = await insert_user(
+            session,
             phone=phone,
             first_name=first_name,
-            last_name=last_name,
-            referral_code=referral_code,
-            points_manual=points
+            last_name=last_name
         )
-        
-        session.add(new_user)
-        session.commit()
-        
-        # Добавляем баллы в историю если они есть
         if points > 0:
-            add_points_with_history(
-                new_user.id,
-                'manual',
-                points,
-                'Создание пользователя с баллами'
-            )
+            await apply_points(session, new_user_id, 'manual', points, 'Создание пользователя с баллами')
+        await session.commit()
         
         return True, f"✅ Создан новый пользователь", {
-            'id': new_user.id,
+            'id': new_user_id,
             'phone': phone,
             'points': points,
             'is_new': True,
@@ -1018,30 +928,29 @@ def add_user_with_details(phone: str, points: int = 0, first_name: str = None,
         }
         
     except Exception as e:
-        session.rollback()
+        await session.rollback()
         return False, f"❌ Ошибка: {str(e)[:50]}", {}
     finally:
-        session.close()
+        await session.close()
 
-def quick_add_user(phone: str, points: int = 0) -> str:
+async def quick_add_user(phone: str, points: int = 0) -> str:
     """
     Быстро добавить пользователя или обновить баллы
     """
-    session = Session()
+    normalized = normalize_phone(phone)
+    if normalized is None:
+        return f"❌ Неверный формат номера: {phone}"
+    phone = normalized
+    
+    session = async_session()
     try:
-        # Нормализация
-        if phone.startswith('+'):
-            phone = '8' + phone[2:]
-        elif phone.startswith('7'):
-            phone = '8' + phone[1:]
-        
         # Ищем существующего
-        user = session.query(User).filter(User.phone == phone).first()
+        user = await session.scalar(select(User).where(User.phone == phone))
         
         if user:
             # Обновляем баллы через add_points_with_history
             if points > 0:
-                add_points_with_history(
+                await add_points_with_history(
                     user.id,
                     'manual',
                     points,
@@ -1049,68 +958,45 @@ def quick_add_user(phone: str, points: int = 0) -> str:
                 )
             return f"✅ Обновлен пользователь {phone}. Теперь баллов: {user.get_total_points()}"
         else:
-            # Создаем нового
-            referral_code = generate_referral_code()
-            while session.query(User).filter(User.referral_code == referral_code).first():
-                referral_code = generate_referral_code()
-            
-            new_user = User(
-                phone=phone,
-                referral_code=referral_code,
-                points_manual=points
-            )
-            
-            session.add(new_user)
-            session.commit()
-            
-            # Добавляем баллы в историю если они есть
+            # Создаем нового, баллы с историей - в той же транзакции
+            new_user_id, _ = await insert_user(session, phone=phone)
             if points > 0:
-                add_points_with_history(
-                    new_user.id,
-                    'manual',
-                    points,
-                    'Создание пользователя с баллами'
-                )
+                await apply_points(session, new_user_id, 'manual', points, 'Создание пользователя с баллами')
+            await session.commit()
             
-            return f"✅ Создан новый пользователь {phone}. ID: {new_user.id}, Баллы: {points}"
+            return f"✅ Создан новый пользователь {phone}. ID: {new_user_id}, Баллы: {points}"
             
     except Exception as e:
-        session.rollback()
+        await session.rollback()
         return f"❌ Ошибка: {str(e)[:50]}"
     finally:
-        session.close()
+        await session.close()
 
-def add_manual_user(phone: str, first_name: str = None, last_name: str = None, 
-                    manual_points: int = 0, referral_points: int = 0) -> tuple[bool, str, int]:
+async def add_manual_user(phone: str, first_name: str = None, last_name: str = None, 
+                          manual_points: int = 0, referral_points: int = 0) -> tuple[bool, str, int]:
     """
     Добавить пользователя вручную
     Возвращает: (успех, сообщение, user_id)
     """
-    session = Session()
+    phone = normalize_phone(phone)
+    if phone is None:
+        return False, "❌ Неверный формат номера", 0
+    
+    session = async_session()
     try:
-        # Нормализация номера
-        if phone.startswith('+'):
-            phone = '8' + phone[2:]
-        elif phone.startswith('7'):
-            phone = '8' + phone[1:]
-        
-        # Проверка формата
-        if len(phone) != 11 or not phone.isdigit():
-            return False, "❌ Неверный формат номера", 0
-        
         # Проверяем, не существует ли уже пользователь с таким телефоном
-        existing_user = session.query(User).filter(User.phone == phone).first()
+        existing_user = await session.scalar(select(User).where(User.phone == phone))
         if existing_user:
             # Если пользователь существует, обновляем баллы через add_points_with_history
             if manual_points > 0:
-                add_points_with_history(
+                await add_points_with_history(
                     existing_user.id,
                     'manual',
                     manual_points,
                     'Ручное добавление баллов'
                 )
             if referral_points > 0:
-                add_points_with_history(
+                await add_points_with_history(
                     existing_user.id,
                     'referral',
                     referral_points,
@@ -1122,158 +1008,560 @@ def add_manual_user(phone: str, first_name: str = None, last_name: str = None,
             if last_name and not existing_user.last_name:
                 existing_user.last_name = last_name
             
-            session.commit()
+            await session.commit()
+            user_cache.invalidate_user(user_id=existing_user.id)
             return True, f"✅ Пользователь существует. Обновлены баллы. Всего: {existing_user.get_total_points()}", existing_user.id
         
-        # Генерируем реферальный код
-        referral_code = generate_referral_code()
-        while session.query(User).filter(User.referral_code == referral_code).first():
-            referral_code = generate_referral_code()
-        
-        # Создаем нового пользователя
-        new_user = User(
+        # Создаем нового пользователя (без привязки к Telegram), баллы с историей - в той же транзакции
+        new_user_id, _ = await insert_user(
+            session,
             phone=phone,
             first_name=first_name,
-            last_name=last_name,
-            referral_code=referral_code,
-            points_manual=manual_points,
-            points_referral=referral_points,
-            tg_id=None  # Без привязки к Telegram
+            last_name=last_name
         )
-        
-        session.add(new_user)
-        session.commit()
-        
-        # Добавляем баллы в историю
         if manual_points > 0:
-            add_points_with_history(
-                new_user.id,
-                'manual',
-                manual_points,
-                'Создание с ручными баллами'
-            )
-        
+            await apply_points(session, new_user_id, 'manual', manual_points, 'Создание с ручными баллами')
         if referral_points > 0:
-            add_points_with_history(
-                new_user.id,
-                'referral',
-                referral_points,
-                'Создание с реферальными баллами'
-            )
+            await apply_points(session, new_user_id, 'referral', referral_points, 'Создание с реферальными баллами')
+        await session.commit()
         
-        return True, f"✅ Пользователь создан! ID: {new_user.id}, Баллы: {new_user.get_total_points()}", new_user.id
+        return True, f"✅ Пользователь создан! ID: {new_user_id}, Баллы: {manual_points + referral_points}", new_user_id
         
     except Exception as e:
-        session.rollback()
+        await session.rollback()
         logger.error(f"Error adding manual user: {e}")
         return False, f"❌ Ошибка: {str(e)[:50]}", 0
     finally:
-        session.close()
+        await session.close()
 
-def update_user_points_with_history(user_id: int, points_type: str, points: int, description: str = None):
+async def update_user_points_with_history(user_id: int, points_type: str, points: int, description: str = None):
     """Обновить баллы пользователя с записью в историю"""
-    return add_points_with_history(user_id, points_type, points, description)
+    return await add_points_with_history(user_id, points_type, points, description)
+
+# Колонки баланса и даты обновления для каждого типа баллов
+POINTS_COLUMNS = {
+    'manual': ('points_manual', 'last_manual_points_update'),
+    'welcome': ('points_manual', 'last_manual_points_update'),
+    'admin': ('points_manual', 'last_manual_points_update'),
+    'referral': ('points_referral', 'last_referral_points_update'),
+    'cashback': ('points_manual', 'last_manual_points_update'),
+    'expired': ('points_manual', 'last_manual_points_update'),
+    'expired_referral': ('points_referral', 'last_referral_points_update'),
+}
+
+def get_points_columns(points_type: str) -> tuple[str, str]:
+    """Колонки (баланс, дата обновления) для типа баллов, по умолчанию manual"""
+    columns = POINTS_COLUMNS.get(points_type)
+    if columns is None:
+        logger.warning(f"Неизвестный тип баллов '{points_type}', использован manual")
+        columns = POINTS_COLUMNS['manual']
+    return columns
 
-def add_points_with_history(user_id: int, points_type: str, amount: int, description: str = None):
+async def apply_points(session, user_id: int, points_type: str, amount: int,
+                       description: str = None, now: datetime = None) -> bool:
     """
-    Добавляет баллы с записью в историю
+    Начисляет баллы в рамках переданной сессии (без commit):
+    UPDATE ... RETURNING для баланса и INSERT в историю
     """
-    session = Session()
+    now = now or datetime.now()
+    balance_column, update_column = get_points_columns(points_type)
+    users = User.__table__
+    
+    updated_id = await session.scalar(
+        update(users)
+        .where(users.c.id == user_id)
+        .values({
+            balance_column: func.coalesce(users.c[balance_column], 0) + amount,
+            update_column: now
+        })
+        .returning(users.c.id)
+    )
+    if updated_id is None:
+        return False
+    
+    await session.execute(insert(PointsHistory.__table__).values(
+        user_id=user_id,
+        points_type=points_type,
+        points_amount=amount,
+        description=description,
+        created_at=now
+    ))
+    return True
+
+async def add_points_with_history(user_id: int, points_type: str, amount: int, description: str = None):
+    """
+    Добавляет баллы с записью в историю одной транзакцией
+    """
+    session = async_session()
     try:
-        user = session.query(User).filter(User.id == user_id).first()
-        if not user:
+        if not await apply_points(session, user_id, points_type, amount, description):
+            await session.rollback()
             logger.error(f"Пользователь с ID {user_id} не найден")
             return False
         
-        logger.info(f"Начинаем добавление баллов: user_id={user_id}, type={points_type}, amount={amount}")
-        
-        # Добавляем баллы в зависимости от типа
-        now = datetime.now()
+        await session.commit()
+        user_cache.invalidate_user(user_id=user_id)
+        logger.debug(f"Начислено {amount} баллов ({points_type}) пользователю {user_id}")
+        return True
         
-        if points_type == 'manual':
-            user.points_manual += amount
-            user.last_manual_points_update = now
-            logger.info(f"Добавлено {amount} ручных баллов. last_manual_points_update = {now}")
-            
-        elif points_type == 'referral':
-            user.points_referral += amount
-            user.last_referral_points_update = now
-            logger.info(f"Добавлено {amount} реферальных баллов. last_referral_points_update = {now}")
-            
-        elif points_type == 'welcome':
-            user.points_manual += amount
-            user.last_manual_points_update = now
-            logger.info(f"Добавлено {amount} приветственных баллов. last_manual_points_update = {now}")
-            
-        elif points_type == 'admin':
-            user.points_manual += amount
-            user.last_manual_points_update = now
-            logger.info(f"Добавлено {amount} админских баллов. last_manual_points_update = {now}")
-            
+    except Exception as e:
+        await session.rollback()
+        logger.error(f"Ошибка добавления баллов с историей: {e}", exc_info=True)
+        return False
+    finally:
+        await session.close()
+
+async def add_points_bulk(session, entries: list[dict], now: datetime = None, chunk_size: int = 500):
+    """
+    Массовое изменение баллов в рамках переданной сессии (без commit, ошибки
+    БД пробрасываются вызывающему), пользователи должны существовать.
+    entries: записи истории - user_id, points_type, points_amount, description,
+    необязательный order_id; balance_amount - если баланс меняется не на
+    points_amount (сгорание не уводит баланс в минус).
+    Суммы по пользователю сводятся в один executemany UPDATE на колонку
+    баланса, история - executemany INSERT. Дата обновления баланса
+    сдвигается только начислениями
+    """
+    if not entries:
+        return
+    now = now or datetime.now()
+    users = User.__table__
+    
+    increments = defaultdict(int)
+    history = []
+    for entry in entries:
+        columns = get_points_columns(entry['points_type'])
+        increments[(columns, entry['user_id'])] += entry.get('balance_amount', entry['points_amount'])
+        history.append({
+            'user_id': entry['user_id'],
+            'points_type': entry['points_type'],
+            'points_amount': entry['points_amount'],
+            'description': entry.get('description'),
+            'order_id': entry.get('order_id'),
+            'created_at': now
+        })
+    
+    by_columns = defaultdict(list)
+    for (columns, user_id), amount in increments.items():
+        by_columns[columns].append({'b_user_id': user_id, 'b_amount': amount})
+    
+    amount = bindparam('b_amount')
+    for (balance_column, update_column), params in by_columns.items():
+        stmt = update(users).where(users.c.id == bindparam('b_user_id')).values({
+            balance_column: func.coalesce(users.c[balance_column], 0) + amount,
+            update_column: case((amount > 0, now), else_=users.c[update_column])
+        })
+        for i in range(0, len(params), chunk_size):
+            await session.execute(stmt, params[i:i + chunk_size])
+    
+    for i in range(0, len(history), chunk_size):
+        await session.execute(insert(PointsHistory.__table__), history[i:i + chunk_size])
+
+IMPORT_REJECT_EXAMPLES = 10
+
+async def import_users(records, chunk_size: int = 500) -> dict:
+    """
+    Массовый импорт клиентов (CSV из админки).
+    records: итерируемое из словарей line, phone, first_name, last_name, points;
+    читается потоково, каждый чанк - отдельная транзакция.
+    Новые номера создаются, существующим добавляются баллы и недостающее имя.
+    Возвращает счетчики строк inserted / merged / rejected и примеры ошибок
+    """
+    result = {'inserted': 0, 'merged': 0, 'rejected': 0, 'errors': []}
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            await _import_users_chunk(chunk, result)
+            chunk = []
+    if chunk:
+        await _import_users_chunk(chunk, result)
+    
+    logger.info(
+        f"Импорт клиентов: создано {result['inserted']}, объединено {result['merged']}, "
+        f"отклонено {result['rejected']}"
+    )
+    return result
+
+def _reject_import_row(result: dict, line, reason: str):
+    result['rejected'] += 1
+    if len(result['errors']) < IMPORT_REJECT_EXAMPLES:
+        result['errors'].append(f"строка {line}: {reason}")
+
+async def _import_users_chunk(records: list, result: dict):
+    # Нормализуем и сводим повторы номера внутри чанка в одну строку
+    rows = {}
+    for record, phone in zip(records, normalize_phones(record.get('phone') for record in records)):
+        if phone is None:
+            _reject_import_row(result, record.get('line'), f"неверный номер {record.get('phone')!r}")
+            continue
+        
+        try:
+            points = int(str(record.get('points') or 0).strip() or 0)
+        except ValueError:
+            points = -1
+        if points < 0:
+            _reject_import_row(result, record.get('line'), f"неверные баллы {record.get('points')!r}")
+            continue
+        
+        first_name = (record.get('first_name') or '').strip() or None
+        last_name = (record.get('last_name') or '').strip() or None
+        row = rows.get(phone)
+        if row is None:
+            rows[phone] = {'phone': phone, 'first_name': first_name, 'last_name': last_name,
+                           'points': points, 'count': 1}
         else:
-            # По умолчанию считаем manual
-            user.points_manual += amount
-            user.last_manual_points_update = now
-            logger.warning(f"Неизвестный тип баллов '{points_type}', использован manual. last_manual_points_update = {now}")
-        
-        # Записываем в историю
-        history_record = PointsHistory(
-            user_id=user_id,
-            points_type=points_type,
-            points_amount=amount,
-            description=description,
-            created_at=now
-        )
-        session.add(history_record)
-        logger.info(f"Создана запись в истории: {description}")
+            row['first_name'] = row['first_name'] or first_name
+            row['last_name'] = row['last_name'] or last_name
+            row['points'] += points
+            row['count'] += 1
+    
+    if not rows:
+        return
+    
+    users = User.__table__
+    session = async_session()
+    try:
+        now = datetime.now()
+        phones = list(rows)
+        existing = dict((await session.execute(
+            select(users.c.phone, users.c.id).where(users.c.phone.in_(phones))
+        )).all())
+        
+        new_rows = [row for row in rows.values() if row['phone'] not in existing]
+        merged_rows = [row for row in rows.values() if row['phone'] in existing]
+        
+        # Новые клиенты: один executemany INSERT, коды из пула
+        user_ids = dict(existing)
+        if new_rows:
+            codes = await allocate_referral_codes(session, len(new_rows))
+            await session.execute(insert(users), [
+                {
+                    'phone': row['phone'],
+                    'first_name': row['first_name'],
+                    'last_name': row['last_name'],
+                    'referral_code': code,
+                    'points_manual': row['points'],
+                    'points_referral': 0,
+                    'last_manual_points_update': now if row['points'] else None
+                }
+                for row, code in zip(new_rows, codes)
+            ])
+            user_ids.update((await session.execute(
+                select(users.c.phone, users.c.id).where(users.c.phone.in_([row['phone'] for row in new_rows]))
+            )).all())
+        
+        # Существующие: баллы и пустые имя/фамилия одним executemany UPDATE
+        if merged_rows:
+            amount = bindparam('b_amount')
+            await session.execute(
+                update(users).where(users.c.id == bindparam('b_user_id')).values(
+                    points_manual=func.coalesce(users.c.points_manual, 0) + amount,
+                    last_manual_points_update=case((amount > 0, now), else_=users.c.last_manual_points_update),
+                    first_name=func.coalesce(users.c.first_name, bindparam('b_first_name')),
+                    last_name=func.coalesce(users.c.last_name, bindparam('b_last_name'))
+                ),
+                [
+                    {'b_user_id': existing[row['phone']], 'b_amount': row['points'],
+                     'b_first_name': row['first_name'], 'b_last_name': row['last_name']}
+                    for row in merged_rows
+                ]
+            )
         
-        session.commit()
-        logger.info(f"Успешно добавлены баллы пользователю {user_id}")
+        history = [
+            {
+                'user_id': user_ids[row['phone']],
+                'points_type': 'manual',
+                'points_amount': row['points'],
+                'description': 'Импорт клиентов',
+                'created_at': now
+            }
+            for row in rows.values() if row['points'] > 0
+        ]
+        if history:
+            await session.execute(insert(PointsHistory.__table__), history)
         
-        # Проверяем, сохранились ли даты
-        session.refresh(user)
-        logger.info(f"Проверка после коммита: last_manual={user.last_manual_points_update}, last_referral={user.last_referral_points_update}")
+        await session.commit()
         
-        return True
+    except Exception as e:
+        await session.rollback()
+        logger.error(f"Ошибка импорта клиентов: {e}", exc_info=True)
+        # Чанк откатился целиком - все его строки считаются отклоненными
+        result['rejected'] += sum(row['count'] for row in rows.values())
+        if len(result['errors']) < IMPORT_REJECT_EXAMPLES:
+            result['errors'].append(
+                f"строки {records[0].get('line')}-{records[-1].get('line')}: ошибка БД {str(e)[:50]}"
+            )
+        return
+    finally:
+        await session.close()
+    
+    for row in merged_rows:
+        user_cache.invalidate_user(user_id=existing[row['phone']])
+    result['inserted'] += len(new_rows)
+    result['merged'] += sum(row['count'] for row in merged_rows) + sum(row['count'] - 1 for row in new_rows)
+
+async def accrue_cashback(records, percent: int = CASHBACK_PERCENT, chunk_size: int = 500) -> dict:
+    """
+    Начисление кэшбэка по выгрузке заказов.
+    records: итерируемое из словарей line, phone, order_total, order_id;
+    читается потоково, каждый чанк - отдельная транзакция.
+    Заказ начисляется один раз: номер сохраняется в points_history.order_id,
+    поэтому повторный запуск на том же файле ничего не добавит.
+    Возвращает счетчики заказов accrued / duplicates / unknown / rejected,
+    сумму баллов points и примеры ошибок
+    """
+    result = {'accrued': 0, 'points': 0, 'duplicates': 0, 'unknown': 0, 'rejected': 0, 'errors': []}
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            await _accrue_cashback_chunk(chunk, percent, result)
+            chunk = []
+    if chunk:
+        await _accrue_cashback_chunk(chunk, percent, result)
+    
+    logger.info(
+        f"Кэшбэк {percent}%: начислено {result['points']} баллов за {result['accrued']} заказов, "
+        f"повторов {result['duplicates']}, не найдено {result['unknown']}, отклонено {result['rejected']}"
+    )
+    return result
+
+def _parse_order_total(value):
+    """Сумма заказа из выгрузки ('1 234,50', '1234.5'), None - если не число"""
+    try:
+        total = Decimal(str(value).replace(' ', '').replace('\u00a0', '').replace(',', '.'))
+    except (InvalidOperation, ValueError):
+        return None
+    return total if total.is_finite() and total > 0 else None
+
+async def _accrue_cashback_chunk(records: list, percent: int, result: dict):
+    # Разбираем строки, повторы номера заказа внутри чанка отбрасываем
+    orders = {}
+    for record, phone in zip(records, normalize_phones(record.get('phone') for record in records)):
+        order_id = (record.get('order_id') or '').strip()
+        total = _parse_order_total(record.get('order_total'))
+        if not order_id or phone is None or total is None:
+            _reject_import_row(result, record.get('line'), "нужны телефон, сумма и номер заказа")
+            continue
+        if order_id in orders:
+            result['duplicates'] += 1
+            continue
+        points = int(total * percent / 100)  # дробная часть отбрасывается
+        orders[order_id] = (phone, points)
+    
+    if not orders:
+        return
+    
+    users = User.__table__
+    history_table = PointsHistory.__table__
+    session = async_session()
+    try:
+        # Заказы, уже начисленные раньше (прошлый запуск или предыдущий чанк)
+        processed = set((await session.scalars(
+            select(history_table.c.order_id).where(history_table.c.order_id.in_(list(orders)))
+        )).all())
+        user_ids = dict((await session.execute(
+            select(users.c.phone, users.c.id).where(users.c.phone.in_({phone for phone, _ in orders.values()}))
+        )).all())
+        
+        history = []
+        increments = defaultdict(int)
+        duplicates = unknown = 0
+        for order_id, (phone, points) in orders.items():
+            if order_id in processed:
+                duplicates += 1
+                continue
+            user_id = user_ids.get(phone)
+            if user_id is None:
+                unknown += 1
+                continue
+            increments[user_id] += points
+            history.append({
+                'user_id': user_id,
+                'points_type': 'cashback',
+                'points_amount': points,
+                'description': f'Кэшбэк {percent}% за заказ {order_id}',
+                'order_id': order_id
+            })
+        
+        if history:
+            # Один executemany INSERT истории и один executemany UPDATE балансов на чанк
+            await add_points_bulk(session, history)
+            await session.commit()
         
     except Exception as e:
-        session.rollback()
-        logger.error(f"Ошибка добавления баллов с историей: {e}", exc_info=True)
-        return False
+        # Например, тот же файл запущен параллельно: уникальный order_id откатит чанк целиком
+        await session.rollback()
+        logger.error(f"Ошибка начисления кэшбэка: {e}", exc_info=True)
+        result['rejected'] += len(orders)
+        if len(result['errors']) < IMPORT_REJECT_EXAMPLES:
+            result['errors'].append(
+                f"строки {records[0].get('line')}-{records[-1].get('line')}: ошибка БД {str(e)[:50]}"
+            )
+        return
+    finally:
+        await session.close()
+    
+    for user_id in increments:
+        user_cache.invalidate_user(user_id=user_id)
+    result['accrued'] += len(history)
+    result['points'] += sum(increments.values())
+    result['duplicates'] += duplicates
+    result['unknown'] += unknown
+
+# ========== СГОРАНИЕ БАЛЛОВ ==========
+
+POINTS_EXPIRY_JOB = 'points_expiry'
+# Тип записи о сгорании для каждого баланса
+EXPIRED_POINTS_TYPES = {'points_manual': 'expired', 'points_referral': 'expired_referral'}
+
+async def get_job_cursor(session, name: str) -> str | None:
+    return await session.scalar(select(JobState.cursor).where(JobState.name == name))
+
+async def set_job_cursor(session, name: str, cursor: str | None, now: datetime = None):
+    now = now or datetime.now()
+    await session.execute(
+        sqlite_insert(JobState.__table__).values(name=name, cursor=cursor, last_run_at=now)
+        .on_conflict_do_update(index_elements=['name'], set_={'cursor': cursor, 'last_run_at': now})
+    )
+
+def _history_balance_column():
+    """Колонка баланса, к которой относится запись истории (как в get_points_columns)"""
+    referral_types = [name for name, (column, _) in POINTS_COLUMNS.items() if column == 'points_referral']
+    return case((PointsHistory.points_type.in_(referral_types), 'points_referral'), else_='points_manual')
+
+async def expire_points(now: datetime = None, chunk_size: int = 500) -> dict:
+    """
+    Сгорание баллов старше POINTS_EXPIRY_DAYS. Каждое начисление - партия;
+    списания (отрицательные записи, в том числе прошлые сгорания) гасят
+    самые старые партии (FIFO). Сгорает то, что осталось от партий старше
+    границы: начислено до границы - все списания - уже сгоревшее.
+    Инкрементально: проверяются только пользователи, у которых партии
+    пересекли границу с прошлого запуска (диапазон по индексу created_at),
+    граница сохраняется в job_state. Повторный запуск ничего не спишет.
+    Каждый чанк пользователей - отдельная транзакция.
+    Возвращает счетчики checked / users / points
+    """
+    now = now or datetime.now()
+    cutoff = now - timedelta(days=POINTS_EXPIRY_DAYS)
+    result = {'checked': 0, 'users': 0, 'points': 0}
+    history = PointsHistory.__table__
+    
+    session = async_session()
+    try:
+        previous = await get_job_cursor(session, POINTS_EXPIRY_JOB)
+        crossed = select(history.c.user_id).distinct().where(
+            history.c.created_at < cutoff, history.c.points_amount > 0, history.c.user_id.isnot(None)
+        )
+        if previous:
+            crossed = crossed.where(history.c.created_at >= datetime.fromisoformat(previous))
+        user_ids = list(await session.scalars(crossed))
+        await session.commit()
+        result['checked'] = len(user_ids)
+        
+        for i in range(0, len(user_ids), chunk_size):
+            await _expire_points_chunk(session, user_ids[i:i + chunk_size], cutoff, now, result)
+        
+        # Границу двигаем только после всех чанков: после сбоя следующий запуск
+        # проверит тех же пользователей, уже списанное повторно не сгорит
+        await set_job_cursor(session, POINTS_EXPIRY_JOB, cutoff.isoformat(), now)
+        await session.commit()
+    except Exception as e:
+        await session.rollback()
+        logger.error(f"Ошибка сгорания баллов: {e}", exc_info=True)
+        result['error'] = str(e)
     finally:
-        session.close()
+        await session.close()
+    
+    if result['users']:
+        stats_cache.clear()
+    logger.info(
+        f"Сгорание баллов до {cutoff:%d.%m.%Y}: проверено {result['checked']}, "
+        f"списано {result['points']} у {result['users']} пользователей"
+    )
+    return result
 
-def get_points_history(user_id: int, limit: int = 10):
+async def _expire_points_chunk(session, user_ids: list, cutoff: datetime, now: datetime, result: dict):
+    users = User.__table__
+    history = PointsHistory.__table__
+    balance_column = _history_balance_column()
+    amount = history.c.points_amount
+    
+    # Блокировка записи на время расчета: трата баллов между чтением и
+    # списанием не даст сжечь уже потраченное
+    await _begin_immediate(session)
+    lots = (await session.execute(
+        select(
+            history.c.user_id,
+            balance_column.label('balance_column'),
+            func.sum(case(((amount > 0) & (history.c.created_at < cutoff), amount), else_=0)).label('matured'),
+            func.sum(case((amount < 0, -amount), else_=0)).label('debited'),
+        )
+        .where(history.c.user_id.in_(user_ids))
+        .group_by(history.c.user_id, balance_column)
+    )).all()
+    balances = {row.id: row for row in await session.execute(
+        select(users.c.id, users.c.points_manual, users.c.points_referral).where(users.c.id.in_(user_ids))
+    )}
+    
+    entries = []
+    for lot in lots:
+        expiring = lot.matured - lot.debited
+        user = balances.get(lot.user_id)
+        if expiring <= 0 or user is None:
+            continue
+        # Баланс не уходит в минус. Если он меньше остатка по истории (старые
+        # данные без истории), в историю пишем весь остаток - иначе он
+        # сгорел бы позже из новых начислений
+        entries.append({
+            'user_id': lot.user_id,
+            'points_type': EXPIRED_POINTS_TYPES[lot.balance_column],
+            'points_amount': -expiring,
+            'balance_amount': -min(expiring, max(getattr(user, lot.balance_column) or 0, 0)),
+            'description': f'Сгорание баллов, начисленных до {cutoff:%d.%m.%Y}'
+        })
+    
+    await add_points_bulk(session, entries, now)
+    await session.commit()
+    
+    expired_users = {entry['user_id'] for entry in entries}
+    for user_id in expired_users:
+        user_cache.invalidate_user(user_id=user_id)
+    result['users'] += len(expired_users)
+    result['points'] += sum(-entry['points_amount'] for entry in entries)
+
+async def get_points_history(user_id: int, limit: int = 10):
     """Получить историю начисления баллов пользователя"""
-    session = Session()
+    session = async_session()
     try:
-        return session.query(PointsHistory)\
-            .filter(PointsHistory.user_id == user_id)\
+        result = await session.execute(select(*POINTS_RECORD_COLUMNS)\
+            .where(PointsHistory.user_id == user_id)\
             .order_by(PointsHistory.created_at.desc())\
-            .limit(limit)\
-            .all()
+            .limit(limit))
+        return [PointsRecord(*row) for row in result]
     finally:
-        session.close()
+        await session.close()
 
-def get_user_points_summary(user_id: int):
+async def get_user_points_summary(user_id: int):
     """Получить сводку по баллам пользователя"""
-    session = Session()
+    session = async_session()
     try:
-        user = session.query(User).filter(User.id == user_id).first()
+        user = await session.scalar(select(User).where(User.id == user_id))
         if not user:
             return None
         
         # Суммируем по типам из истории
         from sqlalchemy import func
         
-        summary = session.query(
+        summary = (await session.execute(select(
             PointsHistory.points_type,
             func.sum(PointsHistory.points_amount).label('total')
-        ).filter(
+        ).where(
             PointsHistory.user_id == user_id
         ).group_by(
             PointsHistory.points_type
-        ).all()
+        ))).all()
         
         result = {
             'user': user,
@@ -1288,32 +1576,31 @@ def get_user_points_summary(user_id: int):
         return result
         
     finally:
-        session.close()
+        await session.close()
 
 
-def get_points_statistics(start_date: datetime = None, end_date: datetime = None):
-    """Статистика начисления баллов по периодам"""
-    session = Session()
+async def get_points_statistics(start_date: date = None, end_date: date = None):
+    """
+    Начисления по дням и типам за период (границы включительно), новые дни сверху.
+    Читает дневную сводку points_daily, а не историю: стоимость зависит от
+    длины периода, а не от объема истории.
+    Строки: date, points_type, total, count
+    """
+    query = select(
+        PointsDaily.day.label('date'),
+        PointsDaily.points_type,
+        PointsDaily.total,
+        PointsDaily.count
+    ).where(PointsDaily.count > 0).order_by(PointsDaily.day.desc(), PointsDaily.points_type)
+    
+    if start_date:
+        query = query.where(PointsDaily.day >= start_date.strftime('%Y-%m-%d'))
+    if end_date:
+        query = query.where(PointsDaily.day <= end_date.strftime('%Y-%m-%d'))
+    
+    session = async_session()
     try:
-        from sqlalchemy import func
-        
-        query = session.query(
-            func.date(PointsHistory.created_at).label('date'),
-            PointsHistory.points_type,
-            func.sum(PointsHistory.points_amount).label('total')
-        ).group_by(
-            func.date(PointsHistory.created_at),
-            PointsHistory.points_type
-        ).order_by(
-            func.date(PointsHistory.created_at).desc()
-        )
-        
-        if start_date:
-            query = query.filter(PointsHistory.created_at >= start_date)
-        if end_date:
-            query = query.filter(PointsHistory.created_at <= end_date)
-        
-        return query.limit(30).all()
-        
+        result = await session.execute(query)
+        return result.all()
     finally:
-        session.close()
\ No newline at end of file
+        await session.close()
\ No newline at end of file